@@ -0,0 +1,331 @@
+"""Batch refine/evaluate over a JSONL prompt library.
+
+Each input line is a JSON object::
+
+    {"id": "p1", "prompt": "...", "model": "ChatGPT", "word_limit": "short",
+     "tags": ["technical"], "mode": "Technical", "action": "both"}
+
+Only ``prompt`` is required. ``mode`` selects one of try.py's refinement
+styles; without it the home page instruction (model, word limit, tags) is
+used. Results are appended to the output JSONL as they finish, and the
+output file doubles as the checkpoint: rerunning the same command skips
+every line that already has a successful result.
+
+All of a run's model calls share one scheduler user, so at most
+``SCHEDULER_MAX_USER_QUEUE`` of them are in flight at once, however many
+workers there are; more would only be shed by the scheduler and retried.
+
+``--action score`` skips the model entirely and writes the instant local
+score of every prompt, scored in large vectorized chunks.
+
+Usage::
+
+    python batch.py prompts.jsonl results.jsonl --workers 16 --action both
+    python batch.py prompts.jsonl scores.jsonl --action score
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import time
+
+import httpx
+
+from budget import budget_for
+from cache import make_cache_key
+from clients import get_registry, route_model
+from gemini_rest import GeminiError
+from llm import agenerate
+from prompts import (MODES, build_evaluate_instruction, build_mode_instruction,
+                     build_refine_instruction, clean_output, resolve_word_limit)
+from resilience import CallRejected, DeadlineExceeded
+from scheduler import DEFAULT_MAX_USER_QUEUE
+from scorer import SCORE_DIMENSIONS, score_prompts
+
+ACTIONS = ("refine", "evaluate", "both")
+
+
+NOT_JSON = "Line is not valid JSON"
+NOT_AN_OBJECT = "Line is not a JSON object"
+
+
+def parse_record(line):
+    """Return ``(record, error)`` for one input line; ``error`` is set unless it is a JSON object."""
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return None, NOT_JSON
+    if not isinstance(record, dict):
+        return None, NOT_AN_OBJECT
+    return record, None
+
+
+def record_id(record, line_number):
+    return str(record.get("id", line_number))
+
+
+def write_result(output, result):
+    output.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+
+def load_completed(output_path):
+    """Return the ids already written successfully to the output file.
+
+    A crash can leave a partial last line behind; it is truncated so that
+    new results start on a fresh line.
+    """
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+
+    with open(output_path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+            data = data[:data.rfind(b"\n") + 1]
+
+    for line in data.splitlines():
+        try:
+            result = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(result, dict) and not result.get("error"):
+            completed.add(str(result.get("id")))
+    return completed
+
+
+async def call_model(client, instruction, cache_key, model_id, latency_class, budget, bypass_cache,
+                     max_rejections=0, slots=None):
+    # Batch calls queue behind interactive ones and can be shed under saturation; wait as told and retry
+    for rejections in range(max_rejections + 1):
+        try:
+            async with slots or contextlib.nullcontext():
+                return await agenerate(client, instruction, cache_key=cache_key, bypass_cache=bypass_cache,
+                                       model_id=model_id, latency_class=latency_class, priority="batch",
+                                       user="batch", budget=budget)
+        except CallRejected as e:
+            if rejections == max_rejections:
+                raise
+            await asyncio.sleep(max(0.1, e.retry_after))
+
+
+async def process(client, record, action, bypass_cache, max_rejections=0, slots=None):
+    """Refine and/or evaluate one record; ``slots`` bounds the model calls in flight."""
+    prompt = str(record.get("prompt") or "").strip()
+    if not prompt:
+        raise ValueError("Prompt cannot be empty")
+    action = record.get("action") or action
+    if action not in ACTIONS:
+        raise ValueError(f"Invalid action: {action}")
+
+    result = {}
+    tokens = 0
+    calls = []
+
+    if action in ("refine", "both"):
+        mode = record.get("mode")
+        if mode:
+            if mode not in MODES:
+                raise ValueError(f"Invalid mode: {mode}")
+            instruction = build_mode_instruction(prompt, mode)
+            model_id = route_model("refine")
+            cache_key = make_cache_key("refine", prompt, model_id, mode=mode)
+            latency_class = mode
+            budget = None
+        else:
+            target_model = str(record.get("model") or "ChatGPT")
+            word_limit_context = resolve_word_limit(record.get("word_limit", "medium"))
+            tags = [str(tag) for tag in record.get("tags") or []]
+            instruction = build_refine_instruction(prompt, target_model, word_limit_context, tags)
+            model_id = route_model("refine", word_limit_context)
+            cache_key = make_cache_key("refine", prompt, model_id, target_model=target_model,
+                                       word_limit=word_limit_context, tags=tags)
+            latency_class = word_limit_context
+            budget = budget_for(word_limit_context)
+        calls.append(("refined_output", instruction, cache_key, model_id, latency_class, budget))
+
+    if action in ("evaluate", "both"):
+        model_id = route_model("evaluate")
+        calls.append(("evaluation", build_evaluate_instruction(prompt),
+                      make_cache_key("evaluate", prompt, model_id), model_id, "evaluate", None))
+
+    # Refine and evaluate of one line are independent, so run them together; a shed call is retried on its own
+    generations = await asyncio.gather(*(
+        call_model(client, instruction, cache_key, model_id, latency_class, budget, bypass_cache,
+                   max_rejections, slots)
+        for _, instruction, cache_key, model_id, latency_class, budget in calls
+    ))
+    for (field, *_), generation in zip(calls, generations):
+        result[field] = clean_output(generation.text)
+        tokens += generation.prompt_tokens + generation.completion_tokens
+    return result, tokens
+
+
+class BatchRunner:
+    def __init__(self, client, output_path, action="refine", workers=8, bypass_cache=False, max_rejections=5):
+        self.client = client
+        self.output_path = output_path
+        self.action = action
+        self.workers = workers
+        self.bypass_cache = bypass_cache
+        self.max_rejections = max_rejections
+        # The scheduler sheds a user's calls beyond its per-user queue, so never have more in flight
+        self.max_calls = DEFAULT_MAX_USER_QUEUE
+        self._slots = None
+        self.stats = {"done": 0, "failed": 0, "skipped": 0, "tokens": 0}
+
+    async def _process(self, record):
+        return await process(self.client, record, self.action, self.bypass_cache, self.max_rejections, self._slots)
+
+    async def _worker(self, queue, output):
+        while True:
+            item = await queue.get()
+            if item is None:
+                queue.task_done()
+                return
+            rid, record = item
+            started = time.perf_counter()
+            try:
+                try:
+                    result, tokens = await self._process(record)
+                    self.stats["done"] += 1
+                    self.stats["tokens"] += tokens
+                except (GeminiError, httpx.HTTPError, CallRejected, DeadlineExceeded, ValueError) as e:
+                    logging.error(f"Line {rid} failed: {e}")
+                    result = {"error": str(e)}
+                    self.stats["failed"] += 1
+                except Exception as e:
+                    # A worker that dies leaves the reader blocked on a full queue, so fail the line instead
+                    logging.exception(f"Line {rid} failed unexpectedly")
+                    result = {"error": f"{type(e).__name__}: {e}"}
+                    self.stats["failed"] += 1
+                write_result(output, {"id": rid, **result, "latency": round(time.perf_counter() - started, 3)})
+                output.flush()
+            except OSError as e:
+                logging.error(f"Could not write the result of line {rid}: {e}")
+            finally:
+                queue.task_done()
+
+    async def run(self, input_path):
+        completed = load_completed(self.output_path)
+        # Keep only a small window of lines in memory regardless of file size
+        queue = asyncio.Queue(maxsize=self.workers * 2)
+        # Each worker makes up to two calls at once for "both"
+        if self.workers * 2 > self.max_calls:
+            logging.info(f"Limiting model calls in flight to {self.max_calls}, the scheduler's per-user queue")
+            self._slots = asyncio.Semaphore(self.max_calls)
+
+        with open(self.output_path, "a", encoding="utf-8") as output:
+            tasks = [asyncio.create_task(self._worker(queue, output)) for _ in range(self.workers)]
+            last_sync = time.monotonic()
+            with open(input_path, encoding="utf-8") as f:
+                for line_number, line in enumerate(f):
+                    if not line.strip():
+                        continue
+                    record, error = parse_record(line)
+                    if error:
+                        logging.error(f"Line {line_number}: {error}")
+                        write_result(output, {"id": str(line_number), "error": error})
+                        self.stats["failed"] += 1
+                        continue
+                    rid = record_id(record, line_number)
+                    if rid in completed:
+                        self.stats["skipped"] += 1
+                        continue
+                    await queue.put((rid, record))
+
+                    # Make finished results durable every few seconds
+                    if time.monotonic() - last_sync > 5:
+                        os.fsync(output.fileno())
+                        last_sync = time.monotonic()
+
+            for _ in tasks:
+                await queue.put(None)
+            await asyncio.gather(*tasks)
+            os.fsync(output.fileno())
+        return self.stats
+
+
+def score_file(input_path, output_path, chunk_size=10000):
+    """Write the local score of every prompt in the input; no model calls are made."""
+    completed = load_completed(output_path)
+    stats = {"done": 0, "failed": 0, "skipped": 0, "tokens": 0}
+    columns = ("overall",) + SCORE_DIMENSIONS
+    pending = []
+
+    with open(output_path, "a", encoding="utf-8") as output:
+        def flush():
+            for (rid, _), row in zip(pending, score_prompts(prompt for _, prompt in pending)):
+                write_result(output, {"id": rid, "local_score": dict(zip(columns, row.tolist()))})
+            stats["done"] += len(pending)
+            pending.clear()
+
+        with open(input_path, encoding="utf-8") as f:
+            for line_number, line in enumerate(f):
+                if not line.strip():
+                    continue
+                record, error = parse_record(line)
+                if error:
+                    logging.error(f"Line {line_number}: {error}")
+                    write_result(output, {"id": str(line_number), "error": error})
+                    stats["failed"] += 1
+                    continue
+                rid = record_id(record, line_number)
+                if rid in completed:
+                    stats["skipped"] += 1
+                    continue
+                prompt = str(record.get("prompt") or "").strip()
+                if not prompt:
+                    write_result(output, {"id": rid, "error": "Prompt cannot be empty"})
+                    stats["failed"] += 1
+                    continue
+                pending.append((rid, prompt))
+                if len(pending) >= chunk_size:
+                    flush()
+        if pending:
+            flush()
+        output.flush()
+        os.fsync(output.fileno())
+    return stats
+
+
+async def main(argv=None):
+    parser = argparse.ArgumentParser(description="Refine and/or evaluate a JSONL file of prompts.")
+    parser.add_argument("input", help="input JSONL file")
+    parser.add_argument("output", help="output JSONL file, also used to resume")
+    parser.add_argument("--action", choices=ACTIONS + ("score",), default="refine",
+                        help="default action for lines without their own; 'score' scores locally only")
+    parser.add_argument("--workers", type=int, default=8, help="concurrent requests in flight")
+    parser.add_argument("--bypass-cache", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    if args.action == "score":
+        started = time.perf_counter()
+        stats = score_file(args.input, args.output)
+        elapsed = time.perf_counter() - started
+        print(f"Scored {stats['done']} prompts ({stats['failed']} failed, {stats['skipped']} already done) "
+              f"in {elapsed:.2f}s ({stats['done'] / max(elapsed, 1e-9):.0f} prompts/sec)")
+        return
+
+    registry = get_registry()
+    client = registry.rest_client(max_connections=max(args.workers * 2, 10))
+    runner = BatchRunner(client, args.output, action=args.action, workers=args.workers,
+                         bypass_cache=args.bypass_cache)
+    started = time.perf_counter()
+    try:
+        stats = await runner.run(args.input)
+    finally:
+        await registry.aclose()
+    elapsed = time.perf_counter() - started
+
+    print(f"Processed {stats['done']} prompts ({stats['failed']} failed, {stats['skipped']} already done) "
+          f"in {elapsed:.1f}s")
+    print(f"Throughput: {stats['done'] / elapsed:.2f} prompts/sec, {stats['tokens'] / elapsed:.1f} tokens/sec")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
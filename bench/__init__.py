@@ -0,0 +1 @@
+"""Offline benchmarks: a fake Gemini API (``bench.fake_gemini``) and scenarios (``bench.run``)."""
@@ -0,0 +1,216 @@
+"""Offline stand-in for the Gemini REST API.
+
+Answers ``generateContent``, ``streamGenerateContent`` (as SSE for the
+async REST client and as a JSON array for the SDK's REST transport),
+``models/{id}`` and ``cachedContents`` with generated text, so the app can
+be benchmarked without an API key or quota. Point the app at it with
+``GEMINI_BASE_URL``.
+
+Latency is drawn from a log-normal distribution around a median, with an
+optional slow tail; streamed responses spread it over their chunks. A
+share of calls can fail with a retryable status. Token counts follow the
+request and response lengths. Text comes in sentences and stops at the
+request's ``max_output_tokens``, as the real API does.
+
+Run on its own with::
+
+    python -m bench.fake_gemini --port 8765 --latency-ms 800 --tail-rate 0.02 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import json
+import random
+from collections import namedtuple
+
+from starlette.applications import Starlette
+from starlette.requests import ClientDisconnect
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+FakeConfig = namedtuple("FakeConfig", [
+    "latency_ms", "latency_sigma", "tail_rate", "tail_ms", "error_rate", "output_words", "stream_chunks", "seed",
+])
+DEFAULT_CONFIG = FakeConfig(latency_ms=200.0, latency_sigma=0.3, tail_rate=0.0, tail_ms=5000.0, error_rate=0.0,
+                            output_words=250, stream_chunks=8, seed=0)
+
+ERROR_STATUSES = ((429, "RESOURCE_EXHAUSTED"), (500, "INTERNAL"), (503, "UNAVAILABLE"))
+WORDS = ("clear", "specific", "context", "audience", "format", "examples", "constraints", "tone", "steps",
+         "output", "detail", "role", "goal", "criteria", "concise", "structured", "relevant", "accurate")
+
+
+def count_tokens(text):
+    # Roughly four characters per token, as for English text
+    return max(1, len(text) // 4)
+
+
+def request_text(body):
+    parts = [part.get("text", "") for content in body.get("contents") or [] for part in content.get("parts") or []]
+    system = body.get("systemInstruction") or {}
+    parts += [part.get("text", "") for part in system.get("parts") or []]
+    return "".join(parts)
+
+
+class FakeGemini:
+    def __init__(self, config=DEFAULT_CONFIG):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.stats = {"requests": 0, "streams": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+    def latency(self):
+        """Seconds the next response takes in total."""
+        config = self.config
+        if config.tail_rate and self.random.random() < config.tail_rate:
+            return config.tail_ms / 1000
+        return config.latency_ms / 1000 * self.random.lognormvariate(0, config.latency_sigma)
+
+    def failure(self):
+        if self.config.error_rate and self.random.random() < self.config.error_rate:
+            self.stats["errors"] += 1
+            status, reason = self.random.choice(ERROR_STATUSES)
+            return JSONResponse({"error": {"code": status, "message": "Injected failure", "status": reason}},
+                                status_code=status)
+        return None
+
+    def output(self, body):
+        # The REST client passes the config through as given, the SDK sends camelCase
+        config = body.get("generationConfig") or {}
+        sentences = []
+        for start in range(0, self.config.output_words, 12):
+            sentence = " ".join(self.random.choice(WORDS) for _ in range(min(12, self.config.output_words - start)))
+            sentences.append(sentence.capitalize() + ".")
+        words = " ".join(sentences)
+        max_tokens = config.get("maxOutputTokens") or config.get("max_output_tokens")
+        if max_tokens and count_tokens(words) > max_tokens:
+            words = words[:int(max_tokens) * 4]
+        mime_type = config.get("responseMimeType") or config.get("response_mime_type")
+        if mime_type == "application/json":
+            # Combined mode asks for the refined prompt and the evaluation in one object
+            return json.dumps({"optimized_prompt": words, "evaluation": {"clarity": "Clear.", "suggestions": words[:200]}})
+        return words
+
+    def chunk(self, text, prompt_tokens, completion_tokens):
+        return {
+            "candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": "STOP", "index": 0}],
+            "usageMetadata": {"promptTokenCount": prompt_tokens, "candidatesTokenCount": completion_tokens,
+                              "totalTokenCount": prompt_tokens + completion_tokens},
+        }
+
+    async def generate(self, request):
+        body = await request.json()
+        self.stats["requests"] += 1
+        await asyncio.sleep(self.latency())
+        error = self.failure()
+        if error:
+            return error
+        text = self.output(body)
+        prompt_tokens, completion_tokens = count_tokens(request_text(body)), count_tokens(text)
+        self.stats["prompt_tokens"] += prompt_tokens
+        self.stats["completion_tokens"] += completion_tokens
+        return JSONResponse(self.chunk(text, prompt_tokens, completion_tokens))
+
+    async def stream(self, request):
+        body = await request.json()
+        self.stats["requests"] += 1
+        self.stats["streams"] += 1
+        latency = self.latency()
+        chunks = max(1, self.config.stream_chunks)
+        # Time to first chunk is a third of the total, the rest is spread over the chunks
+        await asyncio.sleep(latency / 3)
+        error = self.failure()
+        if error:
+            return error
+        text = self.output(body)
+        prompt_tokens, completion_tokens = count_tokens(request_text(body)), count_tokens(text)
+        self.stats["prompt_tokens"] += prompt_tokens
+        self.stats["completion_tokens"] += completion_tokens
+        size = -(-len(text) // chunks)
+        pieces = [text[i:i + size] for i in range(0, len(text), size)]
+        sse = request.query_params.get("alt") == "sse"
+
+        async def events():
+            if not sse:
+                yield "["
+            for i, piece in enumerate(pieces):
+                if i:
+                    await asyncio.sleep(latency * 2 / 3 / len(pieces))
+                # Only the last chunk reports the usage of the whole response
+                data = self.chunk(piece, prompt_tokens, completion_tokens if i == len(pieces) - 1 else 0)
+                if sse:
+                    yield f"data: {json.dumps(data)}\r\n\r\n"
+                else:
+                    yield ("," if i else "") + json.dumps(data)
+            if not sse:
+                yield "]"
+
+        return StreamingResponse(events(), media_type="text/event-stream" if sse else "application/json")
+
+    async def model(self, request):
+        name = request.path_params["name"]
+        return JSONResponse({"name": f"models/{name}", "displayName": name, "inputTokenLimit": 1048576,
+                             "outputTokenLimit": 8192, "supportedGenerationMethods": ["generateContent"]})
+
+    async def cached_content(self, request):
+        body = await request.json()
+        return JSONResponse({"name": f"cachedContents/fake-{self.random.getrandbits(32):08x}",
+                             "model": body.get("model"), "ttl": body.get("ttl")})
+
+    async def read_stats(self, request):
+        return JSONResponse(self.stats)
+
+    async def dispatch(self, request):
+        # Model methods arrive as "models/<id>:<method>", which a route pattern cannot split
+        name, _, method = request.path_params["name"].partition(":")
+        request.path_params["name"] = name
+        try:
+            if method == "generateContent":
+                return await self.generate(request)
+            if method == "streamGenerateContent":
+                return await self.stream(request)
+        except ClientDisconnect:
+            # The app cancelled the call, e.g. a hedged duplicate that lost the race
+            return Response(status_code=499)
+        return await self.model(request)
+
+
+def create_app(config=DEFAULT_CONFIG):
+    fake = FakeGemini(config)
+    app = Starlette(routes=[
+        Route("/{version}/models/{name:path}", fake.dispatch, methods=["GET", "POST"]),
+        Route("/{version}/cachedContents", fake.cached_content, methods=["POST"]),
+        Route("/stats", fake.read_stats),
+    ])
+    app.state.fake = fake
+    return app
+
+
+def add_arguments(parser):
+    parser.add_argument("--latency-ms", type=float, default=DEFAULT_CONFIG.latency_ms,
+                        help="median response time")
+    parser.add_argument("--latency-sigma", type=float, default=DEFAULT_CONFIG.latency_sigma,
+                        help="log-normal spread of response times")
+    parser.add_argument("--tail-rate", type=float, default=DEFAULT_CONFIG.tail_rate,
+                        help="share of responses that take --tail-ms")
+    parser.add_argument("--tail-ms", type=float, default=DEFAULT_CONFIG.tail_ms)
+    parser.add_argument("--error-rate", type=float, default=DEFAULT_CONFIG.error_rate,
+                        help="share of calls failing with 429, 500 or 503")
+    parser.add_argument("--output-words", type=int, default=DEFAULT_CONFIG.output_words)
+    parser.add_argument("--stream-chunks", type=int, default=DEFAULT_CONFIG.stream_chunks)
+    parser.add_argument("--seed", type=int, default=DEFAULT_CONFIG.seed)
+
+
+def config_from_args(args):
+    return FakeConfig(*(getattr(args, field) for field in FakeConfig._fields))
+
+
+def main(argv=None):
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Serve a fake Gemini API for benchmarks.")
+    parser.add_argument("--port", type=int, default=8765)
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    uvicorn.run(create_app(config_from_args(args)), host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
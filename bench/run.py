@@ -0,0 +1,367 @@
+"""Benchmark scenarios against the offline Gemini stand-in.
+
+Starts ``bench.fake_gemini`` on a free port, points the app at it with
+``GEMINI_BASE_URL`` and runs each scenario with its own cache, history and
+lock directories in a temporary folder, so results never depend on earlier
+runs and no API quota is spent:
+
+    refine      sequential refinements through the Streamlit call path (SDK)
+    evaluate    sequential evaluations through the same path
+    stream      sequential streamed refinements, timing the first chunk too
+    batch       batch.py refining and evaluating a generated prompt library
+    load        concurrent clients posting to server.py's /refine and /evaluate
+
+Every scenario reports p50/p95/p99 latency, throughput, errors and memory
+(RSS of the benchmark process, or of the server for ``load``). Results are
+saved as JSON under ``bench/results`` and can be compared with an earlier
+run. Usage::
+
+    python -m bench.run
+    python -m bench.run --scenarios load --requests 500 --concurrency 64 --workers 4
+    python -m bench.run --latency-ms 20 --requests 20      # quick CI run
+    python -m bench.run --compare bench/results/<earlier>.json
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench.fake_gemini import add_arguments
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "bench", "results")
+SCENARIOS = ("refine", "evaluate", "stream", "batch", "load")
+TOPICS = ("a product launch email", "a Python code review", "a history lesson plan", "a travel itinerary",
+          "a customer support reply", "a research summary", "a marketing slogan", "a SQL tutorial")
+
+
+def sample_prompt(i):
+    # Distinct prompts so neither the response cache nor coalescing hides the model latency
+    return f"Help me write {TOPICS[i % len(TOPICS)]} for audience #{i}, keep it practical."
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(url, process, timeout=30.0):
+    import httpx
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with status {process.returncode}")
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not start within {timeout:.0f}s")
+
+
+def rss_mb(pid="self"):
+    """Resident memory of a process and its children, in MB."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            rss = next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+        children = f"/proc/{pid}/task/{pid if pid != 'self' else os.getpid()}/children"
+        if os.path.exists(children):
+            with open(children) as f:
+                rss += sum(rss_mb(child) * 1024 for child in f.read().split())
+        return rss / 1024
+    except (OSError, StopIteration):
+        # No /proc (macOS): fall back to this process's peak
+        scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q / 100))] if values else None
+
+
+def ms(seconds):
+    return round(seconds * 1000, 1) if seconds is not None else None
+
+
+def summarize(latencies, errors, elapsed, memory, **extra):
+    result = {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p95_ms": ms(percentile(latencies, 95)),
+        "p99_ms": ms(percentile(latencies, 99)),
+        "rss_mb": round(memory, 1),
+    }
+    result.update(extra)
+    return result
+
+
+def run_calls(count, call, warmup=0):
+    # Warm-up calls (SDK import, connections, templates) use their own prompts and are not timed
+    for i in range(warmup):
+        call(-1 - i)
+    latencies, errors = [], 0
+    started = time.perf_counter()
+    for i in range(count):
+        request_started = time.perf_counter()
+        try:
+            call(i)
+        except Exception as e:
+            errors += 1
+            print(f"  request {i} failed: {e}", file=sys.stderr)
+            continue
+        latencies.append(time.perf_counter() - request_started)
+    return latencies, errors, time.perf_counter() - started
+
+
+def scenario_refine(args):
+    from cache import make_cache_key
+    from clients import route_model
+    from llm import generate
+    from prompts import DEFAULT_WORD_LIMIT, WORD_MAP, build_refine_instruction
+
+    word_limit = WORD_MAP[DEFAULT_WORD_LIMIT]
+
+    def call(i):
+        prompt = sample_prompt(i)
+        model_id = route_model("refine", word_limit)
+        instruction = build_refine_instruction(prompt, "ChatGPT", word_limit, ["bench"])
+        cache_key = make_cache_key("refine", prompt, model_id, target_model="ChatGPT", word_limit=word_limit,
+                                   tags=["bench"])
+        generate(instruction, cache_key=cache_key, model_id=model_id, latency_class=word_limit)
+
+    latencies, errors, elapsed = run_calls(args.requests, call, args.warmup)
+    return summarize(latencies, errors, elapsed, rss_mb())
+
+
+def scenario_evaluate(args):
+    from cache import make_cache_key
+    from clients import route_model
+    from llm import generate
+    from prompts import build_evaluate_instruction
+
+    def call(i):
+        prompt = sample_prompt(i)
+        model_id = route_model("evaluate")
+        generate(build_evaluate_instruction(prompt), cache_key=make_cache_key("evaluate", prompt, model_id),
+                 model_id=model_id, latency_class="evaluate")
+
+    latencies, errors, elapsed = run_calls(args.requests, call, args.warmup)
+    return summarize(latencies, errors, elapsed, rss_mb())
+
+
+def scenario_stream(args):
+    from cache import make_cache_key
+    from clients import route_model
+    from llm import stream_text
+    from prompts import DEFAULT_WORD_LIMIT, WORD_MAP, build_refine_instruction
+
+    word_limit = WORD_MAP[DEFAULT_WORD_LIMIT]
+    first_chunks = []
+
+    def call(i):
+        # Offset the prompts so this scenario never hits the refine scenario's cache entries
+        prompt = sample_prompt(i + args.requests)
+        model_id = route_model("refine", word_limit)
+        instruction = build_refine_instruction(prompt, "ChatGPT", word_limit, ["bench"])
+        cache_key = make_cache_key("refine", prompt, model_id, target_model="ChatGPT", word_limit=word_limit,
+                                   tags=["bench", "stream"])
+        started = time.perf_counter()
+        for n, _ in enumerate(stream_text(instruction, cache_key=cache_key, model_id=model_id,
+                                          latency_class=word_limit)):
+            if not n:
+                first_chunks.append(time.perf_counter() - started)
+
+    latencies, errors, elapsed = run_calls(args.requests, call, args.warmup)
+    return summarize(latencies, errors, elapsed, rss_mb(),
+                     first_chunk_p50_ms=ms(percentile(first_chunks, 50)))
+
+
+def scenario_batch(args, workdir):
+    import batch
+
+    input_path = os.path.join(workdir, "batch_input.jsonl")
+    output_path = os.path.join(workdir, "batch_output.jsonl")
+    with open(input_path, "w", encoding="utf-8") as f:
+        for i in range(args.requests):
+            f.write(json.dumps({"id": f"p{i}", "prompt": sample_prompt(i + 2 * args.requests)}) + "\n")
+
+    started = time.perf_counter()
+    asyncio.run(batch.main([input_path, output_path, "--action", "both", "--workers", str(args.concurrency)]))
+    elapsed = time.perf_counter() - started
+
+    latencies, errors = [], 0
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            result = json.loads(line)
+            if "error" in result:
+                errors += 1
+            else:
+                latencies.append(result["latency"])
+    return summarize(latencies, errors, elapsed, rss_mb())
+
+
+async def load_clients(base_url, args):
+    import httpx
+
+    latencies, errors = [], 0
+    queue = asyncio.Queue()
+    for i in range(args.requests):
+        queue.put_nowait(i)
+
+    async def client(http):
+        nonlocal errors
+        while not queue.empty():
+            i = queue.get_nowait()
+            route = "/refine" if i % 2 == 0 else "/evaluate"
+            body = {"prompt": sample_prompt(i + 3 * args.requests), "max_words": "medium", "stream": args.stream}
+            started = time.perf_counter()
+            try:
+                response = await http.post(route, json=body)
+                failed = response.status_code != 200 or (args.stream and "event: error" in response.text)
+            except httpx.HTTPError as e:
+                print(f"  request {i} failed: {e}", file=sys.stderr)
+                failed = True
+            if failed:
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - started)
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=120.0, limits=limits) as http:
+        started = time.perf_counter()
+        await asyncio.gather(*(client(http) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+    return latencies, errors, elapsed
+
+
+def scenario_load(args, env):
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(args.workers), "--log-level", "warning"],
+        cwd=ROOT, env=env,
+    )
+    try:
+        base_url = f"http://127.0.0.1:{port}"
+        wait_for(f"{base_url}/about", server)
+        latencies, errors, elapsed = asyncio.run(load_clients(base_url, args))
+        return summarize(latencies, errors, elapsed, rss_mb(server.pid), concurrency=args.concurrency,
+                         workers=args.workers, stream=args.stream)
+    finally:
+        server.terminate()
+        server.wait(10)
+
+
+def git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_results(results, baseline=None):
+    columns = ("requests", "errors", "throughput", "p50_ms", "p95_ms", "p99_ms", "rss_mb")
+    print(f"{'scenario':<10}" + "".join(f"{column:>12}" for column in columns))
+    for name, result in results["scenarios"].items():
+        print(f"{name:<10}" + "".join(f"{str(result.get(column)):>12}" for column in columns))
+        before = (baseline or {}).get("scenarios", {}).get(name)
+        if before:
+            deltas = []
+            for column in columns[2:]:
+                old, new = before.get(column), result.get(column)
+                deltas.append(f"{(new - old) / old:+.0%}" if old and new is not None else "")
+            print(f"{'  vs base':<10}{'':>24}" + "".join(f"{delta:>12}" for delta in deltas))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the app against a fake Gemini API.")
+    parser.add_argument("--scenarios", nargs="*", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=40, help="requests per scenario")
+    parser.add_argument("--warmup", type=int, default=2, help="untimed requests before each sequential scenario")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent clients for batch and load")
+    parser.add_argument("--workers", type=int, default=1, help="server worker processes for load")
+    parser.add_argument("--stream", action="store_true", help="load clients ask for SSE responses")
+    parser.add_argument("--output", help="where to save the results (default: bench/results/<time>-<version>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    fake_port = free_port()
+    env = dict(
+        os.environ,
+        GEMINI_BASE_URL=f"http://127.0.0.1:{fake_port}",
+        GEMINI_API_KEY="fake",
+        PROMPT_CACHE_PATH=os.path.join(workdir, "responses.sqlite3"),
+        HISTORY_DB_PATH=os.path.join(workdir, "history.sqlite3"),
+        SIMILARITY_INDEX_DIR=os.path.join(workdir, "similarity"),
+        SINGLE_FLIGHT_DIR=os.path.join(workdir, "inflight"),
+        SCHEDULER_DIR=os.path.join(workdir, "scheduler"),
+        FEEDBACK_SPOOL_DIR=os.path.join(workdir, "feedback"),
+    )
+    # The fake API has no quota; keep the client-side limiter out of the measurement unless asked
+    env.setdefault("GEMINI_RPM", "1000000")
+    env.setdefault("GEMINI_TPM", "1000000000")
+    # Repo modules read their settings at import, so set them before any import below
+    os.environ.update(env)
+
+    fake_args = [f"--{name.replace('_', '-')}={getattr(args, name)}"
+                 for name in ("latency_ms", "latency_sigma", "tail_rate", "tail_ms", "error_rate", "output_words",
+                              "stream_chunks", "seed")]
+    fake = subprocess.Popen([sys.executable, "-m", "bench.fake_gemini", f"--port={fake_port}"] + fake_args,
+                            cwd=ROOT, env=env)
+    results = {
+        "version": git_version(),
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "config": vars(args),
+        "scenarios": {},
+    }
+    try:
+        wait_for(f"{env['GEMINI_BASE_URL']}/stats", fake)
+        for name in args.scenarios:
+            print(f"Running {name}...", file=sys.stderr)
+            if name == "batch":
+                result = scenario_batch(args, workdir)
+            elif name == "load":
+                result = scenario_load(args, env)
+            else:
+                result = globals()[f"scenario_{name}"](args)
+            results["scenarios"][name] = result
+    finally:
+        fake.terminate()
+        fake.wait(10)
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = os.path.join(RESULTS_DIR, f"{stamp}-{results['version']}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    print(f"Saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""Output-length budgets derived from the selected word limit.
+
+A word limit such as "300-500 words" becomes a ``LengthBudget``: the
+instruction still asks for the range, ``max_output_tokens`` caps the
+response a little above its upper bound, and ``WordLimiter`` ends a
+streamed response at the first sentence boundary once the upper bound is
+reached, so over-long answers are neither waited for nor paid for.
+Non-streamed responses are cut the same way. Every budgeted response
+records its length against the target in ``metrics``.
+
+Tunables (environment)::
+
+    OUTPUT_TOKENS_PER_WORD   output tokens budgeted per word (1.6)
+    OUTPUT_BUDGET_SLACK      share of the upper bound a response may run over to finish a sentence (0.1)
+"""
+import math
+import os
+import re
+from collections import namedtuple
+
+from metrics import get_metrics
+
+TOKENS_PER_WORD = float(os.environ.get("OUTPUT_TOKENS_PER_WORD", "1.6"))
+SLACK = float(os.environ.get("OUTPUT_BUDGET_SLACK", "0.1"))
+
+WORD_RANGE_RE = re.compile(r"(\d+)\s*-\s*(\d+)")
+WORD_RE = re.compile(r"\w[\w'’-]*")
+# A sentence ends at terminal punctuation followed by whitespace, or at the end of a line
+SENTENCE_END_RE = re.compile(r"[.!?…][\"'”’)\]*]*(?=\s|$)|\S(?=[ \t]*\n)")
+
+
+class LengthBudget(namedtuple("LengthBudget", ["word_limit", "low", "high", "max_output_tokens"])):
+    @property
+    def hard_limit(self):
+        # Words after which a response is cut even without a sentence boundary
+        return int(self.high * (1 + SLACK))
+
+    def generation_config(self, config=None):
+        """Return ``config`` with the output token cap added, unless it sets its own."""
+        merged = dict(config or {})
+        merged.setdefault("max_output_tokens", self.max_output_tokens)
+        return merged
+
+
+def word_range(word_limit_context):
+    """Return ``(low, high)`` from a word limit such as "800-1000 words", or ``None``."""
+    match = WORD_RANGE_RE.search(word_limit_context or "")
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+def budget_for(word_limit_context):
+    """Return the ``LengthBudget`` of a ``WORD_MAP`` value, or ``None`` when it names no range."""
+    limits = word_range(word_limit_context)
+    if not limits:
+        return None
+    low, high = limits
+    # Room for the slack, plus a little for Markdown and the model's framing
+    max_output_tokens = math.ceil(high * (1 + SLACK) * TOKENS_PER_WORD) + 64
+    return LengthBudget(word_limit_context, low, high, max_output_tokens)
+
+
+def count_words(text):
+    return len(WORD_RE.findall(text))
+
+
+def cut_point(text, budget):
+    """Return the index to end ``text`` at, or ``None`` while it may continue.
+
+    Past the upper bound the text ends at the first sentence boundary; when
+    none comes before the hard limit it is cut after the last allowed word.
+    """
+    word_ends = [match.end() for match in WORD_RE.finditer(text)]
+    if len(word_ends) <= budget.high:
+        return None
+    boundary = SENTENCE_END_RE.search(text, word_ends[budget.high - 1] - 1)
+    hard = budget.hard_limit
+    if boundary and (len(word_ends) <= hard or boundary.end() <= word_ends[hard - 1]):
+        return boundary.end()
+    if len(word_ends) > hard:
+        return word_ends[hard - 1]
+    return None
+
+
+def trim(text, budget):
+    """Return ``(text, stopped)`` with ``text`` cut to the budget."""
+    cut = cut_point(text, budget) if budget else None
+    if cut is None:
+        return text, False
+    return text[:cut], True
+
+
+class WordLimiter:
+    """Passes streamed text through until the budget is used up.
+
+    ``feed`` returns the part of each piece to keep; once it sets
+    ``stopped`` the stream should be closed.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.text = ""
+        self.stopped = False
+
+    def feed(self, piece):
+        start = len(self.text)
+        self.text += piece
+        cut = cut_point(self.text, self.budget)
+        if cut is None:
+            return piece
+        self.stopped = True
+        self.text = self.text[:max(cut, start)]
+        return self.text[start:]
+
+
+def record_length(budget, text, stopped):
+    """Count a response's words against its target range."""
+    words = count_words(text)
+    if stopped:
+        outcome = "stopped"
+    elif words < budget.low:
+        outcome = "short"
+    elif words > budget.high:
+        outcome = "over"
+    else:
+        outcome = "within"
+    metrics = get_metrics()
+    metrics.inc("prompt_output_length_total", word_limit=budget.word_limit, outcome=outcome)
+    metrics.inc("prompt_output_words_total", words, word_limit=budget.word_limit)
+    metrics.inc("prompt_output_target_words_total", budget.high, word_limit=budget.word_limit)
+    return words
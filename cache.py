@@ -0,0 +1,164 @@
+"""Two-tier response cache for Gemini calls.
+
+An in-process LRU (size and TTL bounded) sits in front of a SQLite store in
+WAL mode, so cached responses survive restarts and are shared by every
+worker process on the host.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_CACHE_PATH = os.environ.get("PROMPT_CACHE_PATH", os.path.join(".cache", "responses.sqlite3"))
+DEFAULT_MEMORY_SIZE = int(os.environ.get("PROMPT_CACHE_SIZE", "512"))
+DEFAULT_TTL = float(os.environ.get("PROMPT_CACHE_TTL", str(7 * 24 * 3600)))
+
+
+def normalize_prompt(prompt):
+    # Collapse runs of whitespace so reflowed text maps to the same entry
+    return " ".join(prompt.split())
+
+
+def make_cache_key(kind, prompt, model_id, target_model="", word_limit="", tags=(), **extra):
+    """Build a stable key from the normalized parts of an instruction."""
+    parts = {
+        "kind": kind,
+        "prompt": normalize_prompt(prompt),
+        "model_id": model_id,
+        "target_model": target_model.strip(),
+        "word_limit": word_limit,
+        "tags": sorted(tag.strip().lower() for tag in tags),
+    }
+    parts.update(extra)
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MEMORY_SIZE, ttl=DEFAULT_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = self._connect()
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            conn.commit()
+
+    def _connect(self):
+        # SQLite connections cannot be shared across threads, so keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _remember(self, key, value, created):
+        with self._lock:
+            self._memory[key] = (value, created)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if now - entry[1] <= self.ttl:
+                    self._memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return entry[0]
+                del self._memory[key]
+
+        if self.path:
+            try:
+                row = self._connect().execute(
+                    "SELECT value, created FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+            except sqlite3.Error as e:
+                logging.warning(f"Response cache read failed: {e}")
+                row = None
+            if row is not None and now - row[1] <= self.ttl:
+                self._remember(key, row[0], row[1])
+                self._count("disk_hits")
+                return row[0]
+
+        self._count("misses")
+        return None
+
+    def set(self, key, value):
+        created = time.time()
+        self._remember(key, value, created)
+        if not self.path:
+            return
+        try:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created) VALUES (?, ?, ?)",
+                (key, value, created),
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            logging.warning(f"Response cache write failed: {e}")
+
+    def delete(self, key):
+        """Drop ``key``, e.g. a response that turned out to be unusable."""
+        with self._lock:
+            self._memory.pop(key, None)
+        if not self.path:
+            return
+        try:
+            conn = self._connect()
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            conn.commit()
+        except sqlite3.Error as e:
+            logging.warning(f"Response cache delete failed: {e}")
+
+    def purge_expired(self):
+        if not self.path:
+            return 0
+        conn = self._connect()
+        cursor = conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+        conn.commit()
+        return cursor.rowcount
+
+    def hit_rate(self):
+        with self._lock:
+            hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+            total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Return the process-wide cache shared by all Streamlit sessions."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache()
+    return _cache
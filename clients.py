@@ -0,0 +1,153 @@
+"""Process-wide registry of Gemini clients.
+
+The API key and model routing come from the environment (``.env`` is loaded
+here), the SDK is imported and configured once, on first use, and model
+objects and the pooled async REST client are created once and reused by
+every session in the process.
+
+Routing is per request type and can be overridden with::
+
+    GEMINI_MODEL                default for everything (gemini-1.5-flash)
+    GEMINI_MODEL_REFINE         regular refinements
+    GEMINI_MODEL_REFINE_LONG    refinements with the long word limit
+    GEMINI_MODEL_EVALUATE       evaluations
+    GEMINI_MODEL_CONDENSE       condensing the sections of very large inputs
+
+``GEMINI_BASE_URL`` points both the SDK and the REST client at another
+endpoint, such as the fake API in ``bench/``. Setting ``GEMINI_WARMUP=1``
+imports the SDK and creates the routed models in the background as soon
+as the registry is created, instead of on the first model call.
+"""
+import logging
+import os
+import threading
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DEFAULT_MODEL_ID = os.environ.get("GEMINI_MODEL", "gemini-1.5-flash")
+
+# Word limits that count as long refinements
+LONG_WORD_LIMITS = ("1500-2000 words",)
+
+
+class ClientRegistry:
+    def __init__(self, api_key=None, routes=None):
+        self.api_key = api_key or os.environ.get("GEMINI_API_KEY") or os.environ.get("API_KEY", "")
+        self.routes = {
+            "refine": os.environ.get("GEMINI_MODEL_REFINE", DEFAULT_MODEL_ID),
+            "refine_long": os.environ.get("GEMINI_MODEL_REFINE_LONG", DEFAULT_MODEL_ID),
+            "evaluate": os.environ.get("GEMINI_MODEL_EVALUATE", DEFAULT_MODEL_ID),
+            "condense": os.environ.get("GEMINI_MODEL_CONDENSE", DEFAULT_MODEL_ID),
+        }
+        if routes:
+            self.routes.update(routes)
+        self._models = {}
+        self._rest_client = None
+        self._genai = None
+        self._lock = threading.Lock()
+
+        if not self.api_key:
+            logging.warning("No Gemini API key found; set GEMINI_API_KEY or API_KEY in .env")
+
+    def sdk(self):
+        """Return the configured ``google.generativeai`` module."""
+        # Imported on first use: the SDK takes about a second to import, which
+        # would otherwise delay every cold start of the app
+        if self._genai is None:
+            with self._lock:
+                if self._genai is None:
+                    import google.generativeai as genai
+
+                    base_url = os.environ.get("GEMINI_BASE_URL")
+                    if base_url:
+                        # A custom endpoint (a proxy, or the benchmark's fake API) is reached over REST
+                        genai.configure(api_key=self.api_key, transport="rest",
+                                        client_options={"api_endpoint": base_url})
+                    else:
+                        genai.configure(api_key=self.api_key)
+                    self._genai = genai
+        return self._genai
+
+    def route(self, request_type, word_limit=None):
+        """Return the backend model id for a request type."""
+        if request_type == "refine" and word_limit in LONG_WORD_LIMITS:
+            request_type = "refine_long"
+        return self.routes.get(request_type, DEFAULT_MODEL_ID)
+
+    def model(self, model_id, system_instruction=None, cached_content=None):
+        """Return the shared ``GenerativeModel`` for a model id and preamble.
+
+        ``cached_content`` names a provider context cache holding the
+        preamble; otherwise ``system_instruction`` is sent with each call.
+        """
+        key = (model_id, system_instruction, cached_content)
+        model_api = self._models.get(key)
+        if model_api is None:
+            genai = self.sdk()
+            with self._lock:
+                model_api = self._models.get(key)
+                if model_api is None:
+                    if cached_content:
+                        model_api = genai.GenerativeModel.from_cached_content(cached_content)
+                    else:
+                        model_api = genai.GenerativeModel(model_id, system_instruction=system_instruction)
+                    self._models[key] = model_api
+        return model_api
+
+    def rest_client(self, max_connections=200):
+        """Return the pooled async REST client, creating it on first use."""
+        # Imported here so Streamlit pages never pay for httpx unless they need it
+        from gemini_rest import GeminiRestClient
+
+        with self._lock:
+            if self._rest_client is None:
+                self._rest_client = GeminiRestClient(self.api_key, max_connections=max_connections)
+            return self._rest_client
+
+    async def aclose(self):
+        with self._lock:
+            client, self._rest_client = self._rest_client, None
+        if client is not None:
+            await client.aclose()
+
+    def warm(self):
+        """Create every routed model and open a connection to the API."""
+        for model_id in sorted(set(self.routes.values())):
+            self.model(model_id)
+            try:
+                self.sdk().get_model(f"models/{model_id}")
+            except Exception as e:
+                logging.warning(f"Failed to warm up {model_id}: {e}")
+
+    def warm_in_background(self):
+        threading.Thread(target=self.warm, name="gemini-warmup", daemon=True).start()
+
+    async def awarm(self):
+        client = self.rest_client()
+        for model_id in sorted(set(self.routes.values())):
+            try:
+                await client.get_model(model_id)
+            except Exception as e:
+                logging.warning(f"Failed to warm up {model_id}: {e}")
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = ClientRegistry()
+                # Off by default: warming imports the SDK, which the first model call does anyway
+                if os.environ.get("GEMINI_WARMUP") == "1":
+                    _registry.warm_in_background()
+    return _registry
+
+
+def route_model(request_type, word_limit=None):
+    return get_registry().route(request_type, word_limit)
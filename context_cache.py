@@ -0,0 +1,198 @@
+"""Provider-side context caching of constant system instructions.
+
+Each distinct (model, system instruction) pair is uploaded to Gemini's
+context cache once and referenced by name afterwards, so the fixed preamble
+is not re-sent and re-processed on every call. Gemini only accepts caches
+above a minimum token count; smaller preambles, or models that reject
+caching, fall back to a plain ``system_instruction`` and the refusal is
+remembered so it is not retried on every request. Callers that need an
+entry another caller is already creating wait for it instead of creating a
+second one.
+
+The preambles of the templates in ``prompts`` are all well under the
+minimum (about 60-200 estimated tokens), so with the default settings every
+call sends its preamble inline and no entry is ever created. The cache only
+takes effect for larger preambles, such as long shared few-shot examples.
+
+Tunables (environment)::
+
+    GEMINI_CONTEXT_CACHE            set to 0 to disable
+    GEMINI_CONTEXT_CACHE_TTL        seconds a cache entry lives (3600)
+    GEMINI_CONTEXT_CACHE_MIN_TOKENS smallest preamble worth caching (1024)
+"""
+import asyncio
+import datetime
+import hashlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+from resilience import estimate_tokens
+
+DEFAULT_TTL = int(os.environ.get("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+DEFAULT_MIN_TOKENS = int(os.environ.get("GEMINI_CONTEXT_CACHE_MIN_TOKENS", "1024"))
+# Longest a caller waits for another caller's upload before sending inline
+CREATE_WAIT = 30.0
+
+
+def sdk_create(model_id, system_instruction, ttl):
+    """Create a cache entry with the google-generativeai SDK; return its name."""
+    from clients import get_registry
+
+    # Importing through the registry configures the SDK with the API key first
+    caching = get_registry().sdk().caching
+    cached = caching.CachedContent.create(
+        model=f"models/{model_id}",
+        system_instruction=system_instruction,
+        ttl=datetime.timedelta(seconds=ttl),
+    )
+    return cached.name
+
+
+class ContextCache:
+    def __init__(self, ttl=DEFAULT_TTL, min_tokens=DEFAULT_MIN_TOKENS, enabled=None):
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+        if enabled is None:
+            enabled = os.environ.get("GEMINI_CONTEXT_CACHE", "1") != "0"
+        self.enabled = enabled
+        self._entries = {}
+        # key -> Future of the name, while one caller uploads the entry
+        self._creating = {}
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "created": 0, "skipped": 0, "failed": 0}
+
+    def _key(self, model_id, system_instruction):
+        return model_id, hashlib.sha256(system_instruction.encode("utf-8")).hexdigest()
+
+    def _lookup(self, key):
+        """Return ``(found, name)`` for a live entry, including remembered refusals."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.time():
+                if entry[0]:
+                    self.stats["hits"] += 1
+                return True, entry[0]
+        return False, None
+
+    def _worth_caching(self, system_instruction):
+        if not self.enabled:
+            return False
+        if estimate_tokens(system_instruction, expected_output=0) < self.min_tokens:
+            self.stats["skipped"] += 1
+            return False
+        return True
+
+    def _claim(self, key):
+        """Return ``(future, leader)``: the upload in flight for ``key``, and whether this caller starts it."""
+        with self._lock:
+            future = self._creating.get(key)
+            if future is not None:
+                return future, False
+            future = self._creating[key] = Future()
+            return future, True
+
+    def _finish(self, key, future, name, store=True):
+        with self._lock:
+            if store:
+                # Refresh a little before the provider expires the entry
+                self._entries[key] = (name, time.time() + self.ttl * 0.9)
+                self.stats["created" if name else "failed"] += 1
+            del self._creating[key]
+        future.set_result(name)
+
+    def _shared(self, name):
+        if name:
+            with self._lock:
+                self.stats["hits"] += 1
+        return name
+
+    def get(self, model_id, system_instruction, create=sdk_create):
+        """Return the cached-content name for a preamble, or ``None`` to send it inline."""
+        if not self._worth_caching(system_instruction):
+            return None
+        key = self._key(model_id, system_instruction)
+        found, name = self._lookup(key)
+        if found:
+            return name
+        future, leader = self._claim(key)
+        if not leader:
+            try:
+                return self._shared(future.result(CREATE_WAIT))
+            except FutureTimeout:
+                return None
+        try:
+            name = create(model_id, system_instruction, self.ttl)
+        except Exception as e:
+            logging.warning(f"Context caching unavailable for {model_id}: {e}")
+            name = None
+        except BaseException:
+            self._finish(key, future, None, store=False)
+            raise
+        self._finish(key, future, name)
+        return name
+
+    async def aget(self, model_id, system_instruction, acreate):
+        """Async ``get``; ``acreate`` is a coroutine function with the same signature."""
+        if not self._worth_caching(system_instruction):
+            return None
+        key = self._key(model_id, system_instruction)
+        found, name = self._lookup(key)
+        if found:
+            return name
+        future, leader = self._claim(key)
+        if not leader:
+            try:
+                name = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), CREATE_WAIT)
+            except asyncio.TimeoutError:
+                return None
+            return self._shared(name)
+        try:
+            name = await acreate(model_id, system_instruction, self.ttl)
+        except Exception as e:
+            logging.warning(f"Context caching unavailable for {model_id}: {e}")
+            name = None
+        except BaseException:
+            # Cancelled: let a later caller try again
+            self._finish(key, future, None, store=False)
+            raise
+        self._finish(key, future, name)
+        return name
+
+
+class FakeContextProvider:
+    """Local stand-in for the provider's cache API, for tests and benchmarks.
+
+    Enforces a minimum size like the real service and records every entry
+    created, so callers can check that a preamble is uploaded only once.
+    """
+
+    def __init__(self, min_tokens=0):
+        self.min_tokens = min_tokens
+        self.entries = {}
+
+    def create(self, model_id, system_instruction, ttl):
+        if estimate_tokens(system_instruction, expected_output=0) < self.min_tokens:
+            raise ValueError("Cached content is too small")
+        name = f"cachedContents/fake-{len(self.entries) + 1}"
+        self.entries[name] = (model_id, system_instruction, time.time() + ttl)
+        return name
+
+    async def acreate(self, model_id, system_instruction, ttl):
+        await asyncio.sleep(0)
+        return self.create(model_id, system_instruction, ttl)
+
+
+_context_cache = None
+_context_cache_lock = threading.Lock()
+
+
+def get_context_cache():
+    global _context_cache
+    if _context_cache is None:
+        with _context_cache_lock:
+            if _context_cache is None:
+                _context_cache = ContextCache()
+    return _context_cache
@@ -0,0 +1,253 @@
+"""Background feedback delivery with a durable local spool.
+
+Submissions are appended to an append-only JSONL spool and acknowledged
+straight away; fsyncs are batched by a small background thread. A worker
+thread then sends spooled records to the feedback endpoint in batches over a
+pooled ``requests.Session``, with timeouts and jittered exponential backoff,
+and advances its saved offset past each record once it is accepted.
+Undelivered feedback therefore survives restarts and is retried until it
+goes through. A record the endpoint rejects outright (a 4xx other than 408
+or 429) is moved to ``dead.jsonl`` next to the spool instead, so it cannot
+hold up the records behind it.
+
+The endpoint comes from ``FEEDBACK_URL`` (defaulting to the Apps Script
+URL), so it can be pointed at a local stand-in server. It accepts one JSON
+object per POST unless ``FEEDBACK_BATCH_POST=1``, in which case each batch
+is sent as a single JSON array.
+"""
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from locks import FileLock
+from resilience import status_of
+
+DEFAULT_ENDPOINT = os.environ.get(
+    "FEEDBACK_URL",
+    "https://script.google.com/macros/s/AKfycbyNptReTdjxtgfVb_Bho_l4-tBpzxvMM0W6_5IhzRRBd9QMsB9sn5yyoPp19RLGcrfV/exec",
+)
+DEFAULT_SPOOL_DIR = os.environ.get("FEEDBACK_SPOOL_DIR", os.path.join(".cache", "feedback"))
+
+
+class FeedbackSpool:
+    def __init__(self, directory=DEFAULT_SPOOL_DIR, fsync_interval=0.2):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, "spool.jsonl")
+        self.offset_path = os.path.join(directory, "spool.offset")
+        self.dead_path = os.path.join(directory, "dead.jsonl")
+        self.lock_path = os.path.join(directory, "spool.lock")
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._file = open(self.path, "a", encoding="utf-8")
+        threading.Thread(target=self._fsync_loop, name="feedback-fsync", daemon=True).start()
+
+    def append(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock, FileLock(self.lock_path):
+            self._file.write(line)
+            self._file.flush()
+        self._dirty.set()
+
+    def _fsync_loop(self):
+        # Group the fsyncs of all appends made within one interval
+        while True:
+            self._dirty.wait()
+            time.sleep(self.fsync_interval)
+            self._dirty.clear()
+            with self._lock:
+                os.fsync(self._file.fileno())
+
+    def read_offset(self):
+        try:
+            with open(self.offset_path) as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def write_offset(self, offset):
+        tmp_path = self.offset_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.offset_path)
+
+    def read_batch(self, offset, max_records):
+        """Return ``(records, next_offset)`` for complete lines after ``offset``.
+
+        ``records`` holds ``(record, end_offset)`` pairs, the offset to save
+        once that record is delivered.
+        """
+        records = []
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            while len(records) < max_records:
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    break
+                offset += len(line)
+                try:
+                    records.append((json.loads(line), offset))
+                except ValueError:
+                    logging.error("Skipping corrupt feedback spool line")
+        return records, offset
+
+    def dead_letter(self, record, reason):
+        with self._lock, open(self.dead_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"record": record, "reason": reason, "failed_at": time.time()}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def compact(self, offset):
+        # Once everything is delivered, start the spool over instead of growing forever
+        with self._lock, FileLock(self.lock_path):
+            if os.path.getsize(self.path) != offset:
+                return offset
+            # Offset first: a crash in between then resends delivered records instead of skipping new ones
+            self.write_offset(0)
+            self._file.truncate(0)
+            return 0
+
+
+class FeedbackWorker:
+    def __init__(self, spool, endpoint=DEFAULT_ENDPOINT, batch_size=50, timeout=10.0,
+                 batch_post=None, max_backoff=300.0, poll_interval=1.0, session=None):
+        self.spool = spool
+        self.endpoint = endpoint
+        self.batch_size = batch_size
+        self.timeout = timeout
+        if batch_post is None:
+            batch_post = os.environ.get("FEEDBACK_BATCH_POST") == "1"
+        self.batch_post = batch_post
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+        self.session = session or self.new_session()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"sent": 0, "failed_attempts": 0, "dead_lettered": 0}
+
+    @staticmethod
+    def new_session():
+        # Imported here so pages that never send feedback do not pay for requests
+        import requests
+
+        return requests.Session()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="feedback-worker", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def notify(self):
+        self._wakeup.set()
+
+    def post(self, payload):
+        response = self.session.post(self.endpoint, json=payload, timeout=self.timeout)
+        response.raise_for_status()
+
+    @staticmethod
+    def is_permanent(exc):
+        # Retrying a rejected record cannot help; timeouts and rate limits can
+        status = status_of(exc)
+        return status is not None and 400 <= status < 500 and status not in (408, 429)
+
+    def send(self, records, next_offset):
+        """Deliver ``(record, end_offset)`` pairs, saving the offset as each one is done with."""
+        if self.batch_post and len(records) > 1:
+            try:
+                self.post([record for record, _ in records])
+            except Exception as e:
+                if not self.is_permanent(e):
+                    raise
+                # Find the rejected records by sending them one by one
+                logging.warning(f"Feedback batch rejected ({e}); sending its records separately")
+            else:
+                self.spool.write_offset(next_offset)
+                self.stats["sent"] += len(records)
+                return
+        for record, end_offset in records:
+            try:
+                self.post([record] if self.batch_post else record)
+                self.stats["sent"] += 1
+            except Exception as e:
+                if not self.is_permanent(e):
+                    raise
+                logging.error(f"Feedback record rejected ({e}); moved to {self.spool.dead_path}")
+                self.spool.dead_letter(record, str(e))
+                self.stats["dead_lettered"] += 1
+            self.spool.write_offset(end_offset)
+        if next_offset != records[-1][1]:
+            # Corrupt lines after the last record were skipped
+            self.spool.write_offset(next_offset)
+
+    def flush_once(self):
+        """Send one batch; return the number of records taken off the spool."""
+        offset = self.spool.read_offset()
+        records, next_offset = self.spool.read_batch(offset, self.batch_size)
+        if not records:
+            if next_offset > 0:
+                self.spool.compact(next_offset)
+            return 0
+        self.send(records, next_offset)
+        return len(records)
+
+    def _run(self):
+        from requests import RequestException
+
+        # Only one process on the host drains the spool
+        leader = FileLock(self.spool.path + ".worker")
+        while not self._stop.is_set() and not leader.acquire(blocking=False):
+            self._stop.wait(5)
+
+        attempt = 0
+        while not self._stop.is_set():
+            try:
+                sent = self.flush_once()
+                attempt = 0
+            except (RequestException, OSError) as e:
+                attempt += 1
+                self.stats["failed_attempts"] += 1
+                delay = min(self.max_backoff, 2 ** attempt) * random.uniform(0.5, 1.0)
+                logging.warning(f"Feedback delivery failed ({e}); retrying in {delay:.1f}s")
+                self._stop.wait(delay)
+                continue
+            if not sent:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+        leader.release()
+
+
+class FeedbackPipeline:
+    def __init__(self, spool=None, worker=None, endpoint=DEFAULT_ENDPOINT):
+        self.spool = spool or FeedbackSpool()
+        self.worker = worker or FeedbackWorker(self.spool, endpoint=endpoint)
+        self.worker.start()
+
+    def submit(self, record):
+        """Spool a submission and return immediately; delivery happens in the background."""
+        self.spool.append(dict(record, submitted_at=time.time()))
+        self.worker.notify()
+
+
+_pipeline = None
+_pipeline_lock = threading.Lock()
+
+
+def get_feedback_pipeline():
+    global _pipeline
+    if _pipeline is None:
+        with _pipeline_lock:
+            if _pipeline is None:
+                _pipeline = FeedbackPipeline()
+    return _pipeline
@@ -0,0 +1,114 @@
+"""Non-blocking Gemini client over the REST API.
+
+One pooled ``httpx.AsyncClient`` is shared by every request in the process,
+so connections to the API stay alive between calls instead of being
+re-established per refinement.
+"""
+import json
+import os
+
+import httpx
+
+API_ROOT = os.environ.get("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com")
+API_VERSION = "v1beta"
+
+
+class GeminiError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class GeminiRestClient:
+    def __init__(self, api_key, base_url=API_ROOT, timeout=120.0, max_connections=200):
+        self._client = httpx.AsyncClient(
+            base_url=base_url,
+            headers={"x-goog-api-key": api_key, "Content-Type": "application/json"},
+            timeout=httpx.Timeout(timeout, connect=10.0),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=120.0,
+            ),
+        )
+
+    @staticmethod
+    def build_payload(instruction, generation_config=None, system_instruction=None, cached_content=None):
+        payload = {"contents": [{"role": "user", "parts": [{"text": instruction}]}]}
+        if generation_config:
+            payload["generationConfig"] = generation_config
+        if cached_content:
+            payload["cachedContent"] = cached_content
+        elif system_instruction:
+            payload["systemInstruction"] = {"parts": [{"text": system_instruction}]}
+        return payload
+
+    @staticmethod
+    def extract_text(data):
+        candidates = data.get("candidates") or []
+        if not candidates:
+            reason = (data.get("promptFeedback") or {}).get("blockReason", "no candidates returned")
+            raise GeminiError(f"Gemini returned no text: {reason}")
+        parts = (candidates[0].get("content") or {}).get("parts") or []
+        return "".join(part.get("text", "") for part in parts)
+
+    @classmethod
+    def chunk_text(cls, data):
+        # Streamed chunks may carry only usage metadata and no candidates
+        if not data.get("candidates") and not (data.get("promptFeedback") or {}).get("blockReason"):
+            return ""
+        return cls.extract_text(data)
+
+    async def generate(self, model_id, instruction, generation_config=None, system_instruction=None,
+                       cached_content=None, timeout=None):
+        """Run ``generateContent`` and return the decoded JSON response."""
+        response = await self._client.post(
+            f"/{API_VERSION}/models/{model_id}:generateContent",
+            json=self.build_payload(instruction, generation_config, system_instruction, cached_content),
+            timeout=timeout or httpx.USE_CLIENT_DEFAULT,
+        )
+        if response.status_code != 200:
+            raise GeminiError(f"Gemini API error {response.status_code}: {response.text[:500]}",
+                              status_code=response.status_code)
+        return response.json()
+
+    async def stream_generate(self, model_id, instruction, generation_config=None, system_instruction=None,
+                              cached_content=None, timeout=None):
+        """Run ``streamGenerateContent`` over SSE, yielding each decoded chunk."""
+        async with self._client.stream(
+            "POST",
+            f"/{API_VERSION}/models/{model_id}:streamGenerateContent",
+            params={"alt": "sse"},
+            json=self.build_payload(instruction, generation_config, system_instruction, cached_content),
+            timeout=timeout or httpx.USE_CLIENT_DEFAULT,
+        ) as response:
+            if response.status_code != 200:
+                body = (await response.aread()).decode("utf-8", "replace")
+                raise GeminiError(f"Gemini API error {response.status_code}: {body[:500]}",
+                                  status_code=response.status_code)
+            async for line in response.aiter_lines():
+                if line.startswith("data:"):
+                    yield json.loads(line[len("data:"):])
+
+    async def create_cached_content(self, model_id, system_instruction, ttl):
+        """Upload a system instruction to the context cache; return its name."""
+        response = await self._client.post(
+            f"/{API_VERSION}/cachedContents",
+            json={
+                "model": f"models/{model_id}",
+                "systemInstruction": {"parts": [{"text": system_instruction}]},
+                "ttl": f"{int(ttl)}s",
+            },
+        )
+        if response.status_code != 200:
+            raise GeminiError(f"Gemini API error {response.status_code}: {response.text[:500]}",
+                              status_code=response.status_code)
+        return response.json()["name"]
+
+    async def get_model(self, model_id):
+        response = await self._client.get(f"/{API_VERSION}/models/{model_id}")
+        response.raise_for_status()
+        return response.json()
+
+    async def aclose(self):
+        await self._client.aclose()
@@ -0,0 +1,280 @@
+"""Hedged model calls for tail latency.
+
+Every call runs under a total deadline. If the first attempt has produced
+nothing by a latency percentile learned from recent calls of the same kind,
+a duplicate attempt is started and whichever finishes first wins; for
+streams the race is to the first chunk. Async losers are cancelled. Sync
+losers cannot be interrupted mid-request, so they are abandoned and their
+result is discarded when it arrives. An abandoned attempt keeps calling the
+model after the caller has released its scheduler slot, so no new hedge is
+started while ``max_abandoned`` of them are still running; they end by the
+deadline they were given at the latest.
+
+The deadline may be a ``resilience.Deadline`` shared with the scheduler
+slot, so that queueing and calling together stay within one budget.
+
+Hedges are capped at a fraction of all calls so the extra spend stays
+bounded, and ``stats`` reports the hedge rate and the latency the winning
+hedges saved (measured for sync calls, estimated for cancelled async ones).
+
+Tunables (environment)::
+
+    GEMINI_HEDGE                set to 0 to disable hedging
+    GEMINI_HEDGE_PERCENTILE     percentile of recent latency that triggers a hedge (95)
+    GEMINI_HEDGE_MIN_SAMPLES    calls observed before hedging starts (20)
+    GEMINI_HEDGE_MAX_FRACTION   largest share of calls that may be hedged (0.1)
+    GEMINI_HEDGE_MAX_ABANDONED  abandoned sync attempts that may still be running (8)
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from resilience import Deadline, DeadlineExceeded
+
+DEFAULT_PERCENTILE = float(os.environ.get("GEMINI_HEDGE_PERCENTILE", "95"))
+DEFAULT_MIN_SAMPLES = int(os.environ.get("GEMINI_HEDGE_MIN_SAMPLES", "20"))
+DEFAULT_MAX_FRACTION = float(os.environ.get("GEMINI_HEDGE_MAX_FRACTION", "0.1"))
+DEFAULT_MAX_ABANDONED = int(os.environ.get("GEMINI_HEDGE_MAX_ABANDONED", "8"))
+
+
+def as_deadline(deadline):
+    """Return ``deadline`` as a ``Deadline``, starting one if it is a number of seconds."""
+    return deadline if isinstance(deadline, Deadline) else Deadline(deadline)
+
+
+class LatencyTracker:
+    """Recent latencies per kind of call, in a fixed-size window."""
+
+    def __init__(self, window=200):
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def observe(self, key, seconds):
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def _sorted(self, key):
+        with self._lock:
+            return sorted(self._samples.get(key, ()))
+
+    def percentile(self, key, q, min_samples=1):
+        samples = self._sorted(key)
+        if len(samples) < max(1, min_samples):
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * q / 100))]
+
+    def tail_mean(self, key, above):
+        """Mean of the recent latencies longer than ``above``, or ``None``."""
+        tail = [sample for sample in self._sorted(key) if sample > above]
+        return sum(tail) / len(tail) if tail else None
+
+
+class Hedger:
+    def __init__(self, percentile=DEFAULT_PERCENTILE, min_samples=DEFAULT_MIN_SAMPLES,
+                 max_fraction=DEFAULT_MAX_FRACTION, enabled=None, tracker=None, max_workers=64,
+                 max_abandoned=DEFAULT_MAX_ABANDONED):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.max_fraction = max_fraction
+        self.max_abandoned = max_abandoned
+        if enabled is None:
+            enabled = os.environ.get("GEMINI_HEDGE", "1") != "0"
+        self.enabled = enabled
+        self.tracker = tracker or LatencyTracker()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedge")
+        self._lock = threading.Lock()
+        # "abandoned" counts the sync attempts still running after losing
+        self.stats = {"calls": 0, "hedged": 0, "hedge_wins": 0, "saved_seconds": 0.0, "abandoned": 0}
+
+    def hedge_delay(self, key, sync=False):
+        """Seconds to wait for the first attempt before hedging, or ``None`` not to hedge."""
+        if not self.enabled or self.stats["hedged"] >= self.max_fraction * self.stats["calls"]:
+            return None
+        if sync and self.stats["abandoned"] >= self.max_abandoned:
+            return None
+        return self.tracker.percentile(key, self.percentile, self.min_samples)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.stats[name] += amount
+
+    def _won(self, key, won_at, hedge_offset):
+        self._count("hedge_wins")
+        self.tracker.observe(key, won_at - hedge_offset)
+
+    def _abandon(self, future, discard):
+        if future.cancel():
+            return
+        self._count("abandoned")
+
+        def finished(f):
+            self._count("abandoned", -1)
+            if discard and f.exception() is None:
+                discard(f.result())
+
+        future.add_done_callback(finished)
+
+    def _race(self, key, fn, deadline, discard=None):
+        """Return the first successful ``fn(remaining_seconds)``, hedging a slow first attempt.
+
+        ``discard`` is called with the result of a losing attempt that
+        completes anyway, so it can be released.
+        """
+        deadline = as_deadline(deadline)
+        started = time.monotonic()
+        self._count("calls")
+        delay = self.hedge_delay(key, sync=True)
+        if delay is None:
+            result = fn(deadline.check())
+            self.tracker.observe(key, time.monotonic() - started)
+            return result
+
+        primary = self.executor.submit(fn, deadline.check())
+        if wait([primary], timeout=min(delay, deadline.check())).done:
+            self.tracker.observe(key, time.monotonic() - started)
+            return primary.result()
+
+        self._count("hedged")
+        hedge_offset = time.monotonic() - started
+        hedge = self.executor.submit(fn, deadline.check())
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, deadline.remaining()), return_when=FIRST_COMPLETED)
+            if not done:
+                for future in pending:
+                    self._abandon(future, discard)
+                raise DeadlineExceeded("Model call deadline exceeded")
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                won_at = time.monotonic() - started
+                if future is hedge:
+                    self._won(key, won_at, hedge_offset)
+                    # The primary keeps running; what the hedge saved is known once it ends
+                    primary.add_done_callback(lambda f: self._count(
+                        "saved_seconds", max(0.0, time.monotonic() - started - won_at)))
+                else:
+                    self.tracker.observe(key, won_at)
+                for other in pending | (done - {future}):
+                    self._abandon(other, discard)
+                return future.result()
+        raise error
+
+    def call(self, key, fn, deadline):
+        """Return ``fn(remaining_seconds)``, hedged once it runs slower than usual."""
+        return self._race(key, fn, deadline)
+
+    def stream(self, key, open_stream, deadline):
+        """Yield from ``open_stream(remaining_seconds)``, hedging on the time to the first chunk."""
+        def start(remaining):
+            chunks = iter(open_stream(remaining))
+            return chunks, next(chunks, None)
+
+        chunks, first = self._race(key, start, deadline, discard=lambda result: result[0].close())
+        if first is not None:
+            yield first
+            yield from chunks
+
+    async def _arace(self, key, fn, deadline, discard=None):
+        """Async ``_race``; ``fn`` returns an awaitable and ``discard`` is a coroutine function."""
+        deadline = as_deadline(deadline)
+        started = time.monotonic()
+        self._count("calls")
+        delay = self.hedge_delay(key)
+        if delay is None:
+            try:
+                result = await asyncio.wait_for(fn(deadline.check()), timeout=deadline.check())
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded("Model call deadline exceeded")
+            self.tracker.observe(key, time.monotonic() - started)
+            return result
+
+        primary = asyncio.ensure_future(fn(deadline.check()))
+        tasks = [primary]
+        winner = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=min(delay, deadline.check()))
+            if done:
+                winner = primary
+                self.tracker.observe(key, time.monotonic() - started)
+                return primary.result()
+
+            self._count("hedged")
+            hedge_offset = time.monotonic() - started
+            hedge = asyncio.ensure_future(fn(deadline.check()))
+            tasks.append(hedge)
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=max(0.0, deadline.remaining()),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise DeadlineExceeded("Model call deadline exceeded")
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    winner = task
+                    won_at = time.monotonic() - started
+                    if task is hedge:
+                        self._won(key, won_at, hedge_offset)
+                        # The primary is cancelled, so estimate its finish from the slow tail,
+                        # or as at least one more typical call when no slow calls are on record
+                        finish = self.tracker.tail_mean(key, won_at) or won_at + self.tracker.percentile(key, 50)
+                        self._count("saved_seconds", max(0.0, finish - won_at))
+                    else:
+                        self.tracker.observe(key, won_at)
+                    return task.result()
+            raise error
+        finally:
+            for task in tasks:
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                elif discard and not task.cancelled() and task.exception() is None:
+                    await discard(task.result())
+
+    async def acall(self, key, fn, deadline):
+        """Async ``call``; ``fn(remaining_seconds)`` returns an awaitable."""
+        return await self._arace(key, fn, deadline)
+
+    async def astream(self, key, open_stream, deadline):
+        """Async ``stream``; ``open_stream(remaining_seconds)`` returns an async iterator."""
+        async def start(remaining):
+            chunks = open_stream(remaining).__aiter__()
+            try:
+                return chunks, await chunks.__anext__()
+            except StopAsyncIteration:
+                return chunks, None
+
+        async def discard(result):
+            await result[0].aclose()
+
+        chunks, first = await self._arace(key, start, deadline, discard=discard)
+        if first is not None:
+            yield first
+            async for chunk in chunks:
+                yield chunk
+
+
+_hedger = None
+_hedger_lock = threading.Lock()
+
+
+def get_hedger():
+    global _hedger
+    if _hedger is None:
+        with _hedger_lock:
+            if _hedger is None:
+                _hedger = Hedger()
+    return _hedger
@@ -0,0 +1,249 @@
+"""Persistent history of refinements and evaluations.
+
+Every generation is saved to a local SQLite database (WAL mode) with its
+input, output, model, word limit, tags, latency and token counts. Saving is
+asynchronous: ``record`` only enqueues the entry, and a writer thread
+commits queued entries in batches, so the generate path never waits on disk.
+
+Entries have an owner. The Streamlit apps run for one person, so they save
+and search as ``HISTORY_OWNER`` ("local"), which stays the same across
+reloads, tabs and restarts; server.py saves each entry under the client that
+made it. Entries saved before owners existed are adopted by the local owner.
+
+Prompts and outputs are indexed with FTS5 for full-text search and tags
+have their own ``(tag, entry_id)`` index. Pages are fetched with keyset
+pagination on the entry id, so every page is an index range scan no
+matter how deep it is or how many rows the table holds.
+
+The database lives at ``HISTORY_DB_PATH`` (``.cache/history.sqlite3``).
+"""
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+DEFAULT_HISTORY_PATH = os.environ.get("HISTORY_DB_PATH", os.path.join(".cache", "history.sqlite3"))
+# Owner of the entries saved and searched by the single-user Streamlit apps
+LOCAL_OWNER = os.environ.get("HISTORY_OWNER", "local")
+PAGE_SIZE = 20
+# Tags with fewer entries than this drive the scan ahead of the text index
+SELECTIVE_TAG_ROWS = 2000
+
+HistoryEntry = namedtuple("HistoryEntry", [
+    "id", "created", "kind", "prompt", "output", "model_id", "target_model", "word_limit", "tags",
+    "latency", "prompt_tokens", "completion_tokens",
+])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY,
+    created REAL NOT NULL,
+    kind TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    output TEXT NOT NULL,
+    model_id TEXT,
+    target_model TEXT,
+    word_limit TEXT,
+    tags TEXT,
+    latency REAL,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    owner TEXT
+);
+CREATE INDEX IF NOT EXISTS history_kind ON history (kind, id);
+CREATE TABLE IF NOT EXISTS history_tags (
+    tag TEXT NOT NULL,
+    entry_id INTEGER NOT NULL,
+    PRIMARY KEY (tag, entry_id)
+) WITHOUT ROWID;
+"""
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(
+    prompt, output, content='history', content_rowid='id'
+);
+"""
+
+
+def fts_query(text):
+    """Turn free text into an FTS5 query in which every word must match."""
+    return " ".join('"' + word.replace('"', '""') + '"' for word in text.split())
+
+
+def normalize_tags(tags):
+    return sorted({tag.strip().lower() for tag in tags if tag.strip()})
+
+
+class HistoryStore:
+    def __init__(self, path=DEFAULT_HISTORY_PATH, batch_size=500, flush_interval=0.5):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._local = threading.local()
+        self._queue = queue.Queue()
+        self.stats = {"written": 0, "failed": 0}
+
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        # Databases created before entries had owners
+        if "owner" not in {row[1] for row in conn.execute("PRAGMA table_info(history)")}:
+            conn.execute("ALTER TABLE history ADD COLUMN owner TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS history_owner ON history (owner, id)")
+        # Entries saved before owners existed were only ever shown by the local apps
+        conn.execute("UPDATE history SET owner = ? WHERE owner IS NULL", (LOCAL_OWNER,))
+        try:
+            conn.executescript(FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError as e:
+            # SQLite built without FTS5: fall back to LIKE scans
+            logging.warning(f"Full-text search unavailable, history search will be slow: {e}")
+            self.fts = False
+        conn.commit()
+
+        threading.Thread(target=self._write_loop, name="history-writer", daemon=True).start()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def record(self, kind, prompt, output, model_id=None, target_model=None, word_limit=None, tags=(),
+               latency=None, prompt_tokens=None, completion_tokens=None, owner=None):
+        """Queue an entry for saving and return immediately."""
+        self._queue.put((time.time(), kind, prompt, output, model_id, target_model, word_limit,
+                         normalize_tags(tags), latency, prompt_tokens, completion_tokens, owner))
+
+    def _write_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            # Gather whatever else arrives shortly after, up to one batch
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+                self.stats["written"] += len(batch)
+            except Exception as e:
+                # Keep draining: a dead writer would leave flush() waiting forever
+                logging.error(f"Failed to save {len(batch)} history entries: {e}")
+                self.stats["failed"] += len(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    def _write(self, batch):
+        conn = self._connect()
+        with conn:
+            for created, kind, prompt, output, model_id, target_model, word_limit, tags, latency, \
+                    prompt_tokens, completion_tokens, owner in batch:
+                cursor = conn.execute(
+                    "INSERT INTO history (created, kind, prompt, output, model_id, target_model, word_limit, "
+                    "tags, latency, prompt_tokens, completion_tokens, owner) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (created, kind, prompt, output, model_id, target_model, word_limit, json.dumps(tags),
+                     latency, prompt_tokens, completion_tokens, owner),
+                )
+                entry_id = cursor.lastrowid
+                conn.executemany("INSERT INTO history_tags (tag, entry_id) VALUES (?, ?)",
+                                 [(tag, entry_id) for tag in tags])
+                if self.fts:
+                    conn.execute("INSERT INTO history_fts (rowid, prompt, output) VALUES (?, ?, ?)",
+                                 (entry_id, prompt, output))
+
+    def flush(self):
+        """Block until every queued entry has been written."""
+        self._queue.join()
+
+    def _tag_rows(self, tag):
+        # Bounded count: only whether a tag is rare matters, not its exact size
+        return self._connect().execute(
+            "SELECT count(*) FROM (SELECT 1 FROM history_tags WHERE tag = ? LIMIT ?)", (tag, SELECTIVE_TAG_ROWS)
+        ).fetchone()[0]
+
+    def search(self, text="", tags=(), kind=None, before_id=None, limit=PAGE_SIZE, owner=None):
+        """Return up to ``limit`` entries, newest first, older than ``before_id``.
+
+        ``text`` must match the prompt or output, and every tag in ``tags``
+        must be present. Pass the id of the last entry of a page as
+        ``before_id`` to get the next page. Only ``owner``'s entries are
+        returned; ``None`` searches all of them, for maintenance scripts.
+        """
+        query = fts_query(text)
+        tags = normalize_tags(tags)
+        conditions = []
+        params = []
+
+        # Drive the scan from the most selective index available: the rarest
+        # tag if it is rare enough, otherwise the text index
+        rows = {tag: self._tag_rows(tag) for tag in tags}
+        tags.sort(key=rows.get)
+        if tags and (not query or rows[tags[0]] < SELECTIVE_TAG_ROWS):
+            source = "history_tags t0 JOIN history h ON h.id = t0.entry_id"
+            order = "t0.entry_id"
+            conditions.append("t0.tag = ?")
+            params.append(tags.pop(0))
+        elif query and self.fts:
+            source = "history_fts JOIN history h ON h.id = history_fts.rowid"
+            order = "history_fts.rowid"
+        else:
+            source = "history h"
+            order = "h.id"
+
+        if query and self.fts:
+            if source.startswith("history_fts"):
+                conditions.append("history_fts MATCH ?")
+            else:
+                conditions.append("EXISTS (SELECT 1 FROM history_fts WHERE history_fts MATCH ? "
+                                  "AND history_fts.rowid = h.id)")
+            params.append(query)
+        elif query:
+            conditions.append("(h.prompt LIKE ? OR h.output LIKE ?)")
+            params += [f"%{text.strip()}%"] * 2
+
+        for tag in tags:
+            conditions.append("EXISTS (SELECT 1 FROM history_tags t WHERE t.tag = ? AND t.entry_id = h.id)")
+            params.append(tag)
+        if kind:
+            conditions.append("h.kind = ?")
+            params.append(kind)
+        if owner is not None:
+            conditions.append("h.owner = ?")
+            params.append(owner)
+        if before_id is not None:
+            conditions.append(f"{order} < ?")
+            params.append(before_id)
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self._connect().execute(
+            f"SELECT h.id, h.created, h.kind, h.prompt, h.output, h.model_id, h.target_model, h.word_limit, "
+            f"h.tags, h.latency, h.prompt_tokens, h.completion_tokens FROM {source} {where} "
+            f"ORDER BY {order} DESC LIMIT ?",
+            params + [limit],
+        ).fetchall()
+        return [HistoryEntry(*row[:8], json.loads(row[8] or "[]"), *row[9:]) for row in rows]
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_history():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = HistoryStore()
+    return _store
@@ -0,0 +1,178 @@
+"""Map-reduce refinement for inputs too large for one instruction.
+
+Inputs over ``LARGE_INPUT_TOKENS`` are split into chunks along paragraph
+boundaries, starting a new chunk at headings where possible, so each chunk
+is a coherent section. The chunks are condensed into notes concurrently,
+with at most ``LARGE_INPUT_CONCURRENCY`` calls in flight, and the notes are
+merged by one final refinement that enforces the selected word limit. When
+the notes themselves outgrow a chunk they are condensed again first, so the
+final instruction stays bounded however long the document is.
+
+Chunks are produced lazily and each condense call is cached on its own, so
+regenerating a document after editing one section only calls the model for
+the sections that changed.
+
+Tunables (environment)::
+
+    LARGE_INPUT_TOKENS        estimated input tokens above which map-reduce is used (8000)
+    LARGE_INPUT_CHUNK_TOKENS  estimated tokens per chunk (3000)
+    LARGE_INPUT_CONCURRENCY   condense calls in flight (4)
+"""
+import os
+import re
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import make_cache_key
+from clients import route_model
+from llm import generate
+from prompts import build_condense_instruction, clean_output
+from resilience import estimate_tokens
+
+LARGE_INPUT_TOKENS = int(os.environ.get("LARGE_INPUT_TOKENS", "8000"))
+CHUNK_TOKENS = int(os.environ.get("LARGE_INPUT_CHUNK_TOKENS", "3000"))
+CONCURRENCY = int(os.environ.get("LARGE_INPUT_CONCURRENCY", "4"))
+
+# Blank lines separate paragraphs; headings, numbered sections and rules start a new section
+PARAGRAPH_BREAK = re.compile(r"\n[ \t]*\n\s*")
+SECTION_START = re.compile(r"(#{1,6}\s|\d+(\.\d+)*[.)]?\s+[A-Z]|[A-Z][A-Z0-9 ,:&/-]{3,}$|(-{3,}|\*{3,}|_{3,})$)")
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+# Notes of the condensed chunks, in document order, with the tokens spent on them
+Condensed = namedtuple("Condensed", ["notes", "chunks", "prompt_tokens", "completion_tokens"])
+
+
+def count_tokens(text):
+    # Same estimate the call guard budgets with, so it costs no API call
+    return estimate_tokens(text, expected_output=0)
+
+
+def is_large(text, threshold=None):
+    return count_tokens(text) > (threshold or LARGE_INPUT_TOKENS)
+
+
+def paragraphs(text):
+    """Yield the paragraphs of ``text`` without copying the rest of it."""
+    start = 0
+    for match in PARAGRAPH_BREAK.finditer(text):
+        paragraph = text[start:match.start()].strip()
+        if paragraph:
+            yield paragraph
+        start = match.end()
+    paragraph = text[start:].strip()
+    if paragraph:
+        yield paragraph
+
+
+def split_oversized(paragraph, max_tokens):
+    """Split one paragraph longer than a chunk at sentence ends, or at words as a last resort."""
+    pieces, current = [], ""
+    for sentence in SENTENCE_END.split(paragraph):
+        while count_tokens(sentence) > max_tokens:
+            # A single run-on sentence; cut it at the last space that fits
+            cut = sentence.rfind(" ", 0, max_tokens * 4)
+            cut = cut if cut > 0 else max_tokens * 4
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(sentence[:cut])
+            sentence = sentence[cut:].lstrip()
+        # Estimate the joined text: rounded per-sentence estimates can add up to less
+        joined = f"{current} {sentence}" if current else sentence
+        if current and count_tokens(joined) > max_tokens:
+            pieces.append(current)
+            joined = sentence
+        current = joined
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def iter_chunks(text, max_tokens=None):
+    """Yield chunks of at most ``max_tokens`` estimated tokens, split along section boundaries.
+
+    A chunk that is at least half full is closed before a heading, so
+    sections stay together whenever they fit.
+    """
+    max_tokens = max_tokens or CHUNK_TOKENS
+    current, size = [], 0
+    for paragraph in paragraphs(text):
+        tokens = count_tokens(paragraph)
+        starts_section = bool(SECTION_START.match(paragraph))
+        if current and (size + tokens > max_tokens or (starts_section and size >= max_tokens // 2)):
+            yield "\n\n".join(current)
+            current, size = [], 0
+        if tokens > max_tokens:
+            pieces = split_oversized(paragraph, max_tokens)
+            yield from pieces[:-1]
+            paragraph, tokens = pieces[-1], count_tokens(pieces[-1])
+        current.append(paragraph)
+        size += tokens
+    if current:
+        yield "\n\n".join(current)
+
+
+def map_bounded(fn, items, concurrency, on_result=None):
+    """Return ``[fn(item) for item in items]`` with at most ``concurrency`` calls in flight.
+
+    ``items`` is consumed lazily, so only the chunks being worked on and the
+    results are held at once. ``on_result(count)`` runs after each result.
+    """
+    results = []
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="condense") as executor:
+        window = deque()
+        for item in items:
+            if len(window) >= concurrency:
+                results.append(window.popleft().result())
+                if on_result:
+                    on_result(len(results))
+            window.append(executor.submit(fn, item))
+        while window:
+            results.append(window.popleft().result())
+            if on_result:
+                on_result(len(results))
+    return results
+
+
+def condense(text, tags=(), bypass_cache=False, chunk_tokens=None, concurrency=None, on_progress=None,
+             priority="interactive", user=None):
+    """Condense a large input into notes small enough for one merge instruction.
+
+    ``on_progress(done, expected)`` reports finished condense calls against
+    the expected number of chunks. ``priority`` and ``user`` are passed on
+    to the scheduler, so the sections of one document queue as one user's calls.
+    """
+    chunk_tokens = chunk_tokens or CHUNK_TOKENS
+    concurrency = concurrency or CONCURRENCY
+    model_id = route_model("condense")
+
+    def condense_one(item):
+        position, chunk = item
+        instruction = build_condense_instruction(chunk, position, tags)
+        # The position is left out of the key so unchanged sections hit the cache after an edit elsewhere
+        cache_key = make_cache_key("condense", chunk, model_id, tags=tags)
+        generation = generate(instruction, cache_key=cache_key, bypass_cache=bypass_cache, model_id=model_id,
+                              latency_class="condense", priority=priority, user=user)
+        return generation._replace(text=clean_output(generation.text))
+
+    def run(chunks, expected, label):
+        progress = (lambda done: on_progress(done, expected)) if on_progress else None
+        return map_bounded(condense_one, ((f"{label} {i}", chunk) for i, chunk in enumerate(chunks, start=1)),
+                           concurrency, progress)
+
+    expected = max(1, -(-count_tokens(text) // chunk_tokens))
+    generations = run(iter_chunks(text, chunk_tokens), expected, "part")
+    chunks = len(generations)
+    prompt_tokens = completion_tokens = 0
+    while True:
+        prompt_tokens += sum(generation.prompt_tokens or 0 for generation in generations)
+        completion_tokens += sum(generation.completion_tokens or 0 for generation in generations)
+        notes = [generation.text for generation in generations]
+        # Condense the notes again until they fit one chunk, e.g. for book-length inputs
+        if len(notes) == 1 or count_tokens("\n\n".join(notes)) <= chunk_tokens:
+            break
+        merged = list(iter_chunks("\n\n".join(notes), chunk_tokens))
+        if len(merged) >= len(notes):
+            break
+        generations = run(merged, len(merged), "notes")
+    return Condensed("\n\n".join(notes), chunks, prompt_tokens, completion_tokens)
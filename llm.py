@@ -0,0 +1,386 @@
+"""Shared Gemini call path used by main.py, try.py, server.py and batch.py.
+
+Instructions are either plain strings or ``prompts.Instruction`` objects;
+for the latter the constant preamble travels as a system instruction, via
+the provider's context cache when it is large enough to qualify. Cache
+misses are coalesced by ``singleflight`` so identical concurrent requests
+make one upstream call. That call waits for a ``scheduler`` slot by its
+``priority`` and ``user``, and is hedged by ``hedging`` when it runs slower
+than recent calls of the same ``latency_class``. A ``budget`` caps the
+output tokens and ends the response at a sentence boundary past the word
+limit, streamed or not. Every call records its cache outcome, upstream
+latency, token usage and error class in ``metrics``.
+"""
+import asyncio
+import contextlib
+import logging
+import time
+from collections import namedtuple
+
+from budget import WordLimiter, record_length, trim
+from cache import get_cache
+from clients import DEFAULT_MODEL_ID, get_registry
+from context_cache import get_context_cache
+from hedging import get_hedger
+from metrics import get_metrics
+from prompts import Instruction
+from resilience import Deadline, estimate_tokens, get_call_guard
+from scheduler import get_scheduler
+from singleflight import get_single_flight
+
+# Text plus token usage of one model call; cache hits report zero tokens
+Generation = namedtuple("Generation", ["text", "prompt_tokens", "completion_tokens", "cached"])
+
+
+def split_instruction(instruction, cache_key):
+    """Return ``(content, system_instruction, cache_key)`` for a call.
+
+    The template version is folded into the cache key so editing a template
+    never serves responses produced by the previous wording.
+    """
+    if isinstance(instruction, Instruction):
+        if cache_key:
+            cache_key = f"{cache_key}:{instruction.version}"
+        return instruction.content, instruction.system, cache_key
+    return instruction, None, cache_key
+
+
+def model_for(model_id, system_instruction):
+    registry = get_registry()
+    if not system_instruction:
+        return registry.model(model_id)
+    cached_content = get_context_cache().get(model_id, system_instruction)
+    if cached_content:
+        return registry.model(model_id, cached_content=cached_content)
+    return registry.model(model_id, system_instruction=system_instruction)
+
+
+async def apreamble(client, model_id, system_instruction):
+    """Keyword arguments carrying the preamble for a ``GeminiRestClient`` call."""
+    if not system_instruction:
+        return {}
+    cached_content = await get_context_cache().aget(model_id, system_instruction, client.create_cached_content)
+    if cached_content:
+        return {"cached_content": cached_content}
+    return {"system_instruction": system_instruction}
+
+
+def latency_key(model_id, latency_class, kind):
+    return f"{model_id}/{latency_class or 'default'}/{kind}"
+
+
+def record_request(kind, outcome):
+    get_metrics().inc("prompt_requests_total", kind=kind, outcome=outcome)
+
+
+def record_usage(model_id, prompt_tokens, completion_tokens):
+    metrics = get_metrics()
+    metrics.inc("prompt_tokens_total", prompt_tokens or 0, model=model_id, type="prompt")
+    metrics.inc("prompt_tokens_total", completion_tokens or 0, model=model_id, type="completion")
+
+
+@contextlib.contextmanager
+def upstream_timer(model_id, kind):
+    """Time a model call and count its error class if it fails."""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        get_metrics().inc("prompt_upstream_errors_total", model=model_id, error=type(e).__name__)
+        raise
+    finally:
+        get_metrics().observe("prompt_upstream_seconds", time.perf_counter() - started, model=model_id, kind=kind)
+
+
+def record_first_chunk(model_id, started):
+    get_metrics().observe("prompt_first_chunk_seconds", time.perf_counter() - started, model=model_id)
+
+
+def budgeted_config(generation_config, budget):
+    return budget.generation_config(generation_config) if budget else generation_config
+
+
+def cached_text(cache_key, budget=None):
+    cached = get_cache().get(cache_key)
+    # Entries stored before the budget applied may run long
+    return trim(cached, budget)[0] if cached is not None else None
+
+
+def cached_generation(cache_key, budget=None):
+    cached = cached_text(cache_key, budget)
+    if cached is None:
+        return None
+    logging.info("Serving response from cache")
+    return Generation(cached, 0, 0, True)
+
+
+def shared_generation(generation, fresh):
+    # Callers that joined another caller's request spent no tokens of their own
+    return generation if fresh else generation._replace(prompt_tokens=0, completion_tokens=0, cached=True)
+
+
+def generate(instruction, cache_key=None, bypass_cache=False, model_id=DEFAULT_MODEL_ID, generation_config=None,
+             latency_class=None, priority="interactive", user=None, budget=None):
+    """Return a ``Generation`` for an instruction, consulting the response cache.
+
+    Passing ``bypass_cache=True`` skips the lookup but still stores the fresh
+    response, so a forced regeneration refreshes the cached entry. Concurrent
+    identical requests, in this process or another on the host, share one
+    model call. ``priority`` and ``user`` place the call in the scheduler's queues,
+    and a ``budget.LengthBudget`` bounds the length of the response.
+    """
+    content, system_instruction, cache_key = split_instruction(instruction, cache_key)
+    generation_config = budgeted_config(generation_config, budget)
+    if cache_key and not bypass_cache:
+        cached = cached_generation(cache_key, budget)
+        if cached is not None:
+            record_request("call", "hit")
+            return cached
+
+    def call():
+        # Call Gemini AI through the shared rate limiter, retry policy and circuit breaker,
+        # with a hedged duplicate if it runs slower than usual
+        model_api = model_for(model_id, system_instruction)
+        guard = get_call_guard()
+        # Queueing for a slot and the hedged call share one deadline
+        deadline = Deadline(guard.deadline)
+        with get_scheduler().slot(priority, user, deadline.check()), upstream_timer(model_id, "call"):
+            response = get_hedger().call(
+                latency_key(model_id, latency_class, "call"),
+                lambda remaining: guard.call(
+                    lambda timeout: model_api.generate_content(content, generation_config=generation_config,
+                                                               request_options={"timeout": timeout}),
+                    estimate_tokens(content + (system_instruction or "")),
+                    deadline=remaining,
+                ),
+                deadline,
+            )
+        text = response.text
+        usage = response.usage_metadata
+        record_usage(model_id, usage.prompt_token_count, usage.candidates_token_count)
+        if budget:
+            text, stopped = trim(text, budget)
+            record_length(budget, text, stopped)
+
+        if cache_key:
+            get_cache().set(cache_key, text)
+        return Generation(text, usage.prompt_token_count, usage.candidates_token_count, False)
+
+    if not cache_key or bypass_cache:
+        record_request("call", "bypass" if cache_key else "uncached")
+        return call()
+    generation, fresh = get_single_flight().do(f"call:{cache_key}", call,
+                                               lambda: cached_generation(cache_key, budget))
+    record_request("call", "miss" if fresh else "shared")
+    return shared_generation(generation, fresh)
+
+
+def generate_text(instruction, cache_key=None, bypass_cache=False, model_id=DEFAULT_MODEL_ID, generation_config=None,
+                  latency_class=None, priority="interactive", user=None, budget=None):
+    return generate(instruction, cache_key, bypass_cache, model_id, generation_config, latency_class, priority,
+                    user, budget).text
+
+
+def stream_text(instruction, cache_key=None, bypass_cache=False, model_id=DEFAULT_MODEL_ID, latency_class=None,
+                priority="interactive", user=None, budget=None, on_cached=None):
+    """Yield the response text chunk by chunk as Gemini generates it.
+
+    A cache hit is yielded as a single chunk, as is the result of an
+    identical stream already in flight; ``on_cached()`` is called for both,
+    since no model call was made for this caller. The full text is only
+    cached once the stream completes, so an abandoned stream never stores a
+    truncated response; a stream the ``budget`` stops early counts as complete.
+    """
+    content, system_instruction, cache_key = split_instruction(instruction, cache_key)
+    generation_config = budgeted_config(None, budget)
+    cache = get_cache()
+    if cache_key and not bypass_cache:
+        cached = cached_text(cache_key, budget)
+        if cached is not None:
+            logging.info("Serving response from cache")
+            record_request("stream", "hit")
+            if on_cached:
+                on_cached()
+            yield cached
+            return
+    fresh = False
+
+    def chunks():
+        nonlocal fresh
+        fresh = True
+        model_api = model_for(model_id, system_instruction)
+        guard = get_call_guard()
+        # Queueing for a slot and the hedged call share one deadline
+        deadline = Deadline(guard.deadline)
+        stream = get_hedger().stream(
+            latency_key(model_id, latency_class, "stream"),
+            lambda remaining: guard.stream(
+                lambda timeout: model_api.generate_content(content, stream=True, generation_config=generation_config,
+                                                           request_options={"timeout": timeout}),
+                estimate_tokens(content + (system_instruction or "")),
+                deadline=remaining,
+            ),
+            deadline,
+        )
+        parts = []
+        usage = None
+        limiter = WordLimiter(budget) if budget else None
+        # The slot is held until the last chunk, since the upstream call runs that long
+        with get_scheduler().slot(priority, user, deadline.check()), upstream_timer(model_id, "stream"):
+            started = time.perf_counter()
+            for chunk in stream:
+                if not parts:
+                    record_first_chunk(model_id, started)
+                # The final chunk carries the usage of the whole response
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                text = limiter.feed(chunk.text) if limiter else chunk.text
+                parts.append(text)
+                yield text
+                if limiter and limiter.stopped:
+                    # Closing the stream ends the upstream request; usage so far is in the last chunk read
+                    stream.close()
+                    break
+        if usage is not None:
+            record_usage(model_id, usage.prompt_token_count, usage.candidates_token_count)
+        if limiter:
+            record_length(budget, limiter.text, limiter.stopped)
+
+        if cache_key:
+            cache.set(cache_key, "".join(parts))
+
+    if not cache_key or bypass_cache:
+        record_request("stream", "bypass" if cache_key else "uncached")
+        yield from chunks()
+    else:
+        yield from get_single_flight().stream(f"stream:{cache_key}", chunks, lambda: cached_text(cache_key, budget))
+        record_request("stream", "miss" if fresh else "shared")
+        if not fresh and on_cached:
+            on_cached()
+
+
+async def acached_generation(cache_key, budget=None):
+    return await asyncio.to_thread(cached_generation, cache_key, budget)
+
+
+async def agenerate(client, instruction, cache_key=None, bypass_cache=False, model_id=DEFAULT_MODEL_ID,
+                    generation_config=None, latency_class=None, priority="interactive", user=None, budget=None):
+    """Async counterpart of ``generate`` using a shared ``GeminiRestClient``."""
+    content, system_instruction, cache_key = split_instruction(instruction, cache_key)
+    generation_config = budgeted_config(generation_config, budget)
+    if cache_key and not bypass_cache:
+        cached = await acached_generation(cache_key, budget)
+        if cached is not None:
+            record_request("call", "hit")
+            return cached
+
+    async def call():
+        preamble = await apreamble(client, model_id, system_instruction)
+        guard = get_call_guard()
+        # Queueing for a slot and the hedged call share one deadline
+        deadline = Deadline(guard.deadline)
+        async with get_scheduler().aslot(priority, user, deadline.check()):
+            with upstream_timer(model_id, "call"):
+                data = await get_hedger().acall(
+                    latency_key(model_id, latency_class, "call"),
+                    lambda remaining: guard.acall(
+                        lambda timeout: client.generate(model_id, content, generation_config=generation_config,
+                                                        timeout=timeout, **preamble),
+                        estimate_tokens(content + (system_instruction or "")),
+                        deadline=remaining,
+                    ),
+                    deadline,
+                )
+        text = client.extract_text(data)
+        usage = data.get("usageMetadata") or {}
+        record_usage(model_id, usage.get("promptTokenCount", 0), usage.get("candidatesTokenCount", 0))
+        if budget:
+            text, stopped = trim(text, budget)
+            record_length(budget, text, stopped)
+
+        if cache_key:
+            await asyncio.to_thread(get_cache().set, cache_key, text)
+        return Generation(text, usage.get("promptTokenCount", 0), usage.get("candidatesTokenCount", 0), False)
+
+    if not cache_key or bypass_cache:
+        record_request("call", "bypass" if cache_key else "uncached")
+        return await call()
+    generation, fresh = await get_single_flight().ado(f"call:{cache_key}", call,
+                                                      lambda: acached_generation(cache_key, budget))
+    record_request("call", "miss" if fresh else "shared")
+    return shared_generation(generation, fresh)
+
+
+async def agenerate_text(client, instruction, cache_key=None, bypass_cache=False, model_id=DEFAULT_MODEL_ID,
+                         generation_config=None, latency_class=None, priority="interactive", user=None,
+                         budget=None):
+    return (await agenerate(client, instruction, cache_key, bypass_cache, model_id, generation_config,
+                            latency_class, priority, user, budget)).text
+
+
+async def astream_text(client, instruction, cache_key=None, bypass_cache=False, model_id=DEFAULT_MODEL_ID,
+                       latency_class=None, priority="interactive", user=None, budget=None):
+    """Async counterpart of ``stream_text`` using a shared ``GeminiRestClient``."""
+    content, system_instruction, cache_key = split_instruction(instruction, cache_key)
+    generation_config = budgeted_config(None, budget)
+    if cache_key and not bypass_cache:
+        cached = await asyncio.to_thread(cached_text, cache_key, budget)
+        if cached is not None:
+            logging.info("Serving response from cache")
+            record_request("stream", "hit")
+            yield cached
+            return
+    fresh = False
+
+    async def chunks():
+        nonlocal fresh
+        fresh = True
+        preamble = await apreamble(client, model_id, system_instruction)
+        guard = get_call_guard()
+        # Queueing for a slot and the hedged call share one deadline
+        deadline = Deadline(guard.deadline)
+        stream = get_hedger().astream(
+            latency_key(model_id, latency_class, "stream"),
+            lambda remaining: guard.astream(
+                lambda timeout: client.stream_generate(model_id, content, generation_config=generation_config,
+                                                       timeout=timeout, **preamble),
+                estimate_tokens(content + (system_instruction or "")),
+                deadline=remaining,
+            ),
+            deadline,
+        )
+        parts = []
+        usage = None
+        limiter = WordLimiter(budget) if budget else None
+        async with get_scheduler().aslot(priority, user, deadline.check()):
+            with upstream_timer(model_id, "stream"):
+                started = time.perf_counter()
+                async for data in stream:
+                    if not parts:
+                        record_first_chunk(model_id, started)
+                    usage = data.get("usageMetadata") or usage
+                    text = client.chunk_text(data)
+                    if limiter:
+                        text = limiter.feed(text)
+                    parts.append(text)
+                    yield text
+                    if limiter and limiter.stopped:
+                        await stream.aclose()
+                        break
+        if usage is not None:
+            record_usage(model_id, usage.get("promptTokenCount", 0), usage.get("candidatesTokenCount", 0))
+        if limiter:
+            record_length(budget, limiter.text, limiter.stopped)
+
+        if cache_key:
+            await asyncio.to_thread(get_cache().set, cache_key, "".join(parts))
+
+    if not cache_key or bypass_cache:
+        record_request("stream", "bypass" if cache_key else "uncached")
+        stream = chunks()
+    else:
+        stream = get_single_flight().astream(f"stream:{cache_key}", chunks,
+                                             lambda: asyncio.to_thread(cached_text, cache_key, budget))
+    async for text in stream:
+        yield text
+    if cache_key and not bypass_cache:
+        record_request("stream", "miss" if fresh else "shared")
@@ -1,17 +1,35 @@
+import time
+run_started = time.perf_counter()
+
 import streamlit as st
-import google.generativeai as genai
+import contextlib
 import logging
 import json
-import requests
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from budget import budget_for, count_words, record_length, trim
+from cache import get_cache, make_cache_key
+from clients import get_registry, route_model
+from feedback import get_feedback_pipeline
+from hedging import get_hedger
+from history import LOCAL_OWNER, PAGE_SIZE, get_history
+from largeinput import condense, is_large
+from llm import generate, stream_text
+from metrics import get_metrics, start_metrics_server
+from prompts import (WORD_MAP, StreamCleaner, build_combined_instruction, build_evaluate_instruction,
+                     build_merge_instruction, build_refine_instruction, clean_output, format_evaluation,
+                     parse_combined_response)
 
-# Configure Google Gemini API Key
-API_KEY = "YOUR_API_KEY"  # Replace with your actual API key
+# Configure Google Gemini once per process; the key is read from .env
 try:
-    genai.configure(api_key=API_KEY)
+    get_registry()
 except Exception as e:
     logging.error(f"Failed to configure Gemini API: {e}")
     raise e
 
+# Serve /metrics for Prometheus when METRICS_PORT is set
+start_metrics_server()
+
 # Initialize session state
 def init_session_state():
     if 'page' not in st.session_state:
@@ -22,6 +40,11 @@ def init_session_state():
         st.session_state.output = ""
     if 'evaluation' not in st.session_state:
         st.session_state.evaluation = ""
+    if 'candidates' not in st.session_state:
+        st.session_state.candidates = []
+    # Identifies the session to the scheduler, which takes turns between users
+    if 'user_id' not in st.session_state:
+        st.session_state.user_id = uuid.uuid4().hex
 
 init_session_state()
 
@@ -32,15 +55,30 @@ def navigation():
         "Learn": "📚",
         "About": "ℹ️",
         "Feedback": "📝",
-        "Techniques": "🧠"
+        "Techniques": "🧠",
+        "History": "🕘"
     }
     
     st.sidebar.title("Prompt Generator")
     st.session_state.page = st.sidebar.radio("Navigate to:", list(pages.keys()), 
                                             format_func=lambda x: f"{pages[x]} {x}")
 
-# Custom CSS for styling
-st.markdown("""
+    # Response cache statistics
+    stats = get_cache().stats
+    st.sidebar.caption(
+        f"Cache: {stats['memory_hits'] + stats['disk_hits']} hits / {stats['misses']} misses"
+    )
+    hedges = get_hedger().stats
+    if hedges["calls"]:
+        st.sidebar.caption(
+            f"Hedged {hedges['hedged'] / hedges['calls']:.1%} of calls, "
+            f"{hedges['hedge_wins']} wins saving {hedges['saved_seconds']:.1f}s"
+        )
+
+# Custom CSS for styling; built once per process and re-sent on every rerun
+@st.cache_resource
+def page_style():
+    return """
 <style>
     /* General Styles */
     body {
@@ -117,11 +155,207 @@ st.markdown("""
         color: #3498db !important;
     }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+# Render streamed chunks into an output box as they arrive
+def render_stream(chunks):
+    placeholder = st.empty()
+    cleaner = StreamCleaner()
+    text = ""
+    for chunk in chunks:
+        piece = cleaner.feed(chunk)
+        if piece:
+            text += piece
+            placeholder.markdown(f'<div class="output-box">{text}</div>', unsafe_allow_html=True)
+    placeholder.empty()
+    return text + cleaner.finish()
+
+# Instruction, cache key and backend model for a refinement
+def refine_request(prompt, target_model, word_limit_context, tags):
+    instruction = build_refine_instruction(prompt, target_model, word_limit_context, tags)
+    model_id = route_model("refine", word_limit_context)
+    cache_key = make_cache_key(
+        "refine", prompt, model_id,
+        target_model=target_model,
+        word_limit=word_limit_context,
+        tags=tags,
+    )
+    return instruction, cache_key, model_id
+
+# Condense a very large input section by section, showing progress; None for regular inputs
+def condense_large_input(prompt, tags, bypass_cache, trace=None):
+    if not is_large(prompt):
+        return None
+    progress = st.progress(0.0, text="Large input: condensing it section by section...")
+    with stage(trace, "condense"):
+        condensed = condense(prompt, tags, bypass_cache, user=st.session_state.user_id,
+                             on_progress=lambda done, expected: progress.progress(
+                                 min(1.0, done / expected),
+                                 text=f"Large input: condensed {done} of about {expected} sections"))
+    progress.empty()
+    if trace:
+        trace.annotate(chunks=condensed.chunks)
+    return condensed
+
+# Instruction, cache key and backend model for merging the condensed notes into the refined prompt
+def merge_request(condensed, target_model, word_limit_context, tags):
+    instruction = build_merge_instruction(condensed.notes, target_model, word_limit_context, tags)
+    model_id = route_model("refine", word_limit_context)
+    cache_key = make_cache_key(
+        "merge", condensed.notes, model_id,
+        target_model=target_model,
+        word_limit=word_limit_context,
+        tags=tags,
+    )
+    return instruction, cache_key, model_id
+
+# Count the condense calls of a large input towards the generation that used them
+def with_condense_usage(generation, condensed):
+    if not generation or not condensed:
+        return generation
+    return generation._replace(prompt_tokens=(generation.prompt_tokens or 0) + condensed.prompt_tokens,
+                               completion_tokens=(generation.completion_tokens or 0) + condensed.completion_tokens)
+
+# Generate several candidates concurrently and rank them locally; returns ``[(text, RankedCandidate)]``
+# best first, plus the summed token usage (None when the first candidate was streamed)
+def generate_candidates(instruction, cache_key, model_id, count, word_limit_context, bypass_cache, stream_first):
+    from scorer import rank_candidates
+    
+    user = st.session_state.user_id
+    
+    # The first candidate shares its cache entry with single-candidate refinements
+    def candidate_key(i):
+        return cache_key if i == 0 else f"{cache_key}:candidate-{i}"
+    
+    budget = budget_for(word_limit_context)
+    
+    def call(i):
+        return generate(instruction, cache_key=candidate_key(i), bypass_cache=bypass_cache, model_id=model_id,
+                        latency_class=word_limit_context, user=user, budget=budget)
+    
+    texts, generations, errors = [], [], []
+    with ThreadPoolExecutor(max_workers=count) as executor:
+        futures = [executor.submit(call, i) for i in range(1 if stream_first else 0, count)]
+        # Stream one candidate while the others are generated, so there is something to read right away
+        if stream_first:
+            try:
+                texts.append(render_stream(stream_text(instruction, cache_key=candidate_key(0),
+                                                       bypass_cache=bypass_cache, model_id=model_id,
+                                                       latency_class=word_limit_context, user=user,
+                                                       budget=budget)))
+            except Exception as e:
+                errors.append(e)
+        for future in futures:
+            try:
+                generations.append(future.result())
+            except Exception as e:
+                errors.append(e)
+    texts += [clean_output(generation.text) for generation in generations]
+    if not texts:
+        raise errors[0]
+    if errors:
+        logging.warning(f"{len(errors)} of {count} candidates failed, ranking the rest: {errors[0]}")
+    
+    ranked = [(texts[candidate.index], candidate) for candidate in rank_candidates(texts, word_limit_context)]
+    usage = None
+    if generations and not stream_first:
+        usage = generations[0]._replace(prompt_tokens=sum(g.prompt_tokens or 0 for g in generations),
+                                        completion_tokens=sum(g.completion_tokens or 0 for g in generations),
+                                        cached=all(g.cached for g in generations))
+    return ranked, usage
+
+# Near-duplicate matches must share the request kind, target, word limit and tags
+def similarity_scope(target_model, word_limit_context, tags):
+    return "|".join(["refine", target_model, word_limit_context, ",".join(sorted(tags))])
+
+# Instruction, cache key and backend model for an evaluation
+def evaluate_request(prompt):
+    instruction = build_evaluate_instruction(prompt)
+    model_id = route_model("evaluate")
+    cache_key = make_cache_key("evaluate", prompt, model_id)
+    return instruction, cache_key, model_id
+
+# Time a stage of the request being traced, if any
+def stage(trace, name):
+    return trace.stage(name) if trace else contextlib.nullcontext()
+
+# Save a finished generation to the history; the write happens in the background
+def save_history(kind, prompt, output, model_id, started, generation=None, target_model=None,
+                 word_limit_context=None, tags=()):
+    get_history().record(
+        kind, prompt, output,
+        model_id=model_id,
+        target_model=target_model,
+        word_limit=word_limit_context,
+        tags=tags,
+        latency=round(time.perf_counter() - started, 3),
+        prompt_tokens=generation.prompt_tokens if generation else None,
+        completion_tokens=generation.completion_tokens if generation else None,
+        owner=LOCAL_OWNER,
+    )
+
+# Refine and evaluate in one structured call, or as two concurrent calls
+def generate_and_evaluate(prompt, target_model, word_limit_context, tags, combined, bypass_cache):
+    started = time.perf_counter()
+    # A very large input is condensed first; both calls then work from the notes
+    condensed = condense_large_input(prompt, tags, bypass_cache)
+    if combined and not condensed:
+        instruction = build_combined_instruction(prompt, target_model, word_limit_context, tags)
+        model_id = route_model("refine", word_limit_context)
+        cache_key = make_cache_key(
+            "combined", prompt, model_id,
+            target_model=target_model,
+            word_limit=word_limit_context,
+            tags=tags,
+        )
+        generation = generate(instruction, cache_key=cache_key, bypass_cache=bypass_cache, model_id=model_id,
+                              generation_config={"response_mime_type": "application/json"}, latency_class="combined",
+                              user=st.session_state.user_id)
+        try:
+            optimized, evaluation = parse_combined_response(generation.text)
+            optimized, evaluation = clean_output(optimized), clean_output(format_evaluation(evaluation))
+            # The evaluation shares the response, so the word limit is held after parsing instead of by a token cap
+            budget = budget_for(word_limit_context)
+            if budget:
+                optimized, stopped = trim(optimized, budget)
+                record_length(budget, optimized, stopped)
+            save_history("refine", prompt, optimized, model_id, started, generation,
+                         target_model, word_limit_context, tags)
+            save_history("evaluate", prompt, evaluation, model_id, started)
+            return optimized, evaluation
+        except ValueError as e:
+            logging.warning(f"Combined response could not be parsed, falling back to separate calls: {e}")
+            # Otherwise every retry of this prompt would hit the unusable response and pay for the fallback again
+            get_cache().delete(cache_key)
+    
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        if condensed:
+            calls = (("refine",) + merge_request(condensed, target_model, word_limit_context, tags),
+                     ("evaluate",) + evaluate_request(condensed.notes))
+        else:
+            calls = (("refine",) + refine_request(prompt, target_model, word_limit_context, tags),
+                     ("evaluate",) + evaluate_request(prompt))
+        futures = [executor.submit(generate, instruction, cache_key=cache_key, bypass_cache=bypass_cache,
+                                   model_id=model_id,
+                                   latency_class=word_limit_context if kind == "refine" else kind,
+                                   user=st.session_state.user_id,
+                                   budget=budget_for(word_limit_context) if kind == "refine" else None)
+                   for kind, instruction, cache_key, model_id in calls]
+        outputs = []
+        for (kind, _, _, model_id), future in zip(calls, futures):
+            generation = future.result()
+            outputs.append(clean_output(generation.text))
+            if kind == "refine":
+                save_history(kind, prompt, outputs[-1], model_id, started, with_condense_usage(generation, condensed),
+                             target_model, word_limit_context, tags)
+            else:
+                save_history(kind, prompt, outputs[-1], model_id, started, generation)
+        return outputs[0], outputs[1]
 
 # Home Page
 def home_page():
     st.title("Generate Your Prompt")
+    trace = None
     
     with st.container():
         st.subheader("Input Prompt")
@@ -130,7 +364,7 @@ def home_page():
         col1, col2 = st.columns(2)
         with col1:
             word_limit = st.selectbox("Word Limit", 
-                                     ["Short (300-500 words)", "Medium (800-1000 words)", "Long (1500-2000 words)"],
+                                     list(WORD_MAP.keys()),
                                      index=1)
         
         with col2:
@@ -152,48 +386,152 @@ def home_page():
             if st.button("Clear Tags"):
                 st.session_state.tags = []
         
+        bypass_cache = st.checkbox("Bypass cache", help="Always call the model and refresh the cached response")
+        stream_output = st.checkbox("Stream output", value=True, help="Show the response as it is generated")
+        combined_mode = st.checkbox("Combined mode", value=True,
+                                    help="Generate & Evaluate with a single model call instead of two concurrent ones")
+        reuse_similar = st.checkbox("Reuse near-identical results", value=False,
+                                    help="Serve the stored result of an almost identical earlier prompt without calling the model. "
+                                         "Matching is by wording, so a prompt that differs in one word, e.g. \"not\", counts as a match")
+        candidate_count = st.slider("Candidates", 1, 5, 1,
+                                    help="Generate several optimized prompts at once and show the best-scoring one first")
+        
         if st.button("Generate Optimized Prompt"):
             if not prompt.strip():
                 st.error("Prompt cannot be empty")
             else:
                 with st.spinner("Generating prompt..."):
                     try:
-                        # Map word limit selection
-                        word_map = {
-                            "Short (300-500 words)": "300-500 words",
-                            "Medium (800-1000 words)": "800-1000 words",
-                            "Long (1500-2000 words)": "1500-2000 words"
-                        }
-                        word_limit_context = word_map.get(word_limit, "800-1000 words")
+                        word_limit_context = WORD_MAP.get(word_limit, "800-1000 words")
+                        target_model = model if model != 'Custom' else custom_model
+                        st.session_state.candidates = []
                         
-                        # Build instruction
-                        instruction = (
-                            f"You are a professional prompt generator. Your task is to take the following user input and transform it into a "
-                            f"high-quality, optimized prompt for the target AI model '{model if model != 'Custom' else custom_model}'. "
-                            f"Follow these guidelines:\n\n"
-                            f"1. **Objective**: Clearly define the purpose of the prompt\n"
-                            f"2. **Structure**: Break the prompt into logical sections\n"
-                            f"3. **Specificity**: Include specific details or examples\n"
-                            f"4. **Tone**: Use a professional and engaging tone\n"
-                            f"5. **Word Count**: Ensure the prompt adheres to: {word_limit_context}\n\n"
-                            f"**Tags**: {', '.join(st.session_state.tags) if st.session_state.tags else 'None'}\n\n"
-                            f"**User Input**:\n{prompt}\n\n"
-                            f"**Optimized Prompt**:"
-                        )
+                        # NumPy-backed index, imported on first use to keep cold starts fast
+                        from similarity import REUSE_THRESHOLD, SUGGEST_THRESHOLD, get_similarity_index
                         
-                        # Call Gemini AI
-                        model_api = genai.GenerativeModel("gemini-1.5-flash")
-                        response = model_api.generate_content(instruction)
+                        started = time.perf_counter()
+                        trace = get_metrics().trace("refine", target_model=target_model,
+                                                    word_limit=word_limit_context, stream=stream_output)
+                        
+                        # Look for a previously refined prompt that is nearly the same
+                        scope = similarity_scope(target_model, word_limit_context, st.session_state.tags)
+                        similar = None
+                        if not bypass_cache:
+                            with trace.stage("similarity_lookup"):
+                                similar = get_similarity_index().lookup(prompt, scope, SUGGEST_THRESHOLD)
+                        
+                        if similar and reuse_similar and similar[0] >= REUSE_THRESHOLD:
+                            st.info(f"Reused the result of a near-identical prompt ({similar[0]:.0%} similar)")
+                            trace.annotate(reused_similar=True)
+                            st.session_state.output = similar[2]
+                            save_history("refine", prompt, similar[2], None, started,
+                                         target_model=target_model, word_limit_context=word_limit_context,
+                                         tags=st.session_state.tags)
+                        else:
+                            if similar:
+                                st.info(f"While the new prompt is generated, here is the result for a similar one "
+                                        f"({similar[0]:.0%} similar): \"{similar[1][:80]}\"")
+                                st.markdown(f'<div class="output-box">{similar[2]}</div>', unsafe_allow_html=True)
+                            
+                            # Very large inputs are condensed section by section before the final refinement
+                            condensed = condense_large_input(prompt, st.session_state.tags, bypass_cache, trace)
+                            
+                            # Build instruction
+                            with trace.stage("build_instruction"):
+                                if condensed:
+                                    instruction, cache_key, model_id = merge_request(
+                                        condensed, target_model, word_limit_context, st.session_state.tags
+                                    )
+                                else:
+                                    instruction, cache_key, model_id = refine_request(
+                                        prompt, target_model, word_limit_context, st.session_state.tags
+                                    )
+                            trace.annotate(model=model_id)
+                            
+                            # Call Gemini AI; streamed chunks are cleaned and shown as they arrive
+                            generation = None
+                            # Set when a streamed response came from the cache or an identical request
+                            stream_cached = []
+                            if candidate_count > 1:
+                                with trace.stage("generate"):
+                                    ranked, generation = generate_candidates(
+                                        instruction, cache_key, model_id, candidate_count, word_limit_context,
+                                        bypass_cache, stream_output
+                                    )
+                                cleaned_output = ranked[0][0]
+                                st.session_state.candidates = ranked
+                                trace.annotate(candidates=len(ranked), chosen=ranked[0][1].index)
+                            elif stream_output:
+                                with trace.stage("generate"):
+                                    cleaned_output = render_stream(
+                                        stream_text(instruction, cache_key=cache_key, bypass_cache=bypass_cache, model_id=model_id,
+                                                    latency_class=word_limit_context, user=st.session_state.user_id,
+                                                    budget=budget_for(word_limit_context),
+                                                    on_cached=lambda: stream_cached.append(True))
+                                    )
+                            else:
+                                with trace.stage("generate"):
+                                    generation = generate(instruction, cache_key=cache_key, bypass_cache=bypass_cache, model_id=model_id,
+                                                          latency_class=word_limit_context, user=st.session_state.user_id,
+                                                          budget=budget_for(word_limit_context))
+                                
+                                # Clean up output
+                                with trace.stage("clean"):
+                                    cleaned_output = clean_output(generation.text)
+                                trace.annotate(prompt_tokens=generation.prompt_tokens,
+                                               completion_tokens=generation.completion_tokens, cached=generation.cached)
+                            st.session_state.output = cleaned_output
+                            trace.annotate(output_words=count_words(cleaned_output))
+                            with trace.stage("save"):
+                                # A cached response was indexed when it was generated
+                                if not (generation and generation.cached) and not stream_cached:
+                                    get_similarity_index().add(prompt, cleaned_output, scope)
+                                save_history("refine", prompt, cleaned_output, model_id, started,
+                                             with_condense_usage(generation, condensed),
+                                             target_model, word_limit_context, st.session_state.tags)
+                    except Exception as e:
+                        if trace:
+                            trace.finish(e)
+                            trace = None
+                        st.error(f"Error: {str(e)}")
+        
+        if st.button("Generate & Evaluate"):
+            if not prompt.strip():
+                st.error("Prompt cannot be empty")
+            else:
+                with st.spinner("Generating and evaluating prompt..."):
+                    try:
+                        word_limit_context = WORD_MAP.get(word_limit, "800-1000 words")
+                        target_model = model if model != 'Custom' else custom_model
+                        trace = get_metrics().trace("generate_and_evaluate", target_model=target_model,
+                                                    word_limit=word_limit_context, combined=combined_mode)
+                        st.session_state.candidates = []
                         
-                        # Clean up output
-                        cleaned_output = response.text.replace("*", "").strip()
-                        st.session_state.output = cleaned_output
+                        with trace.stage("generate"):
+                            st.session_state.output, st.session_state.evaluation = generate_and_evaluate(
+                                prompt, target_model, word_limit_context, st.session_state.tags,
+                                combined_mode, bypass_cache
+                            )
                     except Exception as e:
+                        if trace:
+                            trace.finish(e)
+                            trace = None
                         st.error(f"Error: {str(e)}")
         
         if st.session_state.output:
             st.subheader("Generated Prompt")
-            st.markdown(f'<div class="output-box">{st.session_state.output}</div>', unsafe_allow_html=True)
+            with stage(trace, "render"):
+                st.markdown(f'<div class="output-box">{st.session_state.output}</div>', unsafe_allow_html=True)
+            
+            if st.session_state.candidates:
+                with st.expander(f"All {len(st.session_state.candidates)} candidates, best first"):
+                    for i, (text, candidate) in enumerate(st.session_state.candidates):
+                        st.caption(f"#{i + 1}: local score {candidate.overall}/10, {candidate.words} words "
+                                   f"({candidate.fit:.0%} within the word limit), rank {candidate.rank:.2f}")
+                        st.markdown(f'<div class="output-box">{text}</div>', unsafe_allow_html=True)
+                        if text != st.session_state.output and st.button("Use this candidate", key=f"candidate_{i}"):
+                            st.session_state.output = text
+                            st.rerun()
             
             if st.button("Copy to Clipboard"):
                 st.session_state.copied = True
@@ -203,43 +541,107 @@ def home_page():
         st.divider()
         st.subheader("Evaluate Your Prompt")
         
-        if st.button("Evaluate Prompt"):
+        # Instant local score; the model is only asked for the detailed critique
+        if prompt.strip():
+            from scorer import SCORE_DIMENSIONS, score_prompt
+            
+            local_score = score_prompt(prompt)
+            columns = st.columns(len(SCORE_DIMENSIONS) + 1)
+            columns[0].metric("Overall", f"{local_score.overall}/10")
+            for column, dimension in zip(columns[1:], SCORE_DIMENSIONS):
+                column.metric(dimension.capitalize(), f"{getattr(local_score, dimension)}/10")
+            for suggestion in local_score.suggestions:
+                st.caption(f"• {suggestion}")
+        
+        if st.button("Get Detailed Critique"):
             if not prompt.strip():
                 st.error("Prompt cannot be empty")
             else:
                 with st.spinner("Evaluating prompt..."):
                     try:
+                        started = time.perf_counter()
+                        trace = get_metrics().trace("evaluate", stream=stream_output)
+                        
+                        # A very large input is critiqued from its condensed notes
+                        condensed = condense_large_input(prompt, [], bypass_cache, trace)
+                        
                         # Build instruction
-                        instruction = (
-                            f"You are a professional prompt evaluator. Analyze this prompt:\n\n"
-                            f"**User Input**:\n{prompt}\n\n"
-                            f"Focus on:\n"
-                            f"1. **Clarity**: Is the prompt clear?\n"
-                            f"2. **Specificity**: Enough details?\n"
-                            f"3. **Structure**: Logical organization?\n"
-                            f"4. **Tone**: Appropriate for audience?\n"
-                            f"5. **Suggestions**: Specific improvements\n\n"
-                            f"**Evaluation**:"
-                        )
+                        with trace.stage("build_instruction"):
+                            instruction, cache_key, model_id = evaluate_request(condensed.notes if condensed else prompt)
+                        trace.annotate(model=model_id)
                         
                         # Call Gemini AI
-                        model_api = genai.GenerativeModel("gemini-1.5-flash")
-                        response = model_api.generate_content(instruction)
-                        
-                        # Clean up output
-                        cleaned_output = response.text.replace("*", "").strip()
+                        generation = None
+                        if stream_output:
+                            with trace.stage("generate"):
+                                cleaned_output = render_stream(
+                                    stream_text(instruction, cache_key=cache_key, bypass_cache=bypass_cache, model_id=model_id,
+                                                latency_class="evaluate", user=st.session_state.user_id)
+                                )
+                        else:
+                            with trace.stage("generate"):
+                                generation = generate(instruction, cache_key=cache_key, bypass_cache=bypass_cache, model_id=model_id,
+                                                      latency_class="evaluate", user=st.session_state.user_id)
+                            
+                            # Clean up output
+                            with trace.stage("clean"):
+                                cleaned_output = clean_output(generation.text)
+                            trace.annotate(prompt_tokens=generation.prompt_tokens,
+                                           completion_tokens=generation.completion_tokens, cached=generation.cached)
                         st.session_state.evaluation = cleaned_output
+                        with trace.stage("save"):
+                            save_history("evaluate", prompt, cleaned_output, model_id, started,
+                                         with_condense_usage(generation, condensed))
                     except Exception as e:
+                        if trace:
+                            trace.finish(e)
+                            trace = None
                         st.error(f"Error: {str(e)}")
         
         if st.session_state.evaluation:
             st.subheader("Evaluation Result")
-            st.markdown(f'<div class="output-box">{st.session_state.evaluation}</div>', unsafe_allow_html=True)
+            with stage(trace, "render"):
+                st.markdown(f'<div class="output-box">{st.session_state.evaluation}</div>', unsafe_allow_html=True)
             
             if st.button("Learn More About Prompt Engineering"):
                 st.session_state.page = "Learn"
+    
+    # Finish the request traced in this run, now that its output is rendered
+    if trace:
+        trace.finish()
 
 # Learn Page
+# Expander titles and bodies, formatted once per process
+@st.cache_resource
+def learn_techniques():
+    techniques = (
+        "Zero-shot Prompting",
+        "Few-shot Prompting",
+        "Chain-of-Thought Prompting",
+        "Meta Prompting",
+        "Self-Consistency",
+        "Generate Knowledge Prompting",
+        "Prompt Chaining",
+        "Tree of Thoughts",
+        "Retrieval Augmented Generation",
+        "Automatic Prompt Engineer",
+        "Automatic Reasoning and Tool-use",
+        "Active-Prompt",
+        "Directional Stimulus Prompting",
+        "Program-Aided Language Models",
+        "ReAct",
+        "Reflexion",
+        "Multimodal CoT",
+        "Graph Prompting"
+    )
+    return tuple(
+        (f"{i+1}. {technique}",
+         f"**Use Case:** General purpose technique for {technique.split(' ')[0].lower()} prompts\n\n"
+         f"**Developed By:** Research Community\n\n"
+         f"**Example Implementation:** Commonly used in state-of-the-art LLMs")
+        for i, technique in enumerate(techniques)
+    )
+
 def learn_page():
     st.title("Prompt Engineering Guide")
     
@@ -256,32 +658,9 @@ def learn_page():
     
     with st.container():
         st.subheader("Prompt Techniques")
-        techniques = [
-            "Zero-shot Prompting",
-            "Few-shot Prompting",
-            "Chain-of-Thought Prompting",
-            "Meta Prompting",
-            "Self-Consistency",
-            "Generate Knowledge Prompting",
-            "Prompt Chaining",
-            "Tree of Thoughts",
-            "Retrieval Augmented Generation",
-            "Automatic Prompt Engineer",
-            "Automatic Reasoning and Tool-use",
-            "Active-Prompt",
-            "Directional Stimulus Prompting",
-            "Program-Aided Language Models",
-            "ReAct",
-            "Reflexion",
-            "Multimodal CoT",
-            "Graph Prompting"
-        ]
-        
-        for i, technique in enumerate(techniques):
-            with st.expander(f"{i+1}. {technique}"):
-                st.write(f"**Use Case:** General purpose technique for {technique.split(' ')[0].lower()} prompts")
-                st.write(f"**Developed By:** Research Community")
-                st.write(f"**Example Implementation:** Commonly used in state-of-the-art LLMs")
+        for title, body in learn_techniques():
+            with st.expander(title):
+                st.markdown(body)
 
 # About Page
 def about_page():
@@ -315,10 +694,69 @@ def about_page():
         st.markdown("""
         - Add multi-language support for prompt generation and evaluation
         - Integrate more AI models for diverse prompt refinement
-        - Enable users to save and manage their prompts
         - Add a community feature to share and discuss prompts
         """)
 
+# History Page
+def history_page():
+    st.title("Prompt History")
+    
+    col1, col2, col3 = st.columns([3, 2, 1])
+    with col1:
+        search_text = st.text_input("Search prompts and outputs")
+    with col2:
+        tag_filter = st.text_input("Tags (comma separated)")
+    with col3:
+        kind = st.selectbox("Type", ["All", "refine", "evaluate"])
+    tags = [tag for tag in tag_filter.split(",") if tag.strip()]
+    
+    # Keyset pagination: remember the last id of every page shown so far
+    filters = (search_text, tag_filter, kind)
+    if st.session_state.get("history_filters") != filters:
+        st.session_state.history_filters = filters
+        st.session_state.history_cursors = [None]
+    cursors = st.session_state.history_cursors
+    
+    entries = get_history().search(search_text, tags, None if kind == "All" else kind, before_id=cursors[-1],
+                                   owner=LOCAL_OWNER)
+    if not entries:
+        st.info("No saved prompts match." if len(cursors) == 1 else "No older prompts.")
+    
+    for entry in entries:
+        created = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry.created))
+        with st.expander(f"{created} · {entry.kind} · {entry.prompt[:80]}"):
+            st.markdown("**Prompt**")
+            st.write(entry.prompt)
+            st.markdown("**Output**")
+            st.markdown(f'<div class="output-box">{entry.output}</div>', unsafe_allow_html=True)
+            details = [f"Model: {entry.model_id or 'reused'}"]
+            if entry.target_model:
+                details.append(f"Target: {entry.target_model}")
+            if entry.word_limit:
+                details.append(f"Length: {entry.word_limit}")
+            if entry.tags:
+                details.append(f"Tags: {', '.join(entry.tags)}")
+            if entry.latency is not None:
+                details.append(f"Latency: {entry.latency:.2f}s")
+            if entry.prompt_tokens is not None:
+                details.append(f"Tokens: {entry.prompt_tokens} in / {entry.completion_tokens} out")
+            st.caption(" · ".join(details))
+            if st.button("Load into Home", key=f"load_{entry.id}"):
+                st.session_state.input_prompt = entry.prompt
+                if entry.kind == "evaluate":
+                    st.session_state.evaluation = entry.output
+                else:
+                    st.session_state.output = entry.output
+                st.success("Loaded; open the Home page to continue.")
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        if len(cursors) > 1:
+            st.button("← Newer", on_click=cursors.pop)
+    with col2:
+        if len(entries) == PAGE_SIZE:
+            st.button("Older →", on_click=cursors.append, args=(entries[-1].id,))
+
 # Feedback Page
 def feedback_page():
     st.title("Feedback")
@@ -334,30 +772,22 @@ def feedback_page():
                 st.error("Please enter your feedback")
             else:
                 try:
-                    # Google Apps Script endpoint
-                    script_url = "https://script.google.com/macros/s/AKfycbyNptReTdjxtgfVb_Bho_l4-tBpzxvMM0W6_5IhzRRBd9QMsB9sn5yyoPp19RLGcrfV/exec"
-                    
-                    # Send feedback data
+                    # Spool locally; a background worker delivers it to the feedback endpoint
                     data = {
                         'feedback': feedback,
                         'email': email,
                         'language': language
                     }
                     
-                    response = requests.post(script_url, json=data)
-                    
-                    if response.status_code == 200:
-                        st.success("Feedback submitted successfully!")
-                    else:
-                        st.error("Failed to submit feedback. Please try again.")
+                    get_feedback_pipeline().submit(data)
+                    st.success("Feedback submitted successfully!")
                 except Exception as e:
                     st.error(f"Error: {str(e)}")
 
 # Techniques Page
-def techniques_page():
-    st.title("Prompt Engineering Techniques")
-    
-    techniques = [
+@st.cache_resource
+def technique_catalog():
+    return (
         {
             "name": "Zero-shot Prompting",
             "use_case": "Tasks where no examples are provided",
@@ -377,7 +807,12 @@ def techniques_page():
             "developed": "Google Research"
         }
         # Add more techniques as needed
-    ]
+    )
+
+def techniques_page():
+    st.title("Prompt Engineering Techniques")
+    
+    techniques = technique_catalog()
     
     for tech in techniques:
         with st.expander(tech["name"]):
@@ -393,6 +828,7 @@ def main():
         layout="wide",
         initial_sidebar_state="expanded"
     )
+    st.markdown(page_style(), unsafe_allow_html=True)
     
     navigation()
     
@@ -406,6 +842,10 @@ def main():
         feedback_page()
     elif st.session_state.page == "Techniques":
         techniques_page()
+    elif st.session_state.page == "History":
+        history_page()
+    
+    get_metrics().observe("prompt_rerun_seconds", time.perf_counter() - run_started, page=st.session_state.page)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,288 @@
+"""Request metrics in the Prometheus text format, plus optional trace logs.
+
+Counters and latency histograms live in one registry per process. Request
+handlers time their stages (instruction building, the model call, output
+cleanup, rendering) through a ``Trace``, and the shared call path in
+``llm`` records upstream latency, token usage, cache outcomes and error
+classes. The running totals of the cache, call guard, single-flight, hedging and
+scheduler components are read when the metrics are rendered.
+
+server.py serves the metrics at ``/metrics``; the Streamlit app serves them
+from a small background HTTP server when ``METRICS_PORT`` is set. Each
+process reports its own numbers, so scrape every worker.
+
+Tunables (environment)::
+
+    METRICS_PORT    port of the metrics server started by main.py (off by default)
+    TRACE_LOG       file that receives one JSON line per traced request ("-" for the log stream)
+"""
+import bisect
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Upper bounds in seconds; model calls range from cache hits to minute-long generations
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+# Metric name -> (type, help)
+METRICS = {
+    "prompt_requests_total": ("counter", "Generation requests by call kind and cache outcome."),
+    "prompt_request_seconds": ("histogram", "End-to-end latency of traced requests."),
+    "prompt_stage_seconds": ("histogram", "Latency of each stage of a traced request."),
+    "prompt_rerun_seconds": ("histogram", "Duration of Streamlit script runs by page."),
+    "prompt_upstream_seconds": ("histogram", "Latency of model calls, retries and hedges included."),
+    "prompt_first_chunk_seconds": ("histogram", "Time until a streamed model call yields its first chunk."),
+    "prompt_tokens_total": ("counter", "Tokens spent on model calls, by model and token type."),
+    "prompt_errors_total": ("counter", "Failed traced requests by operation and error class."),
+    "prompt_upstream_errors_total": ("counter", "Failed model calls by model and error class."),
+    "prompt_cache_lookups_total": ("counter", "Response cache lookups by result."),
+    "prompt_upstream_calls_total": ("counter", "Model calls admitted by the call guard."),
+    "prompt_upstream_retries_total": ("counter", "Retried model call attempts."),
+    "prompt_upstream_failures_total": ("counter", "Failed model call attempts."),
+    "prompt_upstream_rejected_total": ("counter", "Model calls rejected by the rate limiter or circuit breaker."),
+    "prompt_throttled_seconds_total": ("counter", "Seconds model calls waited for rate-limit budget."),
+    "prompt_coalesced_total": ("counter", "Requests that waited on an identical request already in flight."),
+    "prompt_hedged_total": ("counter", "Model calls that started a hedged duplicate."),
+    "prompt_hedge_wins_total": ("counter", "Hedged duplicates that answered first."),
+    "prompt_hedge_saved_seconds_total": ("counter", "Latency saved by winning hedges."),
+    "prompt_hedge_abandoned": ("gauge", "Losing sync model call attempts still running."),
+    "prompt_output_length_total": ("counter", "Budgeted responses by word limit and length outcome."),
+    "prompt_output_words_total": ("counter", "Words in budgeted responses, by word limit."),
+    "prompt_output_target_words_total": ("counter", "Upper bound of the word limit of budgeted responses."),
+    "prompt_queue_wait_seconds": ("histogram", "Time model calls waited for a scheduler slot, by priority."),
+    "prompt_shed_total": ("counter", "Model calls rejected by the scheduler, by priority and reason."),
+    "prompt_queue_depth": ("gauge", "Model calls waiting for a scheduler slot, by priority."),
+    "prompt_slots_in_use": ("gauge", "Scheduler slots held by running model calls, by priority."),
+}
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+
+def component_stats():
+    """Yield ``(name, labels, value)`` for the counters other components keep themselves."""
+    # Imported here: those modules record into this one
+    from cache import get_cache
+    from hedging import get_hedger
+    from resilience import get_call_guard
+    from scheduler import get_scheduler
+    from singleflight import get_single_flight
+
+    cache = get_cache().stats
+    for result, stat in (("memory_hit", "memory_hits"), ("disk_hit", "disk_hits"), ("miss", "misses")):
+        yield "prompt_cache_lookups_total", (("result", result),), cache[stat]
+    guard = get_call_guard().stats
+    yield "prompt_upstream_calls_total", (), guard["calls"]
+    yield "prompt_upstream_retries_total", (), guard["retries"]
+    yield "prompt_upstream_failures_total", (), guard["failures"]
+    yield "prompt_upstream_rejected_total", (), guard["rejected"]
+    yield "prompt_throttled_seconds_total", (), guard["throttled_seconds"]
+    yield "prompt_coalesced_total", (), get_single_flight().stats["coalesced"]
+    hedges = get_hedger().stats
+    yield "prompt_hedged_total", (), hedges["hedged"]
+    yield "prompt_hedge_wins_total", (), hedges["hedge_wins"]
+    yield "prompt_hedge_saved_seconds_total", (), hedges["saved_seconds"]
+    yield "prompt_hedge_abandoned", (), hedges["abandoned"]
+    for priority, (running, waiting) in get_scheduler().snapshot().items():
+        yield "prompt_slots_in_use", (("priority", priority),), running
+        yield "prompt_queue_depth", (("priority", priority),), waiting
+
+
+class Metrics:
+    def __init__(self, buckets=LATENCY_BUCKETS, collectors=(component_stats,)):
+        self.buckets = tuple(buckets)
+        self.collectors = list(collectors)
+        self._counters = {}
+        # (name, labels) -> [count per bucket..., +Inf count, sum]
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            values = self._histograms.get(key)
+            if values is None:
+                values = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            values[bisect.bisect_left(self.buckets, seconds)] += 1
+            values[-1] += seconds
+
+    def total(self, name, **labels):
+        """Return ``(count, sum)`` of a histogram."""
+        with self._lock:
+            values = self._histograms.get((name, tuple(sorted(labels.items()))))
+        if values is None:
+            return 0, 0.0
+        return sum(values[:-1]), values[-1]
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def trace(self, operation, **fields):
+        return Trace(self, operation, fields)
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+        samples = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                samples.setdefault(name, []).append(f"{name}{format_labels(labels)} {value}")
+            for (name, labels), values in self._histograms.items():
+                lines = samples.setdefault(name, [])
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), values):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {values[-1]}")
+                lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        for collect in self.collectors:
+            try:
+                for name, labels, value in collect():
+                    samples.setdefault(name, []).append(f"{name}{format_labels(labels)} {value}")
+            except Exception as e:
+                logging.warning(f"Metrics collector {collect.__name__} failed: {e}")
+
+        output = []
+        for name in sorted(samples):
+            kind, help_text = METRICS.get(name, ("untyped", ""))
+            output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {kind}")
+            output.extend(samples[name])
+        return "\n".join(output) + "\n"
+
+
+class Trace:
+    """Stage timings of one request, recorded as metrics and optionally logged.
+
+    Use as a context manager: leaving it records the total latency, counts
+    the error class if an exception escaped, and writes the trace log line.
+    """
+
+    def __init__(self, metrics, operation, fields):
+        self.metrics = metrics
+        self.operation = operation
+        self.fields = fields
+        self.id = uuid.uuid4().hex[:16]
+        self.stages = {}
+        self.started = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.stages[name] = self.stages.get(name, 0.0) + elapsed
+            self.metrics.observe("prompt_stage_seconds", elapsed, operation=self.operation, stage=name)
+
+    def annotate(self, **fields):
+        self.fields.update(fields)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.finish(exc)
+
+    def finish(self, error=None):
+        elapsed = time.perf_counter() - self.started
+        self.metrics.observe("prompt_request_seconds", elapsed, operation=self.operation)
+        if error is not None:
+            self.metrics.inc("prompt_errors_total", operation=self.operation, error=type(error).__name__)
+        if trace_logger.handlers:
+            record = {
+                "trace_id": self.id,
+                "operation": self.operation,
+                "seconds": round(elapsed, 4),
+                "stages": {name: round(seconds, 4) for name, seconds in self.stages.items()},
+                "error": type(error).__name__ if error is not None else None,
+            }
+            record.update(self.fields)
+            trace_logger.info(json.dumps(record, default=str))
+
+
+def make_trace_logger(target=os.environ.get("TRACE_LOG")):
+    logger = logging.getLogger("promptgenerator.trace")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    if target and not logger.handlers:
+        handler = logging.StreamHandler() if target == "-" else logging.FileHandler(target)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+    return logger
+
+
+trace_logger = make_trace_logger()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = get_metrics().render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+_server = None
+
+
+def get_metrics():
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                _metrics = Metrics()
+    return _metrics
+
+
+def start_metrics_server(port=None):
+    """Serve ``/metrics`` from a daemon thread once per process; returns the server or ``None``."""
+    global _server
+    port = port or os.environ.get("METRICS_PORT")
+    if not port:
+        return None
+    with _metrics_lock:
+        if _server is None:
+            try:
+                _server = ThreadingHTTPServer(("0.0.0.0", int(port)), MetricsHandler)
+            except OSError as e:
+                # Warn once; Streamlit calls this again on every rerun
+                logging.warning(f"Metrics server could not listen on port {port}: {e}")
+                _server = False
+                return None
+            threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+    return _server or None
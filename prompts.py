@@ -0,0 +1,293 @@
+"""Instruction templates shared by the Streamlit app, the HTTP server and batch.py.
+
+Every instruction is a registered, versioned template compiled once. The
+constant preamble is kept apart from the per-request content so it can be
+sent as a system instruction and cached by the provider.
+"""
+import json
+import string
+from collections import namedtuple
+
+# Map word limit selection
+WORD_MAP = {
+    "Short (300-500 words)": "300-500 words",
+    "Medium (800-1000 words)": "800-1000 words",
+    "Long (1500-2000 words)": "1500-2000 words"
+}
+DEFAULT_WORD_LIMIT = "Medium (800-1000 words)"
+
+# Short option values posted by templates/index.html
+WORD_LIMIT_ALIASES = {
+    "short": "Short (300-500 words)",
+    "medium": "Medium (800-1000 words)",
+    "long": "Long (1500-2000 words)"
+}
+
+
+def resolve_word_limit(word_limit):
+    """Return the ``WORD_MAP`` value for a selectbox label or a short alias."""
+    label = WORD_LIMIT_ALIASES.get(str(word_limit).strip().lower(), word_limit)
+    return WORD_MAP.get(label, WORD_MAP[DEFAULT_WORD_LIMIT])
+
+
+class Instruction(namedtuple("Instruction", ["system", "content", "version"])):
+    """A rendered template: constant ``system`` preamble plus per-request ``content``."""
+
+    @property
+    def text(self):
+        # Single-string form for token estimates and providers without system instructions
+        return f"{self.system}\n\n{self.content}" if self.system else self.content
+
+
+class PromptTemplate:
+    """A named, versioned template compiled once at import time."""
+
+    def __init__(self, name, version, system, content):
+        self.name = name
+        self.version = version
+        self.system = system
+        self._content = string.Template(content)
+
+    @property
+    def key(self):
+        return f"{self.name}@{self.version}"
+
+    def render(self, **fields):
+        return Instruction(self.system, self._content.substitute(fields), self.key)
+
+
+TEMPLATES = {}
+
+
+def register_template(template):
+    TEMPLATES.setdefault(template.name, {})[template.version] = template
+    return template
+
+
+def get_template(name, version=None):
+    """Return a template by name, defaulting to its latest version."""
+    versions = TEMPLATES[name]
+    return versions[version if version is not None else max(versions)]
+
+
+register_template(PromptTemplate(
+    "refine", 2,
+    "You are a professional prompt generator. Your task is to take the user input and transform it into a "
+    "high-quality, optimized prompt for the target AI model named in the request. "
+    "Follow these guidelines:\n\n"
+    "1. **Objective**: Clearly define the purpose of the prompt\n"
+    "2. **Structure**: Break the prompt into logical sections\n"
+    "3. **Specificity**: Include specific details or examples\n"
+    "4. **Tone**: Use a professional and engaging tone\n"
+    "5. **Word Count**: Ensure the prompt adheres to the word count given in the request",
+    "**Target Model**: $target_model\n"
+    "**Word Count**: $word_limit\n"
+    "**Tags**: $tags\n\n"
+    "**User Input**:\n$prompt\n\n"
+    "**Optimized Prompt**:",
+))
+
+register_template(PromptTemplate(
+    "evaluate", 2,
+    "You are a professional prompt evaluator. Analyze the prompt given as user input.\n\n"
+    "Focus on:\n"
+    "1. **Clarity**: Is the prompt clear?\n"
+    "2. **Specificity**: Enough details?\n"
+    "3. **Structure**: Logical organization?\n"
+    "4. **Tone**: Appropriate for audience?\n"
+    "5. **Suggestions**: Specific improvements",
+    "**User Input**:\n$prompt\n\n"
+    "**Evaluation**:",
+))
+
+# Refinement styles offered by try.py
+MODES = ("Creativity", "Technical", "Mix of Both")
+
+register_template(PromptTemplate(
+    "mode/Creativity", 2,
+    "You will act as an expert prompt creator to refine the given input prompt into a creative, imaginative, and engaging version. "
+    "Ensure the refined prompt captures the essence of the original input while inspiring engaging and imaginative responses.",
+    "Input Prompt:\n$prompt\n\nOutput:",
+))
+
+register_template(PromptTemplate(
+    "mode/Technical", 2,
+    "You will act as an expert prompt creator to refine the given input prompt into a technical, precise, and factually accurate version. "
+    "Ensure the refined prompt maintains logical structure, clarity, and correctness, tailored for technical queries.",
+    "Input Prompt:\n$prompt\n\nOutput:",
+))
+
+register_template(PromptTemplate(
+    "mode/Mix of Both", 2,
+    "You will act as an expert prompt creator to refine the given input prompt, balancing creativity with technical precision. "
+    "Ensure the refined prompt is both engaging and technically accurate, offering a perfect blend of imaginative and precise details.",
+    "Input Prompt:\n$prompt\n\nOutput:",
+))
+
+register_template(PromptTemplate(
+    "critique", 2,
+    "You will act as an expert prompt evaluator. Evaluate the given prompt based on these criteria: "
+    "1. Structure: Is the prompt logically organized? "
+    "2. Clarity: Is the prompt precise and unambiguous? "
+    "3. Words and Tone: Is the language appropriate for the audience and purpose? "
+    "4. Effectiveness: Does the prompt achieve its intended goal?",
+    "Prompt to Evaluate:\n$prompt\n\n*Critique:*\n{Provide detailed feedback with actionable suggestions for improvement.}",
+))
+
+register_template(PromptTemplate(
+    "combined", 2,
+    "You are a professional prompt generator and evaluator. Do two things with the user input.\n\n"
+    "First, transform it into a high-quality, optimized prompt for the target AI model named in the request. "
+    "Clearly define the purpose, break it into logical sections, include specific details or examples, "
+    "use a professional and engaging tone, and ensure it adheres to the word count given in the request.\n\n"
+    "Second, evaluate the original user input for clarity (is it clear?), specificity (enough details?), "
+    "structure (logical organization?), tone (appropriate for audience?) and suggestions (specific improvements).\n\n"
+    "Respond with a single JSON object and nothing else, in this shape:\n"
+    '{"optimized_prompt": "...", "evaluation": {"clarity": "...", "specificity": "...", '
+    '"structure": "...", "tone": "...", "suggestions": "..."}}',
+    "Target Model: $target_model\n"
+    "Word Count: $word_limit\n"
+    "Tags: $tags\n\n"
+    "User Input:\n$prompt",
+))
+
+# Map and reduce steps for inputs too large for one refinement (largeinput.py)
+register_template(PromptTemplate(
+    "condense", 1,
+    "You are preparing a long document so a prompt can be written from it. You are given one section of the "
+    "document at a time. Condense the section into compact notes that keep every requirement, constraint, "
+    "definition, number, name and example a prompt writer would need. Drop repetition, boilerplate and prose "
+    "that carries no information. Do not add anything that is not in the section. Reply with the notes only.",
+    "**Section**: $position\n"
+    "**Tags**: $tags\n\n"
+    "**Text**:\n$text\n\n"
+    "**Notes**:",
+))
+
+register_template(PromptTemplate(
+    "merge", 1,
+    "You are a professional prompt generator. The user input was a long document, condensed section by section "
+    "into the notes in the request, in document order. Transform the notes into one high-quality, optimized prompt "
+    "for the target AI model named in the request. "
+    "Follow these guidelines:\n\n"
+    "1. **Objective**: Clearly define the purpose of the prompt\n"
+    "2. **Structure**: Break the prompt into logical sections\n"
+    "3. **Specificity**: Keep the concrete requirements and constraints from the notes, merging duplicates\n"
+    "4. **Tone**: Use a professional and engaging tone\n"
+    "5. **Word Count**: The prompt must stay within the word count given in the request; "
+    "prioritise the most important requirements rather than exceeding it",
+    "**Target Model**: $target_model\n"
+    "**Word Count**: $word_limit\n"
+    "**Tags**: $tags\n\n"
+    "**Section Notes**:\n$notes\n\n"
+    "**Optimized Prompt**:",
+))
+
+# Dimensions listed in the evaluate instruction
+EVALUATION_DIMENSIONS = ("clarity", "specificity", "structure", "tone", "suggestions")
+
+
+def format_tags(tags):
+    return ', '.join(tags) if tags else 'None'
+
+
+def build_refine_instruction(prompt, target_model, word_limit_context, tags):
+    return get_template("refine").render(prompt=prompt, target_model=target_model,
+                                         word_limit=word_limit_context, tags=format_tags(tags))
+
+
+def build_evaluate_instruction(prompt):
+    return get_template("evaluate").render(prompt=prompt)
+
+
+def build_mode_instruction(user_input, mode):
+    return get_template(f"mode/{mode}").render(prompt=user_input)
+
+
+def build_critique_instruction(prompt_to_evaluate):
+    return get_template("critique").render(prompt=prompt_to_evaluate)
+
+
+def build_combined_instruction(prompt, target_model, word_limit_context, tags):
+    """Ask for the optimized prompt and the evaluation in one JSON response."""
+    return get_template("combined").render(prompt=prompt, target_model=target_model,
+                                           word_limit=word_limit_context, tags=format_tags(tags))
+
+
+def build_condense_instruction(text, position, tags):
+    return get_template("condense").render(text=text, position=position, tags=format_tags(tags))
+
+
+def build_merge_instruction(notes, target_model, word_limit_context, tags):
+    return get_template("merge").render(notes=notes, target_model=target_model,
+                                        word_limit=word_limit_context, tags=format_tags(tags))
+
+
+def parse_combined_response(text):
+    """Return ``(optimized_prompt, evaluation)`` from a combined-mode response.
+
+    Tolerates Markdown code fences and text around the JSON object. Raises
+    ``ValueError`` when no usable object can be found.
+    """
+    start = text.find("{")
+    end = text.rfind("}")
+    if start == -1 or end <= start:
+        raise ValueError("Response does not contain a JSON object")
+    data = json.loads(text[start:end + 1])
+
+    optimized = data.get("optimized_prompt") or data.get("optimizedPrompt")
+    evaluation = data.get("evaluation")
+    if not isinstance(optimized, str) or not optimized.strip():
+        raise ValueError("Response is missing the optimized prompt")
+    if not isinstance(evaluation, dict):
+        raise ValueError("Response is missing the evaluation")
+    evaluation = {key.lower(): value for key, value in evaluation.items()}
+    return optimized, evaluation
+
+
+def format_evaluation(evaluation):
+    # Render the structured evaluation like the numbered list the evaluate call returns
+    lines = []
+    for i, dimension in enumerate(EVALUATION_DIMENSIONS, start=1):
+        value = evaluation.get(dimension)
+        if isinstance(value, list):
+            value = "\n" + "\n".join(f"- {item}" for item in value)
+        lines.append(f"{i}. {dimension.capitalize()}: {value or 'No comment'}")
+    return "\n\n".join(lines)
+
+
+def clean_output(text):
+    # Clean up output
+    return text.replace("*", "").strip()
+
+
+class StreamCleaner:
+    """Incremental version of ``clean_output`` for streamed chunks.
+
+    Asterisks are dropped per chunk, leading whitespace is skipped and
+    trailing whitespace is held back until more text arrives, so the joined
+    pieces equal ``clean_output`` applied to the full response.
+    """
+
+    def __init__(self):
+        self._started = False
+        self._pending = ""
+
+    def feed(self, chunk):
+        text = chunk.replace("*", "")
+        if not self._started:
+            text = text.lstrip()
+            if not text:
+                return ""
+            self._started = True
+        stripped = text.rstrip()
+        if not stripped:
+            self._pending += text
+            return ""
+        piece = self._pending + stripped
+        self._pending = text[len(stripped):]
+        return piece
+
+    def finish(self):
+        self._pending = ""
+        return ""
@@ -0,0 +1,399 @@
+"""Rate limiting, retries and circuit breaking around every model call.
+
+One ``CallGuard`` per process is shared by all Streamlit sessions, server
+requests and batch workers, so bursts are smoothed out before they reach
+the API instead of turning into quota errors and wasted retries.
+
+Tunables (environment)::
+
+    GEMINI_RPM              requests per minute (2000)
+    GEMINI_TPM              tokens per minute (4000000)
+    GEMINI_MAX_RETRIES      retries after the first attempt (4)
+    GEMINI_CALL_DEADLINE    total seconds per call, retries included (90)
+"""
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+
+# Status codes and SDK exception names worth retrying
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+RETRYABLE_NAMES = {
+    "ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "InternalServerError",
+    "DeadlineExceeded", "GatewayTimeout", "TimeoutException", "ConnectError", "ReadError",
+    "RemoteProtocolError", "ConnectTimeout", "ReadTimeout", "PoolTimeout",
+}
+QUOTA_NAMES = {"ResourceExhausted", "TooManyRequests"}
+
+
+class CallRejected(Exception):
+    """Raised instead of calling the API; ``retry_after`` is in seconds."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(CallRejected):
+    pass
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def status_of(exc):
+    for attr in ("status_code", "code"):
+        value = getattr(exc, attr, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(exc, "response", None)
+    return getattr(response, "status_code", None)
+
+
+def is_retryable(exc):
+    if isinstance(exc, CallRejected):
+        return False
+    return status_of(exc) in RETRYABLE_STATUS or any(
+        cls.__name__ in RETRYABLE_NAMES for cls in type(exc).__mro__
+    )
+
+
+def is_quota_error(exc):
+    return status_of(exc) == 429 or type(exc).__name__ in QUOTA_NAMES
+
+
+def estimate_tokens(text, expected_output=1024):
+    # Roughly four characters per token for English text
+    return len(text) // 4 + expected_output
+
+
+class Deadline:
+    def __init__(self, seconds):
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return self.expires - time.monotonic()
+
+    def check(self):
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded("Model call deadline exceeded")
+        return remaining
+
+
+class TokenBucket:
+    """Token bucket whose refill rate backs off on quota errors (AIMD)."""
+
+    def __init__(self, per_minute, min_fraction=0.1):
+        self.max_rate = per_minute / 60.0
+        self.rate = self.max_rate
+        self.min_rate = self.max_rate * min_fraction
+        self.capacity = float(per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount):
+        """Take ``amount`` tokens and return how long the caller must wait first."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= min(amount, self.capacity)
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self, amount):
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    def penalize(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def reward(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+
+class CircuitBreaker:
+    """Opens after repeated upstream failures and lets one probe call through after ``reset_timeout``.
+
+    A probe that neither succeeds nor fails within ``probe_timeout``, e.g.
+    one lost to a crash, counts as failed, so the breaker opens again
+    instead of staying half open.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, probe_timeout=90.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probe_timeout = probe_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.state = "closed"
+        self._probe = 0
+        self._probe_started = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if self.state != "open":
+            logging.warning("Opening circuit breaker for Gemini calls")
+        self.state = "open"
+        self.opened_at = time.monotonic()
+
+    def before_call(self):
+        """Admit a call or raise ``CircuitOpenError``; return the probe id when the call is the probe."""
+        with self._lock:
+            if self.state == "half_open" and time.monotonic() - self._probe_started >= self.probe_timeout:
+                logging.warning("Circuit breaker probe never finished, treating it as failed")
+                self._open()
+            if self.state == "open":
+                waited = time.monotonic() - self.opened_at
+                if waited < self.reset_timeout:
+                    raise CircuitOpenError("Gemini is temporarily unavailable, please try again shortly",
+                                           retry_after=self.reset_timeout - waited)
+                # Let a single probe through
+                self.state = "half_open"
+                self._probe += 1
+                self._probe_started = time.monotonic()
+                return self._probe
+            elif self.state == "half_open":
+                raise CircuitOpenError("Gemini is recovering, please try again shortly", retry_after=1.0)
+            return None
+
+    def settle(self, probe, delivered):
+        """Close or reopen for a probe that ended without recording an outcome, e.g. when it was cancelled.
+
+        ``delivered`` is ``None`` for a probe that never reached the API;
+        the next call may then probe straight away.
+        """
+        with self._lock:
+            if probe is None or self.state != "half_open" or probe != self._probe:
+                return
+            if delivered is None:
+                self.state = "open"
+            elif delivered:
+                self.failures = 0
+                self.state = "closed"
+            else:
+                self.failures += 1
+                self._open()
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.state = "closed"
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self._open()
+
+
+class CallGuard:
+    def __init__(self, rpm=None, tpm=None, max_retries=None, deadline=None,
+                 base_delay=0.5, max_delay=20.0, breaker=None):
+        self.requests = TokenBucket(rpm or int(os.environ.get("GEMINI_RPM", "2000")))
+        self.tokens = TokenBucket(tpm or int(os.environ.get("GEMINI_TPM", "4000000")))
+        self.max_retries = int(os.environ.get("GEMINI_MAX_RETRIES", "4")) if max_retries is None else max_retries
+        self.deadline = deadline or float(os.environ.get("GEMINI_CALL_DEADLINE", "90"))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker or CircuitBreaker(probe_timeout=self.deadline)
+        self.stats = {"calls": 0, "retries": 0, "failures": 0, "rejected": 0, "throttled_seconds": 0.0}
+
+    def _admit(self, estimated_tokens, deadline):
+        """Reserve rate-limit budget; return the wait before the call may start and the breaker probe id."""
+        try:
+            probe = self.breaker.before_call()
+        except CircuitOpenError:
+            self.stats["rejected"] += 1
+            raise
+        wait = max(self.requests.reserve(1), self.tokens.reserve(estimated_tokens))
+        if wait >= deadline.remaining():
+            self.requests.refund(1)
+            self.tokens.refund(estimated_tokens)
+            self.stats["rejected"] += 1
+            self.breaker.settle(probe, None)
+            raise CallRejected("Rate limit reached, please try again shortly", retry_after=wait)
+        self.stats["throttled_seconds"] += wait
+        return wait, probe
+
+    def _backoff(self, attempt, deadline):
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+        if delay >= deadline.remaining():
+            return None
+        return delay
+
+    def _on_error(self, exc, attempt, deadline):
+        """Record a failure; return the retry delay or ``None`` to give up."""
+        self.stats["failures"] += 1
+        if is_quota_error(exc):
+            # Quota errors mean we are too fast, not that the upstream is down
+            self.requests.penalize()
+            self.tokens.penalize()
+            self.breaker.record_success()
+        elif is_retryable(exc):
+            self.breaker.record_failure()
+        else:
+            # Bad requests say nothing about upstream health
+            self.breaker.record_success()
+            return None
+        if attempt >= self.max_retries:
+            return None
+        delay = self._backoff(attempt, deadline)
+        if delay is not None:
+            self.stats["retries"] += 1
+            logging.warning(f"Retrying Gemini call in {delay:.2f}s after: {exc}")
+        return delay
+
+    def _on_success(self):
+        self.breaker.record_success()
+        self.requests.reward()
+        self.tokens.reward()
+
+    def call(self, fn, estimated_tokens, deadline=None):
+        """Run ``fn(timeout)`` under the limiter, retry policy and breaker."""
+        deadline = Deadline(deadline or self.deadline)
+        self.stats["calls"] += 1
+        attempt = 0
+        probe = None
+        try:
+            while True:
+                wait, probe = self._admit(estimated_tokens, deadline)
+                time.sleep(wait)
+                try:
+                    result = fn(deadline.check())
+                except Exception as e:
+                    delay = self._on_error(e, attempt, deadline)
+                    if delay is None:
+                        raise
+                    time.sleep(delay)
+                    attempt += 1
+                    continue
+                self._on_success()
+                return result
+        finally:
+            # Only does anything when the probe ended without an outcome, e.g. on KeyboardInterrupt
+            self.breaker.settle(probe, False)
+
+    async def acall(self, fn, estimated_tokens, deadline=None):
+        """Async ``call``; ``fn(timeout)`` returns an awaitable."""
+        deadline = Deadline(deadline or self.deadline)
+        self.stats["calls"] += 1
+        attempt = 0
+        probe = None
+        try:
+            while True:
+                wait, probe = self._admit(estimated_tokens, deadline)
+                await asyncio.sleep(wait)
+                try:
+                    result = await asyncio.wait_for(fn(deadline.check()), timeout=deadline.remaining())
+                except asyncio.TimeoutError:
+                    raise DeadlineExceeded("Model call deadline exceeded")
+                except Exception as e:
+                    delay = self._on_error(e, attempt, deadline)
+                    if delay is None:
+                        raise
+                    await asyncio.sleep(delay)
+                    attempt += 1
+                    continue
+                self._on_success()
+                return result
+        finally:
+            # A probe that timed out or was cancelled, e.g. as a losing hedge, failed
+            self.breaker.settle(probe, False)
+
+    def stream(self, open_stream, estimated_tokens, deadline=None):
+        """Yield from ``open_stream(timeout)``, retrying only until the first chunk arrives."""
+        deadline = Deadline(deadline or self.deadline)
+        self.stats["calls"] += 1
+        attempt = 0
+        probe = None
+        delivered = False
+        try:
+            while True:
+                wait, probe = self._admit(estimated_tokens, deadline)
+                time.sleep(wait)
+                try:
+                    chunks = iter(open_stream(deadline.check()))
+                    first = next(chunks, None)
+                except Exception as e:
+                    delay = self._on_error(e, attempt, deadline)
+                    if delay is None:
+                        raise
+                    time.sleep(delay)
+                    attempt += 1
+                    continue
+                break
+            if first is not None:
+                delivered = True
+                yield first
+            try:
+                yield from chunks
+            except Exception as e:
+                self._on_error(e, self.max_retries, deadline)
+                raise
+            self._on_success()
+        finally:
+            # A probe stream closed early, e.g. at the word limit, succeeded if it delivered anything
+            self.breaker.settle(probe, delivered)
+
+    async def astream(self, open_stream, estimated_tokens, deadline=None):
+        """Async ``stream``; ``open_stream(timeout)`` returns an async iterator."""
+        deadline = Deadline(deadline or self.deadline)
+        self.stats["calls"] += 1
+        attempt = 0
+        probe = None
+        delivered = False
+        try:
+            while True:
+                wait, probe = self._admit(estimated_tokens, deadline)
+                await asyncio.sleep(wait)
+                chunks = open_stream(deadline.check()).__aiter__()
+                try:
+                    first = await asyncio.wait_for(chunks.__anext__(), timeout=deadline.remaining())
+                except StopAsyncIteration:
+                    first = None
+                except asyncio.TimeoutError:
+                    raise DeadlineExceeded("Model call deadline exceeded")
+                except Exception as e:
+                    delay = self._on_error(e, attempt, deadline)
+                    if delay is None:
+                        raise
+                    await asyncio.sleep(delay)
+                    attempt += 1
+                    continue
+                break
+            if first is not None:
+                delivered = True
+                yield first
+                try:
+                    async for chunk in chunks:
+                        yield chunk
+                except Exception as e:
+                    self._on_error(e, self.max_retries, deadline)
+                    raise
+            self._on_success()
+        finally:
+            # Closed early, cancelled or timed out: a probe succeeded if it delivered anything
+            self.breaker.settle(probe, delivered)
+
+
+_guard = None
+_guard_lock = threading.Lock()
+
+
+def get_call_guard():
+    global _guard
+    if _guard is None:
+        with _guard_lock:
+            if _guard is None:
+                _guard = CallGuard()
+    return _guard
@@ -0,0 +1,258 @@
+"""Priority scheduling of model calls with per-user fairness and load shedding.
+
+Every model call that misses the response cache takes one of
+``SCHEDULER_SLOTS`` slots before it reaches the call guard, and holds it
+until the response (or the last streamed chunk) has arrived. When the slots
+are busy, calls wait in priority order: interactive requests from the apps
+and server.py ahead of batch jobs. Within a class the waiting users take
+turns, so one user with many queued calls cannot starve the others.
+
+Queues are bounded. A call is rejected at once with ``CallRejected`` and a
+retry-after estimate when its class queue or its user's share of it is
+full, or when the expected wait would outlast the call deadline, instead of
+waiting until it times out. Queue waits and shed calls are recorded in
+``metrics``.
+
+Slots are per process, like the call guard's rate limits. So that batch.py
+running next to the app also yields, a process whose interactive calls have
+to queue touches a marker file, and batch calls in any process on the host
+then use at most ``SCHEDULER_BATCH_SHARE`` of their slots.
+
+Tunables (environment)::
+
+    SCHEDULER_SLOTS             model calls in flight per process (32)
+    SCHEDULER_MAX_QUEUE         waiting calls per priority class (256)
+    SCHEDULER_MAX_USER_QUEUE    waiting calls per user and class (32)
+    SCHEDULER_BATCH_SHARE       share of slots batch calls keep under interactive load (0.25)
+    SCHEDULER_DIR               directory of the interactive load marker (.cache/scheduler)
+"""
+import asyncio
+import contextlib
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+from metrics import get_metrics
+from resilience import CallRejected, DeadlineExceeded
+
+# Classes in order of precedence
+PRIORITIES = ("interactive", "batch")
+
+DEFAULT_SLOTS = int(os.environ.get("SCHEDULER_SLOTS", "32"))
+DEFAULT_MAX_QUEUE = int(os.environ.get("SCHEDULER_MAX_QUEUE", "256"))
+DEFAULT_MAX_USER_QUEUE = int(os.environ.get("SCHEDULER_MAX_USER_QUEUE", "32"))
+DEFAULT_BATCH_SHARE = float(os.environ.get("SCHEDULER_BATCH_SHARE", "0.25"))
+DEFAULT_STATE_DIR = os.environ.get("SCHEDULER_DIR", os.path.join(".cache", "scheduler"))
+
+# Seconds the interactive load marker stays in effect after its last touch
+PRESSURE_WINDOW = 5.0
+
+
+class _Waiter:
+    __slots__ = ("priority", "user", "notify", "granted")
+
+    def __init__(self, priority, user, notify):
+        self.priority = priority
+        self.user = user
+        self.notify = notify
+        self.granted = False
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class Scheduler:
+    def __init__(self, slots=DEFAULT_SLOTS, max_queue=DEFAULT_MAX_QUEUE, max_user_queue=DEFAULT_MAX_USER_QUEUE,
+                 batch_share=DEFAULT_BATCH_SHARE, state_dir=DEFAULT_STATE_DIR):
+        os.makedirs(state_dir, exist_ok=True)
+        self.slots = slots
+        self.max_queue = max_queue
+        self.max_user_queue = max_user_queue
+        self.batch_share = batch_share
+        self.marker = os.path.join(state_dir, "interactive-busy")
+        # Per class, user -> waiting calls; the first user in line is served next and moves to the back
+        self._queues = {priority: OrderedDict() for priority in PRIORITIES}
+        self._depth = dict.fromkeys(PRIORITIES, 0)
+        self._running = dict.fromkeys(PRIORITIES, 0)
+        # Moving average of how long a call holds its slot, for retry-after estimates
+        self._service_seconds = 2.0
+        self._pressure = (0.0, False)
+        self._marked = 0.0
+        self._lock = threading.Lock()
+        self.stats = {"admitted": 0, "queued": 0, "rejected": 0, "wait_seconds": 0.0}
+
+    def _interactive_pressure(self):
+        """Whether interactive calls anywhere on the host had to queue recently; checked twice a second."""
+        now = time.monotonic()
+        checked, busy = self._pressure
+        if now - checked > 0.5:
+            try:
+                busy = time.time() - os.path.getmtime(self.marker) < PRESSURE_WINDOW
+            except OSError:
+                busy = False
+            self._pressure = (now, busy)
+        return busy
+
+    def _mark_pressure(self):
+        now = time.monotonic()
+        if now - self._marked < 1.0:
+            return
+        self._marked = now
+        try:
+            with open(self.marker, "a"):
+                os.utime(self.marker)
+        except OSError:
+            pass
+
+    def _limit(self, priority):
+        if priority == "batch" and self.batch_share < 1 and self._interactive_pressure():
+            return max(1, int(self.slots * self.batch_share))
+        return self.slots
+
+    def _can_run(self, priority):
+        return sum(self._running.values()) < self.slots and self._running[priority] < self._limit(priority)
+
+    def _expected_wait(self, ahead):
+        # The calls ahead are served ``slots`` at a time
+        return (ahead // self.slots + 1) * self._service_seconds
+
+    def _enter(self, priority, user, notify, timeout):
+        """Take a slot now and return ``None``, or queue and return a waiter; raise ``CallRejected`` to shed."""
+        if priority not in self._queues:
+            raise ValueError(f"Unknown priority: {priority}")
+        reason = None
+        with self._lock:
+            ahead = sum(self._depth[p] for p in PRIORITIES[:PRIORITIES.index(priority) + 1])
+            if not ahead and self._can_run(priority):
+                self._running[priority] += 1
+                self.stats["admitted"] += 1
+                return None
+            users = self._queues[priority]
+            retry_after = self._expected_wait(ahead)
+            if self._depth[priority] >= self.max_queue:
+                reason = "queue_full"
+            elif len(users.get(user, ())) >= self.max_user_queue:
+                reason = "user_queue_full"
+            elif retry_after >= timeout:
+                reason = "wait_too_long"
+            else:
+                waiter = _Waiter(priority, user, notify)
+                users.setdefault(user, deque()).append(waiter)
+                self._depth[priority] += 1
+                self.stats["queued"] += 1
+            if reason:
+                self.stats["rejected"] += 1
+        if reason:
+            get_metrics().inc("prompt_shed_total", priority=priority, reason=reason)
+            raise CallRejected(f"Too many requests are waiting for the model, please try again in "
+                               f"{math.ceil(retry_after)}s", retry_after=retry_after)
+        if priority == "interactive":
+            self._mark_pressure()
+        return waiter
+
+    def _grant_waiting(self):
+        """Hand free slots to the next waiters; call with the lock held and notify them after releasing it."""
+        granted = []
+        for priority in PRIORITIES:
+            users = self._queues[priority]
+            while users and self._can_run(priority):
+                user, waiters = next(iter(users.items()))
+                waiter = waiters.popleft()
+                if waiters:
+                    users.move_to_end(user)
+                else:
+                    del users[user]
+                self._depth[priority] -= 1
+                self._running[priority] += 1
+                self.stats["admitted"] += 1
+                waiter.granted = True
+                granted.append(waiter)
+        return granted
+
+    def _release(self, priority, held=None):
+        with self._lock:
+            self._running[priority] -= 1
+            if held is not None:
+                self._service_seconds += 0.2 * (held - self._service_seconds)
+            granted = self._grant_waiting()
+        for waiter in granted:
+            waiter.notify()
+
+    def _abandon(self, waiter):
+        """Withdraw a waiter that gave up; a slot granted to it in the meantime is passed on."""
+        with self._lock:
+            if not waiter.granted:
+                waiters = self._queues[waiter.priority].get(waiter.user)
+                if waiters and waiter in waiters:
+                    waiters.remove(waiter)
+                    self._depth[waiter.priority] -= 1
+                    if not waiters:
+                        del self._queues[waiter.priority][waiter.user]
+                return
+        self._release(waiter.priority)
+
+    def _waited(self, priority, seconds):
+        with self._lock:
+            self.stats["wait_seconds"] += seconds
+        get_metrics().observe("prompt_queue_wait_seconds", seconds, priority=priority)
+
+    @contextlib.contextmanager
+    def slot(self, priority="interactive", user=None, timeout=90.0):
+        """Hold a call slot for the duration of the block, waiting at most ``timeout`` for it."""
+        started = time.monotonic()
+        event = threading.Event()
+        waiter = self._enter(priority, user, event.set, timeout)
+        if waiter is not None and not event.wait(timeout):
+            self._abandon(waiter)
+            raise DeadlineExceeded("Timed out waiting for a model call slot")
+        self._waited(priority, time.monotonic() - started)
+        held = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(priority, time.monotonic() - held)
+
+    @contextlib.asynccontextmanager
+    async def aslot(self, priority="interactive", user=None, timeout=90.0):
+        """Async ``slot``."""
+        started = time.monotonic()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = self._enter(priority, user, lambda: loop.call_soon_threadsafe(_resolve, future), timeout)
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                self._abandon(waiter)
+                raise DeadlineExceeded("Timed out waiting for a model call slot")
+            except asyncio.CancelledError:
+                self._abandon(waiter)
+                raise
+        self._waited(priority, time.monotonic() - started)
+        held = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(priority, time.monotonic() - held)
+
+    def snapshot(self):
+        """Return ``{priority: (running, waiting)}``."""
+        with self._lock:
+            return {priority: (self._running[priority], self._depth[priority]) for priority in PRIORITIES}
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = Scheduler()
+    return _scheduler
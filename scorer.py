@@ -0,0 +1,301 @@
+"""Instant local scoring of prompts, no model call involved.
+
+Scores the same dimensions the evaluate instruction asks the model about
+(clarity, specificity, structure, tone) on a 0-10 scale from plain text
+features: length, sentence shape, readability, and the presence of
+constraints, examples, sections and tone/audience cues. Feature extraction
+and scoring are vectorized over the whole batch with NumPy, so
+``score_prompts`` handles tens of thousands of prompts per second.
+
+The score is a cheap first pass; the model's critique stays available for
+anything it cannot see, such as whether the request makes sense. It also
+ranks several generated candidates for one request, together with how well
+each fits the requested word range.
+"""
+import re
+from collections import namedtuple
+
+import numpy as np
+
+from budget import word_range
+
+SCORE_DIMENSIONS = ("clarity", "specificity", "structure", "tone")
+
+LocalScore = namedtuple("LocalScore", ["overall", "clarity", "specificity", "structure", "tone", "suggestions"])
+# ``rank`` combines the overall score with ``fit``, the share of the word limit met (1 inside the range)
+RankedCandidate = namedtuple("RankedCandidate", ["index", "rank", "overall", "words", "fit"])
+
+SECTION_RE = re.compile(r"^\s*(?:#+\s|[-*•]\s|\d+[.)]\s|[A-Z][\w ]{1,30}:)", re.M)
+
+# Keyword vocabularies, matched as whole lowercase words or two-word phrases
+CONSTRAINT_WORDS = ("must", "should", "avoid", "don't", "never", "only", "exactly", "limit", "limited", "within",
+                    "maximum", "minimum", "include", "exclude", "require", "requires", "required")
+CONSTRAINT_PHRASES = ("do not", "at least", "at most", "no more")
+EXAMPLE_WORDS = ("example", "examples", "sample", "samples")
+EXAMPLE_PHRASES = ("for instance", "such as", "e g", "like this")
+TONE_WORDS = ("tone", "style", "voice", "audience", "formal", "informal", "friendly", "professional", "casual",
+              "persuasive", "concise", "detailed", "beginner", "beginners", "expert", "role")
+TONE_PHRASES = ("act as", "you are")
+VAGUE_WORDS = ("something", "stuff", "thing", "things", "etc", "some", "good", "nice", "whatever", "anything")
+VAGUE_PHRASES = ("kind of", "sort of")
+IMPERATIVE_WORDS = ("write", "create", "generate", "explain", "describe", "list", "summarize", "summarise", "draft",
+                    "design", "build", "compare", "analyze", "analyse", "give", "provide", "make", "translate",
+                    "rewrite", "outline", "suggest", "help", "tell", "find")
+
+# Column order of the feature matrix
+FEATURES = ("words", "sentences", "long_words", "chars", "numbers", "constraints", "examples",
+            "sections", "lines", "tone", "vague", "imperative", "questions")
+
+SUGGESTIONS = {
+    "clarity": "Use shorter sentences and open with a direct instruction (e.g. \"Write...\", \"Explain...\").",
+    "specificity": "Add concrete details: constraints, numbers, the expected length or format, and an example.",
+    "structure": "Break the prompt into sections or a bulleted list (context, task, constraints, output format).",
+    "tone": "State the intended audience, tone or role (e.g. \"for beginners\", \"in a formal tone\").",
+}
+
+
+# Prompts are scored as one joined string; the separator holds no word characters
+SEPARATOR = "\n\x00\n"
+WORD_CHARS = np.zeros(128, dtype=bool)
+for char in "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'":
+    WORD_CHARS[ord(char)] = True
+
+# Words are compared by a polynomial hash modulo 2**64, which NumPy computes
+# for every word at once from prefix sums over the code points
+HASH_BASE = 0x100000001B3
+HASH_MASK = (1 << 64) - 1
+HASH_INVERSE = pow(HASH_BASE, -1, 1 << 64)
+PAIR_FACTOR = np.uint64(0x9E3779B97F4A7C15)
+
+
+def word_hash(word):
+    return sum(ord(char) * pow(HASH_BASE, i, 1 << 64) for i, char in enumerate(word)) & HASH_MASK
+
+
+def vocabulary(words, phrases=()):
+    """Return ``(word_hashes, pair_hashes)`` for a keyword list, as uint64 arrays."""
+    pairs = []
+    for phrase in phrases:
+        first, second = phrase.split()
+        pairs.append((word_hash(first) * int(PAIR_FACTOR) + word_hash(second)) & HASH_MASK)
+    return (np.array([word_hash(word) for word in words], dtype=np.uint64),
+            np.array(pairs, dtype=np.uint64))
+
+
+CONSTRAINTS = vocabulary(CONSTRAINT_WORDS, CONSTRAINT_PHRASES)
+EXAMPLES = vocabulary(EXAMPLE_WORDS, EXAMPLE_PHRASES)
+TONE = vocabulary(TONE_WORDS, TONE_PHRASES)
+VAGUE = vocabulary(VAGUE_WORDS, VAGUE_PHRASES)
+IMPERATIVE = vocabulary(IMPERATIVE_WORDS)[0]
+PLEASE = word_hash("please")
+
+
+def lower_same_length(text):
+    """``text.lower()``, except characters whose lowercase is longer ("İ") are kept as they are.
+
+    Code point offsets must survive lowercasing, since each prompt's slice of
+    the joined text is located by offsets computed on the original.
+    """
+    lowered = text.lower()
+    if len(lowered) == len(text):
+        return lowered
+    return "".join(char if len(low) != 1 else low for char, low in ((char, char.lower()) for char in text))
+
+
+def powers(base, count):
+    result = np.ones(count, dtype=np.uint64)
+    if count > 1:
+        result[1:] = np.cumprod(np.full(count - 1, base, dtype=np.uint64))
+    return result
+
+
+def extract_features(prompts):
+    """Return a ``(len(prompts), len(FEATURES))`` float32 feature matrix.
+
+    All prompts are joined and scanned together: character classes, word
+    boundaries and word hashes come from array operations over the code
+    points, and keyword counts from matching those hashes against small
+    vocabularies, so there is no per-word Python work.
+    """
+    prompts = list(prompts)
+    n = len(prompts)
+    if not n:
+        return np.zeros((0, len(FEATURES)), dtype=np.float32)
+    text = SEPARATOR.join(prompts)
+    lengths = np.fromiter(map(len, prompts), dtype=np.int64, count=n)
+    starts = np.zeros(n, dtype=np.int64)
+    starts[1:] = np.cumsum(lengths + len(SEPARATOR))[:-1]
+
+    def owner(positions):
+        return np.searchsorted(starts, positions, side="right") - 1
+
+    def per_prompt(positions, weights=None):
+        return np.bincount(owner(positions), weights=weights, minlength=n)
+
+    codes = np.frombuffer(lower_same_length(text).encode("utf-32-le"), dtype=np.uint32)
+    is_word = (codes >= 128) | WORD_CHARS[np.minimum(codes, 127)]
+    prev_word = np.concatenate([[False], is_word[:-1]])
+    next_word = np.concatenate([is_word[1:], [False]])
+    word_starts = np.flatnonzero(is_word & ~prev_word)
+    word_ends = np.flatnonzero(is_word & ~next_word) + 1
+    word_lengths = word_ends - word_starts
+    word_owners = owner(word_starts)
+
+    # hash(text[s:e]) == (prefix[e] - prefix[s]) * BASE**-s, all modulo 2**64
+    with np.errstate(over="ignore"):
+        prefix = np.zeros(len(codes) + 1, dtype=np.uint64)
+        np.cumsum(codes.astype(np.uint64) * powers(HASH_BASE, len(codes)), out=prefix[1:])
+        hashes = (prefix[word_ends] - prefix[word_starts]) * powers(HASH_INVERSE, len(codes))[word_starts]
+        pairs = hashes[:-1] * PAIR_FACTOR + hashes[1:]
+    same_prompt = word_owners[:-1] == word_owners[1:]
+
+    def keywords(vocab):
+        words, phrases = vocab
+        counts = np.bincount(word_owners[np.isin(hashes, words)], minlength=n)
+        if len(phrases):
+            counts += np.bincount(word_owners[:-1][same_prompt & np.isin(pairs, phrases)], minlength=n)
+        return counts
+
+    # Leading word of each prompt, skipping a polite "please"
+    imperative = np.zeros(n, dtype=bool)
+    if len(word_starts):
+        prompt_ids = np.arange(n)
+        first = np.minimum(np.searchsorted(word_starts, starts), len(word_starts) - 1)
+        second = np.minimum(first + 1, len(word_starts) - 1)
+        lead = np.where((hashes[first] == np.uint64(PLEASE)) & (word_owners[second] == prompt_ids),
+                        hashes[second], hashes[first])
+        imperative = (word_owners[first] == prompt_ids) & np.isin(lead, IMPERATIVE)
+
+    is_digit = (codes >= 48) & (codes <= 57)
+    is_space = (codes == 32) | ((codes >= 9) & (codes <= 13))
+    is_end = (codes == 46) | (codes == 33) | (codes == 63)
+    next_code = np.concatenate([codes[1:], [10]])
+    next_space = np.concatenate([is_space[1:], [True]])
+    inside = np.ones(len(codes), dtype=bool)
+    if n > 1:
+        inside[(starts[1:, None] - len(SEPARATOR) + np.arange(len(SEPARATOR))).ravel()] = False
+    # A sentence ends at punctuation followed by whitespace, or at a blank line
+    boundaries = np.flatnonzero(((is_end & next_space) | ((codes == 10) & (next_code == 10))) & inside)
+    # Text after the last full stop still counts as a sentence
+    unterminated = np.array([prompt.rstrip()[-1:] not in (".", "!", "?", "") for prompt in prompts])
+    sections = np.fromiter((m.start() for m in SECTION_RE.finditer(text)), dtype=np.int64)
+
+    columns = {
+        "words": np.bincount(word_owners, minlength=n),
+        "sentences": np.maximum(per_prompt(boundaries) + unterminated, 1),
+        "long_words": np.bincount(word_owners[word_lengths > 6], minlength=n),
+        "chars": np.bincount(word_owners, weights=word_lengths, minlength=n),
+        "numbers": per_prompt(np.flatnonzero(is_digit & ~prev_word)),
+        "constraints": keywords(CONSTRAINTS),
+        # Quoted passages count as examples too
+        "examples": keywords(EXAMPLES) + per_prompt(np.flatnonzero(codes == 34)) // 2,
+        "sections": per_prompt(sections),
+        "lines": per_prompt(np.flatnonzero((codes == 10) & inside)) + 1,
+        "tone": keywords(TONE),
+        "vague": keywords(VAGUE),
+        "imperative": imperative,
+        "questions": per_prompt(np.flatnonzero(codes == 63)),
+    }
+    return np.column_stack([columns[name] for name in FEATURES]).astype(np.float32)
+
+
+def saturate(count, scale):
+    # Credit for a feature count: 0 at none, approaching 1 as it grows
+    return 1 - np.exp(-count / scale)
+
+
+def score_features(features):
+    """Return a ``(n, 5)`` array of overall, clarity, specificity, structure and tone scores."""
+    f = {name: features[:, i] for i, name in enumerate(FEATURES)}
+    words = np.maximum(f["words"], 1)
+    sentence_length = words / f["sentences"]
+    word_length = f["chars"] / words
+    long_ratio = f["long_words"] / words
+    vague_ratio = f["vague"] / words
+
+    # Length: too short to say much, or so long it buries the request
+    length_fit = np.clip(np.log1p(words) / np.log1p(40), 0, 1) - np.clip((words - 600) / 1200, 0, 0.3)
+
+    clarity = (
+        4.0 * length_fit
+        + 2.5 * np.clip(1 - np.abs(sentence_length - 15) / 20, 0, 1)
+        + 1.5 * np.clip(1 - (word_length - 5) / 4, 0, 1) * np.clip(1 - (long_ratio - 0.3) * 2, 0, 1)
+        + 1.5 * f["imperative"]
+        + 0.5 * np.minimum(f["questions"], 1)
+        - 6.0 * vague_ratio
+    )
+    specificity = (
+        3.0 * length_fit
+        + 3.0 * saturate(f["constraints"], 2)
+        + 2.0 * saturate(f["examples"], 1)
+        + 1.0 * saturate(f["numbers"], 1)
+        + 1.0 * np.clip(long_ratio * 3, 0, 1)
+        - 8.0 * vague_ratio
+    )
+    structure = (
+        2.0 * np.clip(np.log1p(words) / np.log1p(20), 0, 1)
+        + 2.5 * saturate(f["sentences"] - 1, 2)
+        + 3.5 * saturate(f["sections"], 2)
+        + 2.0 * saturate(f["lines"] - 1, 3)
+    )
+    tone = (
+        4.0 * length_fit
+        + 4.5 * saturate(f["tone"], 1.5)
+        + 1.5 * f["imperative"]
+        - 4.0 * vague_ratio
+    )
+
+    scores = np.clip(np.stack([clarity, specificity, structure, tone], axis=1), 0, 10)
+    return np.round(np.column_stack([scores.mean(axis=1), scores]), 1)
+
+
+def score_prompts(prompts):
+    """Score a batch of prompts; see ``score_features`` for the columns."""
+    return score_features(extract_features(prompts))
+
+
+def score_prompt(prompt):
+    """Return a ``LocalScore`` for one prompt, with suggestions for its weakest dimensions."""
+    row = score_prompts([prompt])[0]
+    dimensions = dict(zip(SCORE_DIMENSIONS, row[1:].tolist()))
+    suggestions = [SUGGESTIONS[name] for name, value in sorted(dimensions.items(), key=lambda item: item[1])
+                   if value < 6]
+    return LocalScore(float(row[0]), suggestions=suggestions, **dimensions)
+
+
+def word_limit_fit(words, low, high):
+    # 1 inside the range, falling linearly to 0 at half the range's bound away from it
+    words = np.asarray(words, dtype=float)
+    below = np.clip((low - words) / (low * 0.5), 0, 1)
+    above = np.clip((words - high) / (high * 0.5), 0, 1)
+    return 1 - np.maximum(below, above)
+
+
+def rank_candidates(texts, word_limit_context=None, length_weight=0.4):
+    """Return a ``RankedCandidate`` per text, best first.
+
+    Candidates are ranked on the overall local score, weighted with
+    ``length_weight`` against compliance with the word limit when one is given.
+    """
+    features = extract_features(texts)
+    overall = score_features(features)[:, 0]
+    words = features[:, FEATURES.index("words")]
+    limits = word_range(word_limit_context)
+    if limits:
+        fit = word_limit_fit(words, *limits)
+        rank = (1 - length_weight) * overall / 10 + length_weight * fit
+    else:
+        fit = np.ones(len(texts))
+        rank = overall / 10
+    # Stable on ties, so the earlier candidate wins
+    order = sorted(range(len(texts)), key=lambda i: -rank[i])
+    return [RankedCandidate(i, round(float(rank[i]), 3), float(overall[i]), int(words[i]), round(float(fit[i]), 3))
+            for i in order]
+
+
+def format_local_score(score):
+    lines = [f"Overall: {score.overall}/10"]
+    lines += [f"{name.capitalize()}: {getattr(score, name)}/10" for name in SCORE_DIMENSIONS]
+    if score.suggestions:
+        lines.append("Suggestions:\n" + "\n".join(f"- {item}" for item in score.suggestions))
+    return "\n\n".join(lines)
@@ -0,0 +1,258 @@
+"""Async HTTP backend for the HTML front end in templates/.
+
+Serves the pages and the ``/refine`` and ``/evaluate`` endpoints that
+templates/index.html calls. Both endpoints answer with JSON, or with
+Server-Sent Events when the client sends ``Accept: text/event-stream``.
+Request metrics are served at ``/metrics`` in the Prometheus format.
+Run with::
+
+    uvicorn server:app --workers 4 --timeout-keep-alive 75
+"""
+import contextlib
+import json
+import logging
+import os
+import time
+
+import httpx
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+from starlette.templating import Jinja2Templates
+
+from budget import budget_for
+from cache import make_cache_key
+from clients import get_registry, route_model
+from gemini_rest import GeminiError
+from history import get_history
+from llm import agenerate, astream_text
+from metrics import CONTENT_TYPE, get_metrics
+from prompts import (StreamCleaner, build_evaluate_instruction, build_refine_instruction, clean_output,
+                     resolve_word_limit)
+from resilience import CallRejected, DeadlineExceeded
+
+logging.basicConfig(level=logging.INFO)
+
+# Failures of the upstream model call, as opposed to bad requests
+UPSTREAM_ERRORS = (GeminiError, httpx.HTTPError, CallRejected, DeadlineExceeded)
+
+templates = Jinja2Templates(directory=os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates"))
+
+
+def page(template_name):
+    async def endpoint(request):
+        return templates.TemplateResponse(request, template_name)
+    return endpoint
+
+
+def bad_request(message):
+    return JSONResponse({"error": message}, status_code=400)
+
+
+async def read_prompt(request):
+    """Return ``(data, error)``; ``data["prompt"]`` is the stripped prompt."""
+    try:
+        data = await request.json()
+    except ValueError:
+        return None, bad_request("Request body must be JSON")
+    if not isinstance(data, dict):
+        return None, bad_request("Request body must be a JSON object")
+    prompt = data.get("prompt")
+    if prompt is not None and not isinstance(prompt, str):
+        return None, bad_request("Prompt must be a string")
+    prompt = (prompt or "").strip()
+    if not prompt:
+        return None, bad_request("Prompt cannot be empty")
+    return dict(data, prompt=prompt), None
+
+
+def requester(request):
+    # The scheduler takes turns between users; the front end has no accounts, so clients stand in for them
+    return request.headers.get("x-user-id") or (request.client.host if request.client else None)
+
+
+def wants_stream(request, data):
+    return "text/event-stream" in request.headers.get("accept", "") or bool(data.get("stream"))
+
+
+def sse_event(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+def log_failure(e, action):
+    if isinstance(e, UPSTREAM_ERRORS):
+        logging.error(f"{action} failed: {e}")
+    else:
+        logging.exception(f"{action} failed unexpectedly")
+
+
+def error_message(e):
+    # Upstream failures are explained to the client; anything else is a bug on this side
+    return f"Error: {e}" if isinstance(e, UPSTREAM_ERRORS) else "Error: internal server error"
+
+
+async def sse_stream(chunks, field, on_done=None, trace=None):
+    # Clean each chunk as it arrives so the first token reaches the browser immediately
+    cleaner = StreamCleaner()
+    pieces = []
+    error = None
+    try:
+        with trace.stage("generate") if trace else contextlib.nullcontext():
+            async for chunk in chunks:
+                piece = cleaner.feed(chunk)
+                if piece:
+                    pieces.append(piece)
+                    yield sse_event({"text": piece})
+        if on_done:
+            on_done("".join(pieces))
+    except Exception as e:
+        error = e
+        log_failure(e, f"Streaming {field}")
+        yield sse_event({"error": error_message(e)}, event="error")
+        return
+    finally:
+        if trace:
+            trace.finish(error)
+    yield sse_event({}, event="done")
+
+
+def error_response(e):
+    if isinstance(e, CallRejected):
+        return JSONResponse({"error": error_message(e)}, status_code=503,
+                            headers={"Retry-After": str(max(1, round(e.retry_after)))})
+    if isinstance(e, DeadlineExceeded):
+        return JSONResponse({"error": error_message(e)}, status_code=504)
+    if isinstance(e, UPSTREAM_ERRORS):
+        return JSONResponse({"error": error_message(e)}, status_code=502)
+    return JSONResponse({"error": error_message(e)}, status_code=500)
+
+
+async def respond(request, data, instruction, cache_key, model_id, field, entry, trace):
+    """Run the call and answer with JSON or SSE.
+
+    ``entry`` describes the request for the history and ``trace`` times its
+    stages; it is finished here once the response is complete.
+    """
+    client = request.app.state.gemini
+    bypass_cache = bool(data.get("bypass_cache"))
+    started = time.perf_counter()
+    # Long refinements are hedged against their own latency history and held to their word limit
+    latency_class = entry.get("word_limit") or entry["kind"]
+    budget = budget_for(entry.get("word_limit"))
+    trace.annotate(model=model_id, stream=wants_stream(request, data))
+
+    def save(output, generation=None):
+        get_history().record(
+            output=output, model_id=model_id, latency=round(time.perf_counter() - started, 3),
+            prompt_tokens=generation.prompt_tokens if generation else None,
+            completion_tokens=generation.completion_tokens if generation else None,
+            owner=requester(request), **entry,
+        )
+
+    if wants_stream(request, data):
+        chunks = astream_text(client, instruction, cache_key=cache_key, bypass_cache=bypass_cache,
+                              model_id=model_id, latency_class=latency_class, user=requester(request),
+                              budget=budget)
+        return StreamingResponse(
+            sse_stream(chunks, field, on_done=save, trace=trace),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    try:
+        with trace.stage("generate"):
+            generation = await agenerate(client, instruction, cache_key=cache_key, bypass_cache=bypass_cache,
+                                         model_id=model_id, latency_class=latency_class, user=requester(request),
+                                         budget=budget)
+        with trace.stage("clean"):
+            output = clean_output(generation.text)
+        save(output, generation)
+    except Exception as e:
+        log_failure(e, f"Request for {field}")
+        trace.finish(e)
+        return error_response(e)
+    trace.annotate(prompt_tokens=generation.prompt_tokens, completion_tokens=generation.completion_tokens,
+                   cached=generation.cached)
+    trace.finish()
+    return JSONResponse({field: output})
+
+
+async def refine(request):
+    data, error = await read_prompt(request)
+    if error:
+        return error
+
+    prompt = data["prompt"]
+    target_model = str(data.get("model") or "ChatGPT")
+    word_limit_context = resolve_word_limit(data.get("max_words", "medium"))
+    tags = data.get("tags") or []
+    if not isinstance(tags, list) or not all(isinstance(tag, str) for tag in tags):
+        return bad_request("Tags must be a list of strings")
+
+    trace = get_metrics().trace("refine", target_model=target_model, word_limit=word_limit_context)
+    with trace.stage("build_instruction"):
+        instruction = build_refine_instruction(prompt, target_model, word_limit_context, tags)
+    model_id = route_model("refine", word_limit_context)
+    cache_key = make_cache_key("refine", prompt, model_id, target_model=target_model,
+                               word_limit=word_limit_context, tags=tags)
+    entry = {"kind": "refine", "prompt": prompt, "target_model": target_model,
+             "word_limit": word_limit_context, "tags": tags}
+    return await respond(request, data, instruction, cache_key, model_id, "refined_output", entry, trace)
+
+
+async def evaluate(request):
+    data, error = await read_prompt(request)
+    if error:
+        return error
+
+    prompt = data["prompt"]
+    trace = get_metrics().trace("evaluate")
+    with trace.stage("build_instruction"):
+        instruction = build_evaluate_instruction(prompt)
+    model_id = route_model("evaluate")
+    cache_key = make_cache_key("evaluate", prompt, model_id)
+    return await respond(request, data, instruction, cache_key, model_id, "evaluation",
+                         {"kind": "evaluate", "prompt": prompt}, trace)
+
+
+async def metrics(request):
+    return Response(get_metrics().render(), media_type=CONTENT_TYPE)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    registry = get_registry()
+    app.state.gemini = registry.rest_client()
+    await registry.awarm()
+    try:
+        yield
+    finally:
+        await registry.aclose()
+
+
+routes = [
+    Route("/", page("index.html")),
+    Route("/learn", page("learn.html")),
+    Route("/about", page("about.html")),
+    Route("/feedback", page("feedback.html")),
+    Route("/techniques/{name}", page("technique.html")),
+    Route("/refine", refine, methods=["POST"]),
+    Route("/evaluate", evaluate, methods=["POST"]),
+    Route("/metrics", metrics),
+]
+
+app = Starlette(
+    routes=routes,
+    middleware=[Middleware(GZipMiddleware, minimum_size=500)],
+    lifespan=lifespan,
+)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run("server:app", host="0.0.0.0", port=int(os.environ.get("PORT", "8000")),
+                timeout_keep_alive=75, workers=int(os.environ.get("WEB_CONCURRENCY", "1")))
@@ -0,0 +1,250 @@
+"""Near-duplicate lookup over previously refined prompts.
+
+Prompts are embedded offline as signed, hashed character-trigram and word
+vectors (no model call), stored as float16 rows in an append-only file, and
+indexed with random-hyperplane LSH. Each band's keys are kept as a sorted
+NumPy array plus a small unsorted tail that is merged once it grows, so
+inserts stay cheap and a lookup is a handful of ``searchsorted`` calls and
+one small matrix-vector product, well under 10ms at millions of rows.
+
+Results are only matched within the same scope (request kind, target model,
+word limit and tags), so a prompt refined for ChatGPT is never offered for
+a Gemini request. The embedding is purely lexical: prompts that differ in
+one word ("include" and "do not include") score close to 1, so matches are
+suggestions, and serving one as the answer is left to an explicit opt-in.
+A prompt that is already indexed in its scope is not added again.
+"""
+import logging
+import os
+import re
+import sqlite3
+import threading
+import zlib
+
+import numpy as np
+
+from cache import normalize_prompt
+from locks import FileLock
+
+DEFAULT_INDEX_DIR = os.environ.get("SIMILARITY_INDEX_DIR", os.path.join(".cache", "similarity"))
+# With reuse turned on, matches at or above REUSE are served as-is; above SUGGEST they are only shown
+REUSE_THRESHOLD = float(os.environ.get("SIMILARITY_REUSE_THRESHOLD", "0.97"))
+SUGGEST_THRESHOLD = float(os.environ.get("SIMILARITY_SUGGEST_THRESHOLD", "0.85"))
+WORD_RE = re.compile(r"\w+")
+
+
+def embed(text, dim=256):
+    """Return an L2-normalized float32 vector for ``text``."""
+    text = normalize_prompt(text).lower()
+    vector = np.zeros(dim, dtype=np.float32)
+    data = np.frombuffer(text.encode("utf-8"), dtype=np.uint8).astype(np.uint32)
+
+    # Character trigrams, hashed in one vectorized pass
+    if len(data) >= 3:
+        h = (data[:-2] * np.uint32(0x9E3779B1)) ^ (data[1:-1] * np.uint32(0x85EBCA77)) ^ (data[2:] * np.uint32(0xC2B2AE3D))
+        h ^= h >> np.uint32(15)
+        signs = np.where(h & np.uint32(1 << 31), -1.0, 1.0).astype(np.float32)
+        vector += np.bincount(h % np.uint32(dim), weights=signs, minlength=dim).astype(np.float32)
+
+    # Whole words carry more meaning than trigrams, so weight them higher
+    for word in WORD_RE.findall(text):
+        h = zlib.crc32(word.encode("utf-8"))
+        vector[h % dim] += 2.0 if h & (1 << 31) else -2.0
+
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def scope_id(scope):
+    return zlib.crc32(scope.encode("utf-8"))
+
+
+class SimilarityIndex:
+    def __init__(self, directory=DEFAULT_INDEX_DIR, dim=256, bands=10, band_bits=12, merge_threshold=4096):
+        os.makedirs(directory, exist_ok=True)
+        self.dim = dim
+        self.bands = bands
+        self.band_bits = band_bits
+        self.merge_threshold = merge_threshold
+        self.vectors_path = os.path.join(directory, "vectors.f16")
+        self.keys_path = os.path.join(directory, "bands.u16")
+        self.scopes_path = os.path.join(directory, "scopes.u32")
+        self.lock_path = os.path.join(directory, "index.lock")
+        self.db_path = os.path.join(directory, "entries.sqlite3")
+
+        # Fixed seed so every process and restart derives the same hyperplanes
+        rng = np.random.default_rng(1234)
+        self.planes = rng.standard_normal((bands * band_bits, dim)).astype(np.float32)
+        self.weights = (1 << np.arange(band_bits, dtype=np.uint32)).astype(np.uint32)
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.count = 0
+        # Over-allocated buffers; rows beyond ``count`` are unused capacity
+        self._vectors = np.zeros((1024, dim), dtype=np.float16)
+        self._scopes = np.zeros(1024, dtype=np.uint32)
+        self._sorted_keys = [np.zeros(0, dtype=np.uint16) for _ in range(bands)]
+        self._sorted_ids = [np.zeros(0, dtype=np.int64) for _ in range(bands)]
+        self._tail_keys = np.zeros((0, bands), dtype=np.uint16)
+        self._tail_start = 0
+
+        conn = self._connect()
+        conn.execute("CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY, prompt TEXT, output TEXT)")
+        conn.commit()
+        for path in (self.vectors_path, self.keys_path, self.scopes_path):
+            open(path, "ab").close()
+        self._refresh()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def band_keys(self, vectors):
+        bits = (vectors.astype(np.float32) @ self.planes.T) > 0
+        bits = bits.reshape(len(vectors), self.bands, self.band_bits)
+        return (bits @ self.weights).astype(np.uint16)
+
+    def _stored_count(self):
+        # Rows are complete only once all three files hold them
+        return min(
+            os.path.getsize(self.vectors_path) // (2 * self.dim),
+            os.path.getsize(self.keys_path) // (2 * self.bands),
+            os.path.getsize(self.scopes_path) // 4,
+        )
+
+    def _refresh(self):
+        """Load rows appended since the last refresh, including other processes' rows."""
+        stored = self._stored_count()
+        if stored <= self.count:
+            return
+        with self._lock:
+            start = self.count
+            if stored <= start:
+                return
+            vectors = np.fromfile(self.vectors_path, dtype=np.float16, count=(stored - start) * self.dim,
+                                  offset=start * 2 * self.dim).reshape(-1, self.dim)
+            keys = np.fromfile(self.keys_path, dtype=np.uint16, count=(stored - start) * self.bands,
+                               offset=start * 2 * self.bands).reshape(-1, self.bands)
+            scopes = np.fromfile(self.scopes_path, dtype=np.uint32, count=stored - start, offset=start * 4)
+            if stored > len(self._vectors):
+                capacity = max(stored, 2 * len(self._vectors))
+                self._vectors = np.resize(self._vectors, (capacity, self.dim))
+                self._scopes = np.resize(self._scopes, capacity)
+            self._vectors[start:stored] = vectors
+            self._scopes[start:stored] = scopes
+            self._tail_keys = np.concatenate([self._tail_keys, keys])
+            self.count = stored
+            if len(self._tail_keys) >= self.merge_threshold:
+                self._merge_tail()
+
+    def _merge_tail(self):
+        ids = np.arange(self._tail_start, self._tail_start + len(self._tail_keys), dtype=np.int64)
+        for band in range(self.bands):
+            keys = np.concatenate([self._sorted_keys[band], self._tail_keys[:, band]])
+            all_ids = np.concatenate([self._sorted_ids[band], ids])
+            order = np.argsort(keys, kind="stable")
+            self._sorted_keys[band] = keys[order]
+            self._sorted_ids[band] = all_ids[order]
+        self._tail_start += len(self._tail_keys)
+        self._tail_keys = np.zeros((0, self.bands), dtype=np.uint16)
+
+    def _candidates(self, keys):
+        found = []
+        for band in range(self.bands):
+            sorted_keys = self._sorted_keys[band]
+            lo = np.searchsorted(sorted_keys, keys[band], side="left")
+            hi = np.searchsorted(sorted_keys, keys[band], side="right")
+            found.append(self._sorted_ids[band][lo:hi])
+        if len(self._tail_keys):
+            tail_hits = np.nonzero((self._tail_keys == keys).any(axis=1))[0]
+            found.append(tail_hits + self._tail_start)
+        return np.unique(np.concatenate(found)) if found else np.zeros(0, dtype=np.int64)
+
+    def _exact_match(self, prompt, vector, keys, scope):
+        """Return the id of the row in ``scope`` whose prompt equals ``prompt`` after normalization."""
+        self._refresh()
+        if not self.count:
+            return None
+        with self._lock:
+            ids = self._candidates(keys)
+            ids = ids[self._scopes[ids] == scope_id(scope)]
+            if not len(ids):
+                return None
+            scores = self._vectors[ids].astype(np.float32) @ vector
+        normalized = normalize_prompt(prompt)
+        conn = self._connect()
+        # Identical prompts embed identically, up to float16 rounding
+        for row_id in ids[scores >= 0.999]:
+            row = conn.execute("SELECT prompt FROM entries WHERE id = ?", (int(row_id),)).fetchone()
+            if row and normalize_prompt(row[0]) == normalized:
+                return int(row_id)
+        return None
+
+    def add(self, prompt, output, scope=""):
+        """Index ``prompt``; an already indexed prompt keeps its row and takes the new output."""
+        vector = embed(prompt, self.dim)[None, :]
+        keys = self.band_keys(vector)
+        with FileLock(self.lock_path):
+            conn = self._connect()
+            row_id = self._exact_match(prompt, vector[0], keys[0], scope)
+            if row_id is not None:
+                conn.execute("UPDATE entries SET output = ? WHERE id = ? AND output != ?", (output, row_id, output))
+                conn.commit()
+                return row_id
+            row_id = self._stored_count()
+            conn.execute("INSERT OR REPLACE INTO entries (id, prompt, output) VALUES (?, ?, ?)",
+                         (row_id, prompt, output))
+            conn.commit()
+            # The scope file is written last; its length marks rows as complete
+            with open(self.vectors_path, "ab") as f:
+                f.write(vector.astype(np.float16).tobytes())
+            with open(self.keys_path, "ab") as f:
+                f.write(keys.tobytes())
+            with open(self.scopes_path, "ab") as f:
+                f.write(np.array([scope_id(scope)], dtype=np.uint32).tobytes())
+        self._refresh()
+        return row_id
+
+    def lookup(self, prompt, scope="", threshold=0.85):
+        """Return ``(similarity, prompt, output)`` for the closest match above ``threshold``."""
+        self._refresh()
+        if not self.count:
+            return None
+        vector = embed(prompt, self.dim)
+        keys = self.band_keys(vector[None, :])[0]
+        with self._lock:
+            ids = self._candidates(keys)
+            ids = ids[self._scopes[ids] == scope_id(scope)]
+            if not len(ids):
+                return None
+            scores = self._vectors[ids].astype(np.float32) @ vector
+        best = int(np.argmax(scores))
+        if scores[best] < threshold:
+            return None
+        try:
+            row = self._connect().execute(
+                "SELECT prompt, output FROM entries WHERE id = ?", (int(ids[best]),)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logging.warning(f"Similarity index read failed: {e}")
+            return None
+        if row is None:
+            return None
+        return float(scores[best]), row[0], row[1]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_similarity_index():
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = SimilarityIndex()
+    return _index
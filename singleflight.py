@@ -0,0 +1,391 @@
+"""Coalescing of identical in-flight generations (single-flight).
+
+When many sessions submit the same instruction at once, only one of them
+calls the model. Inside a process, followers wait on the leader's call and
+receive its result. Across processes on the host, the leader writes a claim
+file for the key and the others poll the shared disk cache (``recheck``)
+until the leader's response appears there. The file lock, striped by key,
+is only held while a claim is read, written or removed, never during the
+call, so unrelated keys on one stripe do not wait on each other. A claim
+expires after ``SINGLE_FLIGHT_LEASE`` seconds, or when its process is gone,
+and a waiter then takes the call over.
+
+A leader refused admission (``CallRejected``, e.g. its user's queue is
+full) does not pass the refusal on: its followers retry as leaders with
+their own admission.
+
+Tunables (environment)::
+
+    SINGLE_FLIGHT_DIR       directory holding the lock stripes and claims (.cache/inflight)
+    SINGLE_FLIGHT_STRIPES   number of lock files keys are spread over (4096)
+    SINGLE_FLIGHT_LEASE     seconds a claim stays valid (120)
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+import zlib
+
+from locks import FileLock
+from resilience import CallRejected
+
+DEFAULT_LOCK_DIR = os.environ.get("SINGLE_FLIGHT_DIR", os.path.join(".cache", "inflight"))
+DEFAULT_STRIPES = int(os.environ.get("SINGLE_FLIGHT_STRIPES", "4096"))
+# Longer than a model call's deadline, so only a stuck or vanished leader's claim expires
+DEFAULT_LEASE = float(os.environ.get("SINGLE_FLIGHT_LEASE", "120"))
+# Longest wait for a lock stripe; it is only ever held for a few file operations
+LOCK_TIMEOUT = 5.0
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # Set when the leader went away without a result; a follower takes over
+        self.abandoned = False
+        self.waiters = []
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _alive(pid):
+    if os.name == "nt":
+        # os.kill would terminate the process there; rely on the lease alone
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # Exists, but belongs to another user
+        return True
+    return True
+
+
+class SingleFlight:
+    def __init__(self, lock_dir=DEFAULT_LOCK_DIR, stripes=DEFAULT_STRIPES, poll_interval=0.02, lease=DEFAULT_LEASE):
+        os.makedirs(lock_dir, exist_ok=True)
+        self.lock_dir = lock_dir
+        self.stripes = stripes
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.stats = {"leaders": 0, "coalesced": 0, "shared": 0}
+
+    def _lock_for(self, key):
+        stripe = zlib.crc32(key.encode("utf-8")) % self.stripes
+        return FileLock(os.path.join(self.lock_dir, f"{stripe:04x}.lock"))
+
+    def _join(self, key, loop=None):
+        """Return ``(call, leader, waiter)``; the leader is responsible for finishing the call.
+
+        With ``loop`` given, a follower also gets an asyncio future on that
+        loop that resolves when the call finishes.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.stats["leaders"] += 1
+                return call, True, None
+            self.stats["coalesced"] += 1
+            waiter = None
+            if loop is not None:
+                waiter = loop.create_future()
+                call.waiters.append((loop, waiter))
+            return call, False, waiter
+
+    def _finish(self, key, call, result=None, error=None, abandoned=False):
+        call.result = result
+        call.error = error
+        call.abandoned = abandoned
+        with self._lock:
+            self._calls.pop(key, None)
+        call.done.set()
+        for loop, waiter in call.waiters:
+            loop.call_soon_threadsafe(_resolve, waiter)
+
+    def _outcome(self, call):
+        """Return a finished call that has a result, ``None`` if it was abandoned."""
+        if call.error is not None:
+            raise call.error
+        return None if call.abandoned else call
+
+    def _claim_path(self, key):
+        return os.path.join(self.lock_dir, hashlib.sha256(key.encode("utf-8")).hexdigest()[:32] + ".claim")
+
+    def _acquire(self, key):
+        """Return the key's stripe lock, or ``None`` if it could not be had within ``LOCK_TIMEOUT``."""
+        lock = self._lock_for(key)
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        while not lock.acquire(blocking=False):
+            if time.monotonic() > deadline:
+                return None
+            time.sleep(self.poll_interval)
+        return lock
+
+    async def _aacquire(self, key):
+        # Poll rather than block a thread on the event loop
+        lock = self._lock_for(key)
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        while not lock.acquire(blocking=False):
+            if time.monotonic() > deadline:
+                return None
+            await asyncio.sleep(self.poll_interval)
+        return lock
+
+    def _write_claim(self, path, token):
+        """Claim a key for this process unless a live claim exists; call with the stripe lock held."""
+        try:
+            with open(path, encoding="utf-8") as f:
+                claim = json.load(f)
+            if claim["expires"] > time.time() and _alive(claim["pid"]):
+                return False
+        except (OSError, ValueError, KeyError, TypeError):
+            # No claim, or a torn one
+            pass
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"token": token, "pid": os.getpid(), "expires": time.time() + self.lease}, f)
+        return True
+
+    def _remove_claim(self, path, token):
+        """Remove this process's claim; call with the stripe lock held."""
+        try:
+            with open(path, encoding="utf-8") as f:
+                mine = json.load(f).get("token") == token
+            if mine:
+                os.remove(path)
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    def _locked(self, lock, key, action):
+        if lock is None:
+            # Go ahead uncoordinated rather than wait on a stripe that is not being released
+            logging.warning(f"Single-flight lock for {key} timed out")
+            return True
+        try:
+            return action()
+        finally:
+            lock.release()
+
+    def _claim(self, key, token):
+        return self._locked(self._acquire(key), key, lambda: self._write_claim(self._claim_path(key), token))
+
+    def _release(self, key, token):
+        if token is not None:
+            self._locked(self._acquire(key), key, lambda: self._remove_claim(self._claim_path(key), token))
+
+    async def _aclaim(self, key, token):
+        return self._locked(await self._aacquire(key), key, lambda: self._write_claim(self._claim_path(key), token))
+
+    async def _arelease(self, key, token):
+        if token is not None:
+            self._locked(await self._aacquire(key), key, lambda: self._remove_claim(self._claim_path(key), token))
+
+    def _shared(self, result):
+        if result is not None:
+            self.stats["shared"] += 1
+        return result
+
+    def _lead(self, key, recheck):
+        """Return ``(result, token)``: the response another process stored, or a claim to make the call.
+
+        Waits while another process holds a live claim on the key. Without
+        ``recheck`` there is nothing to share, so the call is made at once.
+        """
+        if not recheck:
+            return None, None
+        token = uuid.uuid4().hex
+        while True:
+            result = self._shared(recheck())
+            if result is not None:
+                return result, None
+            if self._claim(key, token):
+                # The previous leader may have stored its response just before giving up its claim
+                result = self._shared(recheck())
+                if result is not None:
+                    self._release(key, token)
+                    return result, None
+                return None, token
+            time.sleep(self.poll_interval)
+
+    async def _alead(self, key, recheck):
+        """Async ``_lead``; ``recheck`` is a coroutine function."""
+        if not recheck:
+            return None, None
+        token = uuid.uuid4().hex
+        while True:
+            result = self._shared(await recheck())
+            if result is not None:
+                return result, None
+            if await self._aclaim(key, token):
+                result = self._shared(await recheck())
+                if result is not None:
+                    await self._arelease(key, token)
+                    return result, None
+                return None, token
+            await asyncio.sleep(self.poll_interval)
+
+    def do(self, key, fn, recheck=None):
+        """Run ``fn()`` once for all concurrent callers of ``key``.
+
+        ``recheck()`` returns a result another process stored meanwhile, or
+        ``None``; ``fn`` is expected to store its result where ``recheck``
+        finds it. Returns ``(result, fresh)`` where ``fresh`` is true only
+        for the caller that actually ran ``fn``.
+        """
+        while True:
+            call, leader, _ = self._join(key)
+            if leader:
+                break
+            call.done.wait()
+            if self._outcome(call):
+                return call.result, False
+
+        try:
+            result, token = self._lead(key, recheck)
+            fresh = result is None
+            if fresh:
+                try:
+                    result = fn()
+                finally:
+                    self._release(key, token)
+        except CallRejected:
+            # Refused for this caller's user; the followers try with their own admission
+            self._finish(key, call, abandoned=True)
+            raise
+        except Exception as e:
+            self._finish(key, call, error=e)
+            raise
+        except BaseException:
+            self._finish(key, call, abandoned=True)
+            raise
+        self._finish(key, call, result=result)
+        return result, fresh
+
+    def stream(self, key, chunks, recheck=None):
+        """Yield ``chunks()`` live to the leader; followers get the full text once it is done."""
+        while True:
+            call, leader, _ = self._join(key)
+            if leader:
+                break
+            call.done.wait()
+            if self._outcome(call):
+                yield call.result
+                return
+
+        parts = []
+        try:
+            result, token = self._lead(key, recheck)
+            if result is not None:
+                parts.append(result)
+                yield result
+            else:
+                try:
+                    for chunk in chunks():
+                        parts.append(chunk)
+                        yield chunk
+                finally:
+                    self._release(key, token)
+        except CallRejected:
+            self._finish(key, call, abandoned=True)
+            raise
+        except Exception as e:
+            self._finish(key, call, error=e)
+            raise
+        except BaseException:
+            # Includes GeneratorExit when the leader's reader goes away
+            self._finish(key, call, abandoned=True)
+            raise
+        self._finish(key, call, result="".join(parts))
+
+    async def _afollow(self, key):
+        """Wait as a follower; return ``(call, None)`` with a result or ``(None, call)`` to lead."""
+        loop = asyncio.get_running_loop()
+        while True:
+            call, leader, waiter = self._join(key, loop)
+            if leader:
+                return None, call
+            await waiter
+            if self._outcome(call):
+                return call, None
+
+    async def ado(self, key, fn, recheck=None):
+        """Async ``do``; ``fn`` and ``recheck`` are coroutine functions."""
+        done, call = await self._afollow(key)
+        if done:
+            return done.result, False
+
+        try:
+            result, token = await self._alead(key, recheck)
+            fresh = result is None
+            if fresh:
+                try:
+                    result = await fn()
+                finally:
+                    await self._arelease(key, token)
+        except CallRejected:
+            self._finish(key, call, abandoned=True)
+            raise
+        except Exception as e:
+            self._finish(key, call, error=e)
+            raise
+        except BaseException:
+            self._finish(key, call, abandoned=True)
+            raise
+        self._finish(key, call, result=result)
+        return result, fresh
+
+    async def astream(self, key, chunks, recheck=None):
+        """Async ``stream``; ``chunks()`` returns an async iterator and ``recheck`` is a coroutine function."""
+        done, call = await self._afollow(key)
+        if done:
+            yield done.result
+            return
+
+        parts = []
+        try:
+            result, token = await self._alead(key, recheck)
+            if result is not None:
+                parts.append(result)
+                yield result
+            else:
+                try:
+                    async for chunk in chunks():
+                        parts.append(chunk)
+                        yield chunk
+                finally:
+                    await self._arelease(key, token)
+        except CallRejected:
+            self._finish(key, call, abandoned=True)
+            raise
+        except Exception as e:
+            self._finish(key, call, error=e)
+            raise
+        except BaseException:
+            # Cancelled or abandoned; a follower takes over the call
+            self._finish(key, call, abandoned=True)
+            raise
+        self._finish(key, call, result="".join(parts))
+
+
+_flight = None
+_flight_lock = threading.Lock()
+
+
+def get_single_flight():
+    global _flight
+    if _flight is None:
+        with _flight_lock:
+            if _flight is None:
+                _flight = SingleFlight()
+    return _flight
@@ -0,0 +1,122 @@
+import asyncio
+import json
+
+import pytest
+
+import batch
+from batch import BatchRunner, load_completed, score_file
+
+
+def write_lines(path, lines):
+    path.write_text("".join(line + "\n" for line in lines), encoding="utf-8")
+
+
+def read_results(path):
+    return [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+
+
+@pytest.fixture
+def fake_process(monkeypatch):
+    calls = []
+
+    async def process(client, record, action, bypass_cache, *args):
+        calls.append(record["prompt"])
+        if record["prompt"] == "boom":
+            raise KeyError("unexpected")
+        return {"refined_output": record["prompt"].upper()}, 10
+
+    monkeypatch.setattr(batch, "process", process)
+    return calls
+
+
+def test_load_completed_truncates_partial_last_line(tmp_path):
+    output = tmp_path / "out.jsonl"
+    output.write_bytes(b'{"id": "1", "refined_output": "x"}\n{"id": "2", "error": "failed"}\n{"id": "3", "ref')
+    assert load_completed(str(output)) == {"1"}
+    assert output.read_bytes().endswith(b'"failed"}\n')
+
+
+def test_run_resumes_and_survives_bad_lines(tmp_path, fake_process):
+    source, output = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    write_lines(source, [
+        '{"id": "a", "prompt": "first"}',
+        '[1, 2]',
+        '"just a string"',
+        'not json',
+        '{"id": "b", "prompt": "boom"}',
+        '{"id": "c", "prompt": "third"}',
+    ])
+    write_lines(output, ['{"id": "a", "refined_output": "FIRST"}'])
+
+    stats = asyncio.run(asyncio.wait_for(BatchRunner(None, str(output), workers=2).run(str(source)), 5))
+
+    assert sorted(fake_process) == ["boom", "third"]
+    assert stats == {"done": 1, "failed": 4, "skipped": 1, "tokens": 10}
+    results = {result["id"]: result for result in read_results(output)}
+    assert results["1"]["error"] == results["2"]["error"] == "Line is not a JSON object"
+    assert results["3"]["error"] == "Line is not valid JSON"
+    assert results["b"]["error"].startswith("KeyError")
+    assert results["c"]["refined_output"] == "THIRD"
+    # Only failed lines are retried on the next run
+    fake_process.clear()
+    asyncio.run(asyncio.wait_for(BatchRunner(None, str(output), workers=2).run(str(source)), 5))
+    assert sorted(fake_process) == ["boom"]
+
+
+class FakeGeneration:
+    def __init__(self, text):
+        self.text = text
+        self.prompt_tokens = self.completion_tokens = 1
+
+
+def test_only_the_rejected_call_of_both_is_retried(monkeypatch):
+    calls = []
+
+    async def agenerate(client, instruction, latency_class=None, **kwargs):
+        calls.append(latency_class)
+        if latency_class == "evaluate" and calls.count("evaluate") == 1:
+            raise batch.CallRejected("busy", retry_after=0)
+        return FakeGeneration(latency_class)
+
+    monkeypatch.setattr(batch, "agenerate", agenerate)
+    result, _ = asyncio.run(batch.process(None, {"prompt": "p", "mode": "Technical"}, "both", False, max_rejections=2))
+    assert sorted(calls) == ["Technical", "evaluate", "evaluate"]
+    assert result == {"refined_output": "Technical", "evaluation": "evaluate"}
+
+
+def test_calls_in_flight_stay_within_the_per_user_queue(tmp_path, monkeypatch):
+    in_flight, peak = 0, 0
+
+    async def agenerate(client, instruction, **kwargs):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return FakeGeneration("ok")
+
+    monkeypatch.setattr(batch, "agenerate", agenerate)
+    source, output = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    write_lines(source, [json.dumps({"prompt": f"p{i}", "mode": "Technical"}) for i in range(200)])
+    runner = BatchRunner(None, str(output), action="both", workers=40)
+    stats = asyncio.run(asyncio.wait_for(runner.run(str(source)), 10))
+    assert stats["done"] == 200
+    assert 0 < peak <= runner.max_calls
+
+
+def test_score_file_accounts_for_every_line(tmp_path):
+    source, output = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    write_lines(source, [
+        '{"id": "a", "prompt": "Write a haiku about rain."}',
+        'not json',
+        '[1, 2]',
+        '{"id": "b", "prompt": "  "}',
+    ])
+    stats = score_file(str(source), str(output))
+    assert stats == {"done": 1, "failed": 3, "skipped": 0, "tokens": 0}
+    results = {result["id"]: result for result in read_results(output)}
+    assert set(results) == {"a", "1", "2", "b"}
+    assert results["1"]["error"] == "Line is not valid JSON"
+    assert results["2"]["error"] == "Line is not a JSON object"
+    assert results["b"]["error"] == "Prompt cannot be empty"
+    assert 0 <= results["a"]["local_score"]["overall"] <= 10
@@ -0,0 +1,68 @@
+import budget
+from budget import LengthBudget, WordLimiter, budget_for, count_words, cut_point, record_length, trim, word_range
+from metrics import Metrics
+
+BUDGET = LengthBudget("10-20 words", 10, 20, 100)
+
+
+def words(count, start=0):
+    return " ".join(f"w{i}" for i in range(start, start + count))
+
+
+def test_word_range_and_budget_come_from_the_word_limit():
+    assert word_range("800-1000 words") == (800, 1000)
+    assert word_range("no limit") is None and budget_for("") is None
+    limit = budget_for("300-500 words")
+    assert (limit.low, limit.high) == (300, 500)
+    assert limit.max_output_tokens > limit.hard_limit > limit.high
+    assert limit.generation_config({"temperature": 0.2}) == {"temperature": 0.2, "max_output_tokens": limit.max_output_tokens}
+    assert limit.generation_config({"max_output_tokens": 50})["max_output_tokens"] == 50
+
+
+def test_cut_point_is_none_until_the_upper_bound():
+    assert cut_point(words(20), BUDGET) is None
+    assert cut_point("", BUDGET) is None
+
+
+def test_cut_point_ends_at_the_first_sentence_after_the_upper_bound():
+    text = words(19) + " w19 w20. Next sentence here."
+    cut = cut_point(text, BUDGET)
+    assert text[:cut].endswith("w20.")
+    # A line break ends a sentence too
+    text = words(21) + "\nMore text"
+    assert text[:cut_point(text, BUDGET)] == words(21)
+
+
+def test_cut_point_cuts_hard_when_no_sentence_ends_in_the_slack():
+    assert BUDGET.hard_limit == 22
+    text = words(30)
+    assert text[:cut_point(text, BUDGET)] == words(22)
+    # Still within the slack and no boundary yet: keep waiting
+    assert cut_point(words(22), BUDGET) is None
+
+
+def test_trim_and_word_limiter_agree():
+    text = words(21) + ". " + words(10, 21) + "."
+    trimmed, stopped = trim(text, BUDGET)
+    assert stopped and count_words(trimmed) == 21
+    assert trim(text, None) == (text, False)
+    assert trim(words(5), BUDGET) == (words(5), False)
+
+    limiter = WordLimiter(BUDGET)
+    kept = ""
+    for start in range(0, len(text), 7):
+        if limiter.stopped:
+            break
+        kept += limiter.feed(text[start:start + 7])
+    assert limiter.stopped and kept == trimmed
+
+
+def test_record_length_counts_the_outcome(monkeypatch):
+    metrics = Metrics(collectors=())
+    monkeypatch.setattr(budget, "get_metrics", lambda: metrics)
+    cases = [(words(5), False, "short"), (words(15), False, "within"), (words(25), False, "over"), (words(21), True, "stopped")]
+    for text, stopped, _ in cases:
+        assert record_length(BUDGET, text, stopped) == count_words(text)
+    for _, _, outcome in cases:
+        assert metrics._counters[("prompt_output_length_total", (("outcome", outcome), ("word_limit", "10-20 words")))] == 1
+    assert metrics._counters[("prompt_output_words_total", (("word_limit", "10-20 words"),))] == 66
@@ -0,0 +1,65 @@
+import threading
+import time
+
+from cache import ResponseCache, make_cache_key
+
+
+def test_key_ignores_whitespace_tag_order_and_case():
+    assert make_cache_key("refine", "Write  a\npoem", "flash", "ChatGPT ", tags=["Web", "short"]) == \
+        make_cache_key("refine", "Write a poem", "flash", "ChatGPT", tags=["short", "web"])
+    assert make_cache_key("refine", "Write a poem", "flash") != make_cache_key("evaluate", "Write a poem", "flash")
+    assert make_cache_key("refine", "p", "flash", mode="Technical") != make_cache_key("refine", "p", "flash")
+
+
+def test_memory_tier_evicts_least_recently_used(tmp_path):
+    cache = ResponseCache(path=None, max_entries=2)
+    cache.set("a", "1")
+    cache.set("b", "2")
+    assert cache.get("a") == "1"
+    cache.set("c", "3")
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == ("1", "3")
+
+
+def test_disk_tier_survives_restart_and_refills_memory(tmp_path):
+    path = str(tmp_path / "responses.sqlite3")
+    ResponseCache(path=path).set("key", "value")
+    cache = ResponseCache(path=path)
+    assert cache.get("key") == "value"
+    assert cache.get("key") == "value"
+    assert cache.stats == {"memory_hits": 1, "disk_hits": 1, "misses": 0}
+
+
+def test_expired_entries_are_misses_and_purged(tmp_path, monkeypatch):
+    cache = ResponseCache(path=str(tmp_path / "responses.sqlite3"), ttl=60)
+    cache.set("key", "value")
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    assert cache.get("key") is None
+    assert cache.purge_expired() == 1
+
+
+def test_delete_removes_both_tiers(tmp_path):
+    path = str(tmp_path / "responses.sqlite3")
+    cache = ResponseCache(path=path)
+    cache.set("key", "value")
+    cache.delete("key")
+    assert cache.get("key") is None
+    assert ResponseCache(path=path).get("key") is None
+
+
+def test_threads_share_the_disk_tier(tmp_path):
+    cache = ResponseCache(path=str(tmp_path / "responses.sqlite3"), max_entries=8)
+
+    def writer(start):
+        for i in range(start, start + 50):
+            cache.set(f"k{i}", str(i))
+
+    threads = [threading.Thread(target=writer, args=(i * 50,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    fresh = ResponseCache(path=cache.path)
+    assert all(fresh.get(f"k{i}") == str(i) for i in range(200))
+    assert cache.hit_rate() == 0.0
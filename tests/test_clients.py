@@ -0,0 +1,35 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import sys, threading
+import clients
+registry = clients.get_registry()
+print("google.generativeai" in sys.modules, any(t.name == "gemini-warmup" for t in threading.enumerate()))
+"""
+
+
+def run_probe(**env):
+    output = subprocess.run([sys.executable, "-c", PROBE], cwd=ROOT, capture_output=True, text=True, check=True,
+                            env={**os.environ, "GEMINI_API_KEY": "test", **env}).stdout
+    return output.split()
+
+
+def test_registry_leaves_the_sdk_to_the_first_model_call():
+    assert run_probe(GEMINI_WARMUP="0") == ["False", "False"]
+
+
+def test_warmup_is_opt_in():
+    assert run_probe(GEMINI_WARMUP="1")[1] == "True"
+
+
+def test_long_word_limit_routes_to_its_own_model():
+    from clients import DEFAULT_MODEL_ID, ClientRegistry
+
+    registry = ClientRegistry(api_key="test", routes={"refine": "flash", "refine_long": "pro"})
+    assert registry.route("refine", "800-1000 words") == "flash"
+    assert registry.route("refine", "1500-2000 words") == "pro"
+    assert registry.route("unknown") == DEFAULT_MODEL_ID
@@ -0,0 +1,137 @@
+import asyncio
+import threading
+import time
+
+import httpx
+
+import llm
+from bench.fake_gemini import create_app
+from context_cache import ContextCache, FakeContextProvider
+from gemini_rest import GeminiRestClient
+from prompts import TEMPLATES
+
+PREAMBLE = "You are an expert prompt engineer. " * 200
+
+
+class CountingProvider(FakeContextProvider):
+    def __init__(self, min_tokens=0):
+        super().__init__(min_tokens)
+        self.calls = 0
+
+    def create(self, model_id, system_instruction, ttl):
+        self.calls += 1
+        return super().create(model_id, system_instruction, ttl)
+
+
+class SlowProvider(CountingProvider):
+    def create(self, model_id, system_instruction, ttl):
+        time.sleep(0.1)
+        return super().create(model_id, system_instruction, ttl)
+
+    async def acreate(self, model_id, system_instruction, ttl):
+        await asyncio.sleep(0.1)
+        return super().create(model_id, system_instruction, ttl)
+
+
+def test_preamble_is_uploaded_once_per_model():
+    provider = CountingProvider()
+    cache = ContextCache(ttl=3600, min_tokens=100, enabled=True)
+    name = cache.get("flash", PREAMBLE, create=provider.create)
+    assert name.startswith("cachedContents/")
+    assert cache.get("flash", PREAMBLE, create=provider.create) == name
+    assert cache.get("pro", PREAMBLE, create=provider.create) != name
+    assert provider.calls == 2
+    assert cache.stats["hits"] == 1
+
+
+def test_expired_entry_is_created_again():
+    provider = CountingProvider()
+    cache = ContextCache(ttl=0, min_tokens=100, enabled=True)
+    first = cache.get("flash", PREAMBLE, create=provider.create)
+    second = cache.get("flash", PREAMBLE, create=provider.create)
+    assert first != second
+    assert provider.calls == 2
+
+
+def test_refusal_falls_back_and_is_remembered():
+    provider = CountingProvider(min_tokens=10 ** 6)
+    cache = ContextCache(ttl=3600, min_tokens=100, enabled=True)
+    assert cache.get("flash", PREAMBLE, create=provider.create) is None
+    assert cache.get("flash", PREAMBLE, create=provider.create) is None
+    assert provider.calls == 1
+    assert cache.stats["failed"] == 1
+
+
+def test_small_preambles_and_disabled_cache_are_sent_inline():
+    provider = CountingProvider()
+    assert ContextCache(min_tokens=1024, enabled=True).get("flash", "Be brief.", create=provider.create) is None
+    assert ContextCache(min_tokens=0, enabled=False).get("flash", PREAMBLE, create=provider.create) is None
+    assert provider.calls == 0
+
+
+def test_shipped_templates_are_below_the_default_minimum():
+    provider = CountingProvider()
+    cache = ContextCache(enabled=True)
+    for versions in TEMPLATES.values():
+        for template in versions.values():
+            assert cache.get("flash", template.system, create=provider.create) is None
+    assert provider.calls == 0
+
+
+def test_concurrent_callers_create_one_entry():
+    provider = SlowProvider()
+    cache = ContextCache(ttl=3600, min_tokens=100, enabled=True)
+    names = []
+    threads = [threading.Thread(target=lambda: names.append(cache.get("flash", PREAMBLE, create=provider.create)))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert provider.calls == 1
+    assert len(names) == 5 and len(set(names)) == 1
+
+
+def test_concurrent_async_callers_create_one_entry():
+    provider = SlowProvider()
+    cache = ContextCache(ttl=3600, min_tokens=100, enabled=True)
+
+    async def main():
+        return await asyncio.gather(*[cache.aget("flash", PREAMBLE, provider.acreate) for _ in range(5)])
+
+    names = asyncio.run(main())
+    assert provider.calls == 1
+    assert len(set(names)) == 1 and names[0].startswith("cachedContents/")
+
+
+def test_async_lookup_shares_entries():
+    provider = FakeContextProvider()
+    cache = ContextCache(ttl=3600, min_tokens=100, enabled=True)
+
+    async def main():
+        return [await cache.aget("flash", PREAMBLE, provider.acreate) for _ in range(3)]
+
+    names = asyncio.run(main())
+    assert len(set(names)) == 1
+    assert len(provider.entries) == 1
+
+
+def test_rest_preamble_uses_uploaded_cache(monkeypatch):
+    monkeypatch.setattr(llm, "get_context_cache", lambda: ContextCache(ttl=60, min_tokens=100, enabled=True))
+
+    async def main():
+        client = GeminiRestClient("fake", base_url="http://fake")
+        client._client = httpx.AsyncClient(transport=httpx.ASGITransport(app=create_app()), base_url="http://fake")
+        try:
+            cached = await llm.apreamble(client, "flash", PREAMBLE)
+            inline = await llm.apreamble(client, "flash", "Be brief.")
+        finally:
+            await client.aclose()
+        return cached, inline
+
+    cached, inline = asyncio.run(main())
+    assert cached["cached_content"].startswith("cachedContents/fake-")
+    assert inline == {"system_instruction": "Be brief."}
+    payload = GeminiRestClient.build_payload("Refine this", cached_content=cached["cached_content"])
+    assert payload["cachedContent"] == cached["cached_content"]
+    assert "systemInstruction" not in payload
@@ -0,0 +1,96 @@
+import json
+
+import pytest
+import requests
+
+from feedback import FeedbackSpool, FeedbackWorker
+
+
+class FakeSession:
+    """Answers posts with the next status in ``statuses`` (200 once they run out)."""
+
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.posted = []
+
+    def post(self, url, json=None, timeout=None):
+        self.posted.append(json)
+        response = requests.Response()
+        response.status_code = self.statuses.pop(0) if self.statuses else 200
+        return response
+
+
+@pytest.fixture
+def spool(tmp_path):
+    return FeedbackSpool(str(tmp_path), fsync_interval=0.01)
+
+
+def make_worker(spool, session, batch_post=False):
+    return FeedbackWorker(spool, endpoint="http://feedback.invalid", batch_post=batch_post, session=session)
+
+
+def fill(spool, count):
+    for i in range(count):
+        spool.append({"feedback": f"note {i}"})
+
+
+def test_delivers_records_and_compacts(spool):
+    fill(spool, 3)
+    session = FakeSession()
+    worker = make_worker(spool, session)
+    assert worker.flush_once() == 3
+    assert [record["feedback"] for record in session.posted] == ["note 0", "note 1", "note 2"]
+    assert worker.flush_once() == 0
+    assert spool.read_offset() == 0
+    assert spool.read_batch(0, 10) == ([], 0)
+
+
+def test_transient_failure_keeps_delivered_records_delivered(spool):
+    fill(spool, 3)
+    worker = make_worker(spool, FakeSession(200, 503))
+    with pytest.raises(requests.HTTPError):
+        worker.flush_once()
+    # Only the record that failed and the ones after it are sent again
+    session = FakeSession()
+    worker.session = session
+    worker.flush_once()
+    assert [record["feedback"] for record in session.posted] == ["note 1", "note 2"]
+
+
+def test_rejected_record_is_dead_lettered(spool):
+    fill(spool, 3)
+    worker = make_worker(spool, FakeSession(200, 400))
+    assert worker.flush_once() == 3
+    assert worker.stats == {"sent": 2, "failed_attempts": 0, "dead_lettered": 1}
+    with open(spool.dead_path) as f:
+        dead = [json.loads(line) for line in f]
+    assert [entry["record"]["feedback"] for entry in dead] == ["note 1"]
+
+
+@pytest.mark.parametrize("status", [408, 429])
+def test_timeouts_and_rate_limits_are_retried(spool, status):
+    fill(spool, 1)
+    worker = make_worker(spool, FakeSession(status))
+    with pytest.raises(requests.HTTPError):
+        worker.flush_once()
+    assert spool.read_offset() == 0
+
+
+def test_rejected_batch_is_sent_record_by_record(spool):
+    fill(spool, 3)
+    session = FakeSession(400, 200, 422, 200)
+    worker = make_worker(spool, session, batch_post=True)
+    worker.flush_once()
+    assert len(session.posted[0]) == 3
+    assert session.posted[1:] == [[{"feedback": f"note {i}"}] for i in range(3)]
+    assert worker.stats["sent"] == 2
+    assert worker.stats["dead_lettered"] == 1
+
+
+def test_partial_line_waits_for_the_rest(spool):
+    fill(spool, 1)
+    with open(spool.path, "a") as f:
+        f.write('{"feedback": "half')
+    records, offset = spool.read_batch(0, 10)
+    assert [record for record, _ in records] == [{"feedback": "note 0"}]
+    assert offset == records[-1][1]
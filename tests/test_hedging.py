@@ -0,0 +1,156 @@
+import asyncio
+import itertools
+import threading
+import time
+
+import pytest
+
+from hedging import Hedger, LatencyTracker
+from resilience import Deadline, DeadlineExceeded
+
+KEY = "model/default/call"
+
+
+def hedger(**options):
+    tracker = LatencyTracker()
+    for _ in range(10):
+        tracker.observe(KEY, 0.05)
+    defaults = dict(percentile=95, min_samples=5, max_fraction=1.0, enabled=True, tracker=tracker)
+    defaults.update(options)
+    return Hedger(**defaults)
+
+
+def attempts(*delays):
+    """An ``fn`` whose n-th attempt sleeps ``delays[n]`` seconds and returns ``n``."""
+    counter = itertools.count()
+
+    def fn(remaining):
+        attempt = next(counter)
+        time.sleep(delays[attempt])
+        return attempt
+
+    return fn
+
+
+def test_hedge_delay_is_the_learned_percentile():
+    tracker = LatencyTracker()
+    for ms in range(1, 101):
+        tracker.observe(KEY, ms / 1000)
+    h = Hedger(percentile=95, min_samples=20, max_fraction=1.0, enabled=True, tracker=tracker)
+    # The call being decided on is counted before its delay is asked for
+    h.stats["calls"] = 1
+    assert h.hedge_delay(KEY) == 0.096
+    h.min_samples = 200
+    assert h.hedge_delay(KEY) is None
+    h.min_samples, h.enabled = 20, False
+    assert h.hedge_delay(KEY) is None
+
+
+def test_fast_first_attempt_is_not_hedged_and_updates_the_latency():
+    h = hedger()
+    assert h.call(KEY, attempts(0), 5) == 0
+    assert h.stats["hedged"] == 0 and h.stats["calls"] == 1
+    assert len(h.tracker._sorted(KEY)) == 11
+
+
+def test_slow_first_attempt_is_hedged_and_the_first_response_wins():
+    h = hedger()
+    discarded = []
+    assert h._race(KEY, attempts(0.5, 0), 5, discard=discarded.append) == 1
+    assert h.stats["hedged"] == 1 and h.stats["hedge_wins"] == 1
+    # The losing attempt is abandoned until it ends, then its result is released
+    assert h.stats["abandoned"] == 1
+    time.sleep(0.7)
+    assert discarded == [0] and h.stats["abandoned"] == 0
+    assert h.stats["saved_seconds"] > 0
+    # The winner's latency counts from when the hedge started
+    assert min(h.tracker._sorted(KEY)) < 0.05
+
+
+def test_hedges_are_capped_at_max_fraction():
+    h = hedger(max_fraction=0.5)
+    h.call(KEY, attempts(0.2, 0), 5)
+    h.call(KEY, attempts(0.2, 0), 5)
+    assert h.stats["calls"] == 2 and h.stats["hedged"] == 1
+
+
+def test_no_hedge_while_too_many_losers_still_run():
+    h = hedger(max_abandoned=1)
+    h.call(KEY, attempts(0.5, 0), 5)
+    assert h.stats["abandoned"] == 1
+    assert h.call(KEY, attempts(0.1, 0), 5) == 0
+    assert h.stats["hedged"] == 1
+
+
+def test_deadline_expires_while_both_attempts_run():
+    h = hedger()
+    started = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        h.call(KEY, attempts(1, 1), 0.2)
+    assert time.monotonic() - started < 0.5
+    assert h.stats["abandoned"] == 2
+
+
+def test_a_shared_deadline_carries_time_already_spent():
+    deadline = Deadline(0.1)
+    time.sleep(0.15)
+    with pytest.raises(DeadlineExceeded):
+        hedger().call(KEY, attempts(0), deadline)
+
+
+def test_stream_races_to_the_first_chunk_and_closes_the_loser():
+    h = hedger()
+    closed = threading.Event()
+    counter = itertools.count()
+
+    def open_stream(remaining):
+        attempt = next(counter)
+        try:
+            time.sleep(0.3 if attempt == 0 else 0)
+            yield f"{attempt}a"
+            yield f"{attempt}b"
+        finally:
+            if attempt == 0:
+                closed.set()
+
+    assert list(h.stream(KEY, open_stream, 5)) == ["1a", "1b"]
+    assert closed.wait(1)
+
+
+def test_async_loser_is_cancelled():
+    h = hedger()
+    cancelled = []
+
+    async def run():
+        counter = itertools.count()
+
+        async def fn(remaining):
+            attempt = next(counter)
+            try:
+                await asyncio.sleep(1 if attempt == 0 else 0)
+            except asyncio.CancelledError:
+                cancelled.append(attempt)
+                raise
+            return attempt
+
+        return await h.acall(KEY, fn, 5)
+
+    assert asyncio.run(run()) == 1
+    assert cancelled == [0]
+    assert h.stats["hedge_wins"] == 1 and h.stats["abandoned"] == 0
+
+
+def test_async_deadline_cancels_both_attempts():
+    h = hedger()
+    cancelled = []
+
+    async def fn(remaining):
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(h.acall(KEY, fn, 0.2))
+    assert cancelled == [True, True]
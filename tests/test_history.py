@@ -0,0 +1,86 @@
+import sqlite3
+
+import pytest
+
+from history import LOCAL_OWNER, HistoryStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return HistoryStore(str(tmp_path / "history.sqlite3"), flush_interval=0.01)
+
+
+def test_search_matches_text_tags_and_kind(store):
+    store.record("refine", "Write a haiku about rain", "A refined haiku prompt", tags=["Poetry"], owner="a")
+    store.record("evaluate", "Write a haiku about rain", "Clear and short", owner="a")
+    store.record("refine", "Summarize a contract", "A refined summary prompt", tags=["legal"], owner="a")
+    store.flush()
+    assert [entry.kind for entry in store.search("haiku", owner="a")] == ["evaluate", "refine"]
+    assert [entry.prompt for entry in store.search(tags=["poetry"], owner="a")] == ["Write a haiku about rain"]
+    assert [entry.prompt for entry in store.search(kind="refine", owner="a")] == [
+        "Summarize a contract", "Write a haiku about rain",
+    ]
+
+
+def test_search_only_returns_the_owners_entries(store):
+    store.record("refine", "mine", "output", owner="a")
+    store.record("refine", "theirs", "output", owner="b")
+    store.flush()
+    assert [entry.prompt for entry in store.search(owner="a")] == ["mine"]
+    assert [entry.prompt for entry in store.search("theirs", owner="a")] == []
+    assert len(store.search()) == 2
+
+
+def test_keyset_pages_cover_every_entry_once(store):
+    for i in range(45):
+        store.record("refine", f"prompt {i}", "output", owner="a")
+    store.flush()
+    seen, before_id = [], None
+    while True:
+        page = store.search(before_id=before_id, limit=20, owner="a")
+        if not page:
+            break
+        seen += [entry.prompt for entry in page]
+        before_id = page[-1].id
+    assert seen == [f"prompt {i}" for i in reversed(range(45))]
+
+
+def test_writer_survives_unexpected_errors(store, monkeypatch):
+    def broken(batch):
+        raise TypeError("not a database error")
+
+    monkeypatch.setattr(store, "_write", broken)
+    store.record("refine", "lost", "output")
+    store.flush()
+    assert store.stats["failed"] == 1
+    monkeypatch.undo()
+    store.record("refine", "saved", "output")
+    store.flush()
+    assert [entry.prompt for entry in store.search()] == ["saved"]
+
+
+def test_adds_owner_column_to_existing_database(tmp_path):
+    path = str(tmp_path / "history.sqlite3")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE history (id INTEGER PRIMARY KEY, created REAL NOT NULL, kind TEXT NOT NULL, "
+                 "prompt TEXT NOT NULL, output TEXT NOT NULL, model_id TEXT, target_model TEXT, word_limit TEXT, "
+                 "tags TEXT, latency REAL, prompt_tokens INTEGER, completion_tokens INTEGER)")
+    conn.execute("INSERT INTO history (created, kind, prompt, output, tags) VALUES (0, 'refine', 'old', 'output', '[]')")
+    conn.commit()
+    conn.close()
+    store = HistoryStore(path)
+    store.record("refine", "prompt", "output", owner="a")
+    store.flush()
+    assert [entry.prompt for entry in store.search(owner="a")] == ["prompt"]
+    # Entries from before owners existed are kept for the local apps
+    assert [entry.prompt for entry in store.search(owner=LOCAL_OWNER)] == ["old"]
+
+
+def test_local_entries_are_found_from_a_new_session(tmp_path):
+    path = str(tmp_path / "history.sqlite3")
+    first = HistoryStore(path, flush_interval=0.01)
+    first.record("refine", "saved yesterday", "output", owner=LOCAL_OWNER)
+    first.flush()
+    # A reload, new tab or restart opens the store again with the same owner
+    later = HistoryStore(path)
+    assert [entry.prompt for entry in later.search("yesterday", owner=LOCAL_OWNER)] == ["saved yesterday"]
@@ -0,0 +1,99 @@
+import threading
+import time
+
+import pytest
+
+import largeinput
+from largeinput import condense, count_tokens, iter_chunks, map_bounded, split_oversized
+from llm import Generation
+
+
+def paragraph(words, word="lorem"):
+    return " ".join([word] * words) + "."
+
+
+def test_chunks_follow_sections():
+    text = "\n\n".join([
+        "# Intro", paragraph(45, "intro"),
+        "# Usage", paragraph(8, "usage"),
+    ])
+    # Both sections would fit one chunk, but the first is over half full when the second starts
+    assert count_tokens(text) < 120
+    chunks = list(iter_chunks(text, max_tokens=120))
+    assert chunks == ["# Intro\n\n" + paragraph(45, "intro"), "# Usage\n\n" + paragraph(8, "usage")]
+
+
+def test_oversized_section_is_split_at_sentences():
+    sentences = [f"Sentence number {i} says something useful." for i in range(40)]
+    chunks = list(iter_chunks("# Spec\n\n" + " ".join(sentences), max_tokens=50))
+    assert len(chunks) > 1
+    assert all(count_tokens(chunk) <= 50 for chunk in chunks)
+    # Every sentence survives whole, in order
+    assert " ".join(chunks).replace("\n\n", " ").split(". ") == ("# Spec " + " ".join(sentences)).split(". ")
+
+
+def test_run_on_text_is_split_at_words():
+    text = " ".join(f"word{i}" for i in range(500))
+    pieces = split_oversized(text, max_tokens=50)
+    assert len(pieces) > 1
+    assert all(count_tokens(piece) <= 50 for piece in pieces)
+    assert " ".join(pieces).split() == text.split()
+
+
+def test_map_bounded_keeps_order_and_concurrency_limit():
+    lock = threading.Lock()
+    running = peak = 0
+    progress = []
+
+    def work(item):
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        # Later items finish first
+        time.sleep(0.01 * (10 - item))
+        with lock:
+            running -= 1
+        return item * 2
+
+    results = map_bounded(work, iter(range(10)), concurrency=3, on_result=progress.append)
+    assert results == [item * 2 for item in range(10)]
+    assert peak == 3
+    assert progress == list(range(1, 11))
+
+
+@pytest.fixture
+def model_calls(monkeypatch):
+    calls = []
+    replies = {}
+
+    def generate(instruction, cache_key=None, **kwargs):
+        calls.append(instruction.content)
+        return Generation(replies["text"], 100, 10, False)
+
+    monkeypatch.setattr(largeinput, "generate", generate)
+    monkeypatch.setattr(largeinput, "route_model", lambda request_type, word_limit=None: "flash")
+    return calls, replies
+
+
+def test_notes_are_condensed_again_and_tokens_add_up(model_calls):
+    calls, replies = model_calls
+    # Each note is well under a chunk, but the notes of ten chunks take several rounds to fit one
+    replies["text"] = paragraph(20, "note")
+    text = "\n\n".join(paragraph(30, f"part{i}") for i in range(10))
+    condensed = condense(text, chunk_tokens=60, concurrency=2)
+    assert condensed.chunks == 10
+    assert len(calls) > 10
+    assert count_tokens(condensed.notes) <= 60
+    assert condensed.prompt_tokens == 100 * len(calls)
+    assert condensed.completion_tokens == 10 * len(calls)
+
+
+def test_condensing_stops_when_notes_do_not_shrink(model_calls):
+    calls, replies = model_calls
+    # Every note is longer than a chunk, so another round could never make them fit
+    replies["text"] = paragraph(200, "verbose")
+    text = "\n\n".join(paragraph(30, f"part{i}") for i in range(4))
+    condensed = condense(text, chunk_tokens=60, concurrency=2)
+    assert condensed.chunks == 4 and len(calls) == 4
+    assert condensed.notes.count("verbose") == 800
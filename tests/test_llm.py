@@ -0,0 +1,57 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import llm
+from cache import ResponseCache
+from singleflight import SingleFlight
+
+
+class FakeModel:
+    def __init__(self):
+        self.calls = 0
+
+    def generate_content(self, content, stream=False, **kwargs):
+        self.calls += 1
+        time.sleep(0.1)
+        return iter([SimpleNamespace(text="Refined ", usage_metadata=None),
+                     SimpleNamespace(text="prompt", usage_metadata=None)])
+
+
+@pytest.fixture
+def model(monkeypatch, tmp_path):
+    fake = FakeModel()
+    flight = SingleFlight(str(tmp_path / "inflight"))
+    cache = ResponseCache(path=None)
+    monkeypatch.setattr(llm, "model_for", lambda model_id, system_instruction: fake)
+    monkeypatch.setattr(llm, "get_cache", lambda: cache)
+    monkeypatch.setattr(llm, "get_single_flight", lambda: flight)
+    return fake
+
+
+def test_streamed_cache_hit_is_reported(model):
+    cached = []
+    assert "".join(llm.stream_text("Refine this", cache_key="key", on_cached=lambda: cached.append(True))) == \
+        "Refined prompt"
+    assert cached == []
+    assert "".join(llm.stream_text("Refine this", cache_key="key", on_cached=lambda: cached.append(True))) == \
+        "Refined prompt"
+    assert cached == [True] and model.calls == 1
+
+
+def test_stream_shared_with_an_identical_request_is_reported(model):
+    cached, results = [], []
+
+    def run():
+        results.append("".join(llm.stream_text("Refine this", cache_key="key", on_cached=lambda: cached.append(True))))
+
+    threads = [threading.Thread(target=run) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.02)
+    for thread in threads:
+        thread.join(5)
+    assert results == ["Refined prompt"] * 2
+    assert model.calls == 1 and cached == [True]
@@ -0,0 +1,143 @@
+import json
+import logging
+import re
+import socket
+import urllib.request
+
+import pytest
+
+import metrics
+from metrics import Metrics, start_metrics_server, trace_logger
+
+# One sample line of the text exposition format: name, optional labels, value
+SAMPLE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*(\{([a-zA-Z_][a-zA-Z0-9_]*="(\\.|[^"\\])*",?)*\})? '
+                    r'(-?[0-9.]+(e[+-]?[0-9]+)?|\+Inf|NaN)$')
+
+
+def families(text):
+    """Parse exposition text into ``{name: (type, [sample lines])}``, checking its layout."""
+    assert text.endswith("\n")
+    result, current = {}, None
+    for line in text.splitlines():
+        if line.startswith("# HELP "):
+            current = line.split()[2]
+            assert current not in result, f"{current} is rendered twice"
+        elif line.startswith("# TYPE "):
+            _, _, name, kind = line.split()
+            assert name == current
+            result[name] = (kind, [])
+        else:
+            assert SAMPLE.match(line), line
+            assert line.startswith(current)
+            result[current][1].append(line)
+    return result
+
+
+def test_render_is_valid_exposition_format():
+    registry = Metrics(collectors=(lambda: [("prompt_queue_depth", (("priority", "batch"),), 3)],))
+    registry.inc("prompt_requests_total", kind="call", outcome="hit")
+    registry.inc("prompt_requests_total", 2, kind="call", outcome="miss")
+    registry.observe("prompt_upstream_seconds", 0.2, model="flash", kind="call")
+    parsed = families(registry.render())
+    assert parsed["prompt_requests_total"] == ("counter", [
+        'prompt_requests_total{kind="call",outcome="hit"} 1',
+        'prompt_requests_total{kind="call",outcome="miss"} 2',
+    ])
+    assert parsed["prompt_upstream_seconds"][0] == "histogram"
+    assert parsed["prompt_queue_depth"] == ("gauge", ['prompt_queue_depth{priority="batch"} 3'])
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Metrics(buckets=(0.1, 1, 10), collectors=())
+    for seconds in (0.05, 0.1, 0.5, 5, 50):
+        registry.observe("prompt_request_seconds", seconds, operation="refine")
+    lines = families(registry.render())["prompt_request_seconds"][1]
+    assert lines == [
+        'prompt_request_seconds_bucket{operation="refine",le="0.1"} 2',
+        'prompt_request_seconds_bucket{operation="refine",le="1"} 3',
+        'prompt_request_seconds_bucket{operation="refine",le="10"} 4',
+        'prompt_request_seconds_bucket{operation="refine",le="+Inf"} 5',
+        'prompt_request_seconds_sum{operation="refine"} 55.65',
+        'prompt_request_seconds_count{operation="refine"} 5',
+    ]
+    assert registry.total("prompt_request_seconds", operation="refine") == (5, 55.65)
+
+
+def test_label_values_are_escaped():
+    registry = Metrics(collectors=())
+    registry.inc("prompt_errors_total", operation='say "hi"\\now\nplease', error="ValueError")
+    (line,) = families(registry.render())["prompt_errors_total"][1]
+    assert line == 'prompt_errors_total{error="ValueError",operation="say \\"hi\\"\\\\now\\nplease"} 1'
+
+
+def test_failing_collector_does_not_break_render():
+    def broken():
+        raise RuntimeError("component unavailable")
+
+    registry = Metrics(collectors=(broken,))
+    registry.inc("prompt_coalesced_total")
+    assert "prompt_coalesced_total 1" in registry.render()
+
+
+@pytest.fixture
+def trace_lines():
+    lines = []
+    handler = logging.Handler()
+    handler.emit = lambda record: lines.append(json.loads(record.getMessage()))
+    trace_logger.addHandler(handler)
+    yield lines
+    trace_logger.removeHandler(handler)
+
+
+def test_trace_records_stages_and_total(trace_lines):
+    registry = Metrics(collectors=())
+    with registry.trace("refine", model="flash") as trace:
+        with trace.stage("build"):
+            pass
+        with trace.stage("call"):
+            pass
+        with trace.stage("call"):
+            pass
+        trace.annotate(chunks=3)
+    assert registry.total("prompt_request_seconds", operation="refine")[0] == 1
+    assert registry.total("prompt_stage_seconds", operation="refine", stage="call")[0] == 2
+    (record,) = trace_lines
+    assert record["operation"] == "refine" and record["error"] is None
+    assert set(record["stages"]) == {"build", "call"}
+    assert record["model"] == "flash" and record["chunks"] == 3
+
+
+def test_trace_counts_the_escaping_error(trace_lines):
+    registry = Metrics(collectors=())
+    with pytest.raises(ValueError):
+        with registry.trace("evaluate") as trace:
+            with trace.stage("call"):
+                raise ValueError("bad response")
+    # The stage that failed is still timed
+    assert registry.total("prompt_stage_seconds", operation="evaluate", stage="call")[0] == 1
+    assert registry._counters[("prompt_errors_total", (("error", "ValueError"), ("operation", "evaluate")))] == 1
+    assert trace_lines[0]["error"] == "ValueError"
+
+
+def test_metrics_server_is_off_without_a_port(monkeypatch):
+    monkeypatch.delenv("METRICS_PORT", raising=False)
+    monkeypatch.setattr(metrics, "_server", None)
+    assert start_metrics_server() is None
+    assert metrics._server is None
+
+
+def test_metrics_server_serves_the_registry(monkeypatch):
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    monkeypatch.setenv("METRICS_PORT", str(port))
+    monkeypatch.setattr(metrics, "_server", None)
+    server = start_metrics_server()
+    try:
+        assert start_metrics_server() is server
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+            assert response.headers["Content-Type"] == metrics.CONTENT_TYPE
+            families(response.read().decode("utf-8"))
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,31 @@
+import pytest
+
+from prompts import format_evaluation, parse_combined_response
+
+
+def test_parses_fenced_json_with_surrounding_text():
+    text = 'Here you go:\n```json\n{"optimized_prompt": "Be specific.", "evaluation": {"Clarity": "Clear."}}\n```'
+    assert parse_combined_response(text) == ("Be specific.", {"clarity": "Clear."})
+
+
+def test_accepts_camel_case_prompt_key():
+    assert parse_combined_response('{"optimizedPrompt": "p", "evaluation": {}}') == ("p", {})
+
+
+@pytest.mark.parametrize("text", [
+    "no json here",
+    '{"optimized_prompt": "p", "evaluation": {"clarity": "ok"}',
+    '{"optimized_prompt": "", "evaluation": {}}',
+    '{"optimized_prompt": "p", "evaluation": "good"}',
+    '{"evaluation": {}}',
+])
+def test_rejects_unusable_responses(text):
+    with pytest.raises(ValueError):
+        parse_combined_response(text)
+
+
+def test_formats_evaluation_as_numbered_list():
+    text = format_evaluation({"clarity": "Clear.", "suggestions": ["Add an example", "Name the audience"]})
+    assert text.startswith("1. Clarity: Clear.")
+    assert "- Add an example\n- Name the audience" in text
+    assert "No comment" in text
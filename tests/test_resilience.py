@@ -0,0 +1,184 @@
+import asyncio
+
+import pytest
+
+from resilience import CallGuard, CallRejected, CircuitBreaker, CircuitOpenError, DeadlineExceeded, TokenBucket
+
+
+class Unavailable(Exception):
+    status_code = 503
+
+
+class BadRequest(Exception):
+    status_code = 400
+
+
+def make_guard(breaker=None, deadline=5.0):
+    return CallGuard(rpm=60000, tpm=10 ** 9, max_retries=2, deadline=deadline, base_delay=0.001, max_delay=0.01,
+                     breaker=breaker or CircuitBreaker(failure_threshold=1, reset_timeout=0))
+
+
+def recovering(breaker):
+    """Open ``breaker`` so that its next call is the probe."""
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+
+def test_token_bucket_waits_once_capacity_is_used():
+    bucket = TokenBucket(per_minute=60)
+    assert bucket.reserve(60) == 0.0
+    # One token per second at 60 per minute
+    assert bucket.reserve(1) == pytest.approx(1.0, rel=0.05)
+
+
+def test_token_bucket_backs_off_and_recovers():
+    bucket = TokenBucket(per_minute=600, min_fraction=0.1)
+    for _ in range(10):
+        bucket.penalize()
+    assert bucket.rate == pytest.approx(bucket.min_rate)
+    for _ in range(100):
+        bucket.reward()
+    assert bucket.rate == pytest.approx(bucket.max_rate)
+
+
+def test_breaker_opens_after_threshold_and_probes_once():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert breaker.before_call() is not None
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.before_call() is None
+
+
+def test_breaker_rejects_until_reset_timeout():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError) as info:
+        breaker.before_call()
+    assert 0 < info.value.retry_after <= 60
+
+
+def test_lost_probe_reopens_after_probe_timeout():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0, probe_timeout=0)
+    recovering(breaker)
+    breaker.before_call()
+    assert breaker.state == "half_open"
+    # The probe never reports back; the next call finds it timed out and probes again
+    assert breaker.before_call() is not None
+
+
+def test_settle_ignores_outdated_probe():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    recovering(breaker)
+    old = breaker.before_call()
+    breaker.record_failure()
+    breaker.before_call()
+    breaker.settle(old, False)
+    assert breaker.state == "half_open"
+
+
+def test_call_retries_retryable_errors():
+    guard = make_guard(CircuitBreaker(failure_threshold=10))
+    attempts = []
+
+    def fn(timeout):
+        attempts.append(timeout)
+        if len(attempts) < 3:
+            raise Unavailable()
+        return "ok"
+
+    assert guard.call(fn, 10) == "ok"
+    assert len(attempts) == 3
+
+
+def test_call_does_not_retry_bad_requests():
+    guard = make_guard()
+    attempts = []
+
+    def fn(timeout):
+        attempts.append(timeout)
+        raise BadRequest()
+
+    with pytest.raises(BadRequest):
+        guard.call(fn, 10)
+    assert len(attempts) == 1
+    assert guard.breaker.state == "closed"
+
+
+def test_probe_stream_closed_early_closes_breaker():
+    guard = make_guard()
+    recovering(guard.breaker)
+    stream = guard.stream(lambda timeout: iter(["a", "b", "c"]), 10)
+    assert next(stream) == "a"
+    stream.close()
+    assert guard.breaker.state == "closed"
+
+
+def test_probe_stream_closed_before_first_chunk_reopens_breaker():
+    guard = make_guard()
+    recovering(guard.breaker)
+
+    def open_stream(timeout):
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        next(guard.stream(open_stream, 10))
+    assert guard.breaker.state == "open"
+
+
+def test_cancelled_async_probe_reopens_breaker():
+    guard = make_guard()
+    recovering(guard.breaker)
+
+    async def main():
+        task = asyncio.ensure_future(guard.acall(lambda timeout: asyncio.sleep(10), 10))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert guard.breaker.state == "open"
+    # The next call is let through as a new probe
+    assert asyncio.run(guard.acall(lambda timeout: asyncio.sleep(0, "ok"), 10)) == "ok"
+    assert guard.breaker.state == "closed"
+
+
+def test_async_probe_past_deadline_reopens_breaker():
+    guard = make_guard(deadline=0.05)
+    recovering(guard.breaker)
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(guard.acall(lambda timeout: asyncio.sleep(1), 10))
+    assert guard.breaker.state == "open"
+
+
+def test_async_probe_stream_closed_early_closes_breaker():
+    guard = make_guard()
+    recovering(guard.breaker)
+
+    async def chunks(timeout):
+        for chunk in ("a", "b", "c"):
+            yield chunk
+
+    async def main():
+        stream = guard.astream(chunks, 10)
+        assert await stream.__anext__() == "a"
+        await stream.aclose()
+
+    asyncio.run(main())
+    assert guard.breaker.state == "closed"
+
+
+def test_rate_limited_probe_lets_the_next_call_probe():
+    guard = CallGuard(rpm=1, tpm=10 ** 9, deadline=0.5, breaker=CircuitBreaker(failure_threshold=1, reset_timeout=0))
+    guard.requests.reserve(1)
+    recovering(guard.breaker)
+    with pytest.raises(CallRejected):
+        guard.call(lambda timeout: "ok", 10)
+    assert guard.breaker.state == "open"
+    assert guard.breaker.before_call() is not None
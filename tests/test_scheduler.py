@@ -0,0 +1,110 @@
+import asyncio
+import os
+
+import pytest
+
+from resilience import CallRejected, DeadlineExceeded
+from scheduler import Scheduler
+
+
+def make_scheduler(tmp_path, **kwargs):
+    kwargs.setdefault("slots", 1)
+    return Scheduler(state_dir=str(tmp_path), **kwargs)
+
+
+def run_queued(scheduler, requests):
+    """Hold the only slot, queue ``(priority, user, name)`` requests in order, and return the order they ran in."""
+    order = []
+
+    async def request(priority, user, name):
+        async with scheduler.aslot(priority, user, timeout=60):
+            order.append(name)
+            await asyncio.sleep(0)
+
+    async def main():
+        async with scheduler.aslot("interactive", "holder"):
+            tasks = []
+            for priority, user, name in requests:
+                tasks.append(asyncio.ensure_future(request(priority, user, name)))
+                await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+    return order
+
+
+def test_free_slot_is_taken_without_queueing(tmp_path):
+    scheduler = make_scheduler(tmp_path, slots=2)
+    with scheduler.slot(user="a"), scheduler.slot(user="b"):
+        assert scheduler.snapshot()["interactive"] == (2, 0)
+    assert scheduler.snapshot()["interactive"] == (0, 0)
+    assert scheduler.stats["queued"] == 0
+
+
+def test_interactive_calls_go_ahead_of_batch(tmp_path):
+    order = run_queued(make_scheduler(tmp_path, batch_share=1), [
+        ("batch", "job", "batch 1"), ("interactive", "a", "interactive 1"), ("batch", "job", "batch 2"),
+    ])
+    assert order == ["interactive 1", "batch 1", "batch 2"]
+
+
+def test_users_take_turns_within_a_class(tmp_path):
+    order = run_queued(make_scheduler(tmp_path), [
+        ("interactive", "a", "a1"), ("interactive", "a", "a2"), ("interactive", "a", "a3"), ("interactive", "b", "b1"),
+    ])
+    assert order == ["a1", "b1", "a2", "a3"]
+
+
+@pytest.mark.parametrize("kwargs, reason", [
+    ({"max_user_queue": 1}, "user_queue_full"),
+    ({"max_queue": 1}, "queue_full"),
+])
+def test_full_queues_shed_with_retry_after(tmp_path, kwargs, reason):
+    scheduler = make_scheduler(tmp_path, **kwargs)
+
+    async def main():
+        async with scheduler.aslot("interactive", "holder"):
+            waiting = asyncio.ensure_future(scheduler.aslot("interactive", "a", timeout=5).__aenter__())
+            await asyncio.sleep(0)
+            with pytest.raises(CallRejected) as info:
+                async with scheduler.aslot("interactive", "a", timeout=5):
+                    pass
+            waiting.cancel()
+            return info.value
+
+    error = asyncio.run(main())
+    assert error.retry_after > 0
+    assert scheduler.stats["rejected"] == 1
+
+
+def test_expected_wait_beyond_the_timeout_is_shed(tmp_path):
+    scheduler = make_scheduler(tmp_path)
+    with scheduler.slot(user="holder"):
+        with pytest.raises(CallRejected):
+            with scheduler.slot(user="a", timeout=0.5):
+                pass
+
+
+def test_timed_out_waiter_leaves_the_queue(tmp_path):
+    scheduler = make_scheduler(tmp_path)
+    scheduler._service_seconds = 0.01
+
+    async def main():
+        async with scheduler.aslot("interactive", "holder"):
+            with pytest.raises(DeadlineExceeded):
+                async with scheduler.aslot("interactive", "a", timeout=0.05):
+                    pass
+            assert scheduler.snapshot()["interactive"] == (1, 0)
+
+    asyncio.run(main())
+    # The slot is free again once the holder is done
+    with scheduler.slot(user="b"):
+        pass
+
+
+def test_batch_yields_slots_under_interactive_pressure(tmp_path):
+    scheduler = make_scheduler(tmp_path, slots=4, batch_share=0.25)
+    with open(os.path.join(str(tmp_path), "interactive-busy"), "a"):
+        pass
+    assert scheduler._limit("batch") == 1
+    assert scheduler._limit("interactive") == 4
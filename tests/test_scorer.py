@@ -0,0 +1,66 @@
+import numpy as np
+
+from scorer import FEATURES, extract_features, rank_candidates, score_prompt, score_prompts, word_limit_fit
+
+STRUCTURED = """You are a senior data engineer. Write a step-by-step guide for migrating a 2 TB PostgreSQL
+database to BigQuery for an audience of backend developers.
+
+Requirements:
+- Cover schema conversion, data transfer and validation
+- Include one example command per step
+- Keep it under 800 words
+
+Format: numbered steps with a short summary at the end."""
+
+
+def sentence_text(words):
+    sentence = "Describe the audience, the goal and the format of the answer in clear terms. "
+    count = len(sentence.split())
+    return (sentence * (words // count + 1)).strip()
+
+
+def test_word_limit_fit_is_one_inside_the_range_and_falls_off_outside():
+    fit = word_limit_fit([300, 400, 500, 150, 750, 0, 1000], 300, 500)
+    assert np.allclose(fit, [1, 1, 1, 0, 0, 0, 0])
+    assert word_limit_fit([225], 300, 500)[0] == 0.5
+
+
+def test_scores_are_on_a_ten_point_scale_and_batch_matches_single():
+    prompts = [STRUCTURED, "write something", ""]
+    batch = score_prompts(prompts)
+    assert ((batch >= 0) & (batch <= 10)).all()
+    assert [score_prompt(prompt).overall for prompt in prompts] == batch[:, 0].tolist()
+
+
+def test_unterminated_prompt_counts_the_same_sentences_in_a_batch():
+    sentences = FEATURES.index("sentences")
+    alone = extract_features(["write something"])[0, sentences]
+    assert extract_features(["write something", "Next prompt."])[0, sentences] == alone
+    assert extract_features(["write something", ""])[0, sentences] == alone
+
+
+def test_lowercasing_that_changes_length_keeps_prompts_aligned():
+    prompts = ["İstanbul İİİ guide, please.", "Write a haiku about rain. Use three lines.", "write something"]
+    batch = extract_features(prompts)
+    for i, prompt in enumerate(prompts):
+        assert (batch[i] == extract_features([prompt])[0]).all()
+
+
+def test_specific_structured_prompt_beats_a_vague_one():
+    structured, vague = score_prompt(STRUCTURED), score_prompt("write something about databases")
+    assert structured.overall > vague.overall
+    assert vague.suggestions and len(vague.suggestions) >= len(structured.suggestions)
+
+
+def test_candidate_within_the_word_limit_ranks_first():
+    texts = [sentence_text(100), sentence_text(400), sentence_text(900)]
+    ranked = rank_candidates(texts, "300-500 words")
+    assert ranked[0].index == 1
+    assert ranked[0].fit == 1.0
+    assert [candidate.index for candidate in ranked].count(1) == 1
+
+
+def test_ties_keep_the_original_order_and_no_limit_ignores_length():
+    text = sentence_text(50)
+    assert [candidate.index for candidate in rank_candidates([text, text, text])] == [0, 1, 2]
+    assert all(candidate.fit == 1.0 for candidate in rank_candidates([sentence_text(10), sentence_text(900)]))
@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+from starlette.responses import JSONResponse
+from starlette.testclient import TestClient
+
+import server
+from metrics import Metrics
+from resilience import DeadlineExceeded
+
+
+@pytest.fixture
+def client(monkeypatch):
+    async def respond(request, data, instruction, cache_key, model_id, field, entry, trace):
+        return JSONResponse({field: entry})
+
+    monkeypatch.setattr(server, "respond", respond)
+    # Not entered as a context manager, so the lifespan never connects to Gemini
+    return TestClient(server.app)
+
+
+@pytest.mark.parametrize("path", ["/refine", "/evaluate"])
+@pytest.mark.parametrize("body, error", [
+    ([1, 2], "Request body must be a JSON object"),
+    ({"prompt": 42}, "Prompt must be a string"),
+    ({"prompt": ["a", "b"]}, "Prompt must be a string"),
+    ({"prompt": "   "}, "Prompt cannot be empty"),
+    ({}, "Prompt cannot be empty"),
+])
+def test_rejects_invalid_prompts(client, path, body, error):
+    response = client.post(path, json=body)
+    assert response.status_code == 400
+    assert response.json() == {"error": error}
+
+
+@pytest.mark.parametrize("tags", ["web", ["web", 1], {"web": True}])
+def test_rejects_tags_that_are_not_a_list_of_strings(client, tags):
+    response = client.post("/refine", json={"prompt": "Write a poem", "tags": tags})
+    assert response.status_code == 400
+    assert response.json() == {"error": "Tags must be a list of strings"}
+
+
+def test_passes_on_the_normalized_prompt_and_tags(client):
+    response = client.post("/refine", json={"prompt": "  Write a poem \n", "tags": ["web", "short"]})
+    assert response.status_code == 200
+    entry = response.json()["refined_output"]
+    assert entry["prompt"] == "Write a poem"
+    assert entry["tags"] == ["web", "short"]
+    assert client.post("/evaluate", json={"prompt": " Write a poem "}).json()["evaluation"]["prompt"] == "Write a poem"
+
+
+async def collect(stream):
+    return [frame async for frame in stream]
+
+
+def failing_chunks(error):
+    async def chunks():
+        yield "First words"
+        raise error
+    return chunks()
+
+
+@pytest.mark.parametrize("error, message", [
+    (RuntimeError("secret detail"), "Error: internal server error"),
+    (DeadlineExceeded("Model call deadline exceeded"), "Error: Model call deadline exceeded"),
+])
+def test_stream_failure_ends_with_an_error_event_and_finishes_the_trace(error, message):
+    registry = Metrics(collectors=())
+    trace = registry.trace("refine")
+    done = []
+    frames = asyncio.run(collect(server.sse_stream(failing_chunks(error), "refined_output", done.append, trace)))
+    assert frames == [server.sse_event({"text": "First words"}), server.sse_event({"error": message}, event="error")]
+    assert done == []
+    assert registry.total("prompt_request_seconds", operation="refine")[0] == 1
+    assert registry._counters[("prompt_errors_total", (("error", type(error).__name__), ("operation", "refine")))] == 1
+
+
+def test_finished_stream_ends_with_done():
+    registry = Metrics(collectors=())
+    done = []
+
+    async def chunks():
+        yield "All "
+        yield "good"
+
+    frames = asyncio.run(collect(server.sse_stream(chunks(), "evaluation", done.append, registry.trace("evaluate"))))
+    assert frames[-1] == server.sse_event({}, event="done")
+    assert done == ["All good"]
+    assert registry.total("prompt_request_seconds", operation="evaluate")[0] == 1
+
+
+def test_unexpected_error_is_a_json_500(monkeypatch):
+    async def agenerate(*args, **kwargs):
+        raise RuntimeError("secret detail")
+
+    monkeypatch.setattr(server, "agenerate", agenerate)
+    monkeypatch.setattr(server.app.state, "gemini", None, raising=False)
+    response = TestClient(server.app).post("/evaluate", json={"prompt": "Write a poem"})
+    assert response.status_code == 500
+    assert response.json() == {"error": "Error: internal server error"}
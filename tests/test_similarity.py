@@ -0,0 +1,34 @@
+from similarity import SimilarityIndex, embed
+
+PROMPT = "Write a tutorial on building a REST API with Flask for intermediate developers"
+
+
+def test_embedding_ignores_whitespace_and_case():
+    assert (embed(PROMPT) == embed("  write a tutorial on building a REST API\n with flask for intermediate developers")).all()
+
+
+def test_lookup_finds_close_prompt_in_scope(tmp_path):
+    index = SimilarityIndex(str(tmp_path))
+    index.add(PROMPT, "refined", "refine|ChatGPT")
+    similarity, prompt, output = index.lookup(PROMPT + ".", "refine|ChatGPT")
+    assert similarity > 0.9
+    assert (prompt, output) == (PROMPT, "refined")
+    assert index.lookup(PROMPT, "refine|Gemini") is None
+
+
+def test_adding_an_indexed_prompt_keeps_one_row(tmp_path):
+    index = SimilarityIndex(str(tmp_path))
+    first = index.add(PROMPT, "first", "scope")
+    assert index.add(" ".join(PROMPT.split(" ")) + "  ", "second", "scope") == first
+    assert index.count == 1
+    assert index.lookup(PROMPT, "scope")[2] == "second"
+    # The same prompt in another scope is a separate entry
+    index.add(PROMPT, "other", "other scope")
+    assert index.count == 2
+
+
+def test_other_processes_rows_are_visible(tmp_path):
+    writer = SimilarityIndex(str(tmp_path))
+    reader = SimilarityIndex(str(tmp_path))
+    writer.add(PROMPT, "refined", "scope")
+    assert reader.lookup(PROMPT, "scope")[2] == "refined"
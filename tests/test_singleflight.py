@@ -0,0 +1,211 @@
+import asyncio
+import json
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from resilience import CallRejected
+from singleflight import SingleFlight
+
+
+@pytest.fixture
+def flight(tmp_path):
+    return SingleFlight(str(tmp_path), stripes=16)
+
+
+def run_threads(count, target):
+    results = [None] * count
+
+    def run(i):
+        try:
+            results[i] = target()
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+def test_concurrent_callers_share_one_call(flight):
+    calls = []
+
+    def fn():
+        calls.append(1)
+        time.sleep(0.1)
+        return "result"
+
+    results = run_threads(8, lambda: flight.do("key", fn))
+    assert len(calls) == 1
+    assert sorted(results, key=lambda r: r[1]) == [("result", False)] * 7 + [("result", True)]
+
+
+def test_error_reaches_every_waiter(flight):
+    def fn():
+        time.sleep(0.1)
+        raise ValueError("bad prompt")
+
+    results = run_threads(4, lambda: flight.do("key", fn))
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_recheck_result_skips_the_call(flight):
+    assert flight.do("key", lambda: pytest.fail("called"), recheck=lambda: "stored") == ("stored", False)
+    assert flight.stats["shared"] == 1
+
+
+def test_other_process_result_is_picked_up(tmp_path):
+    # Two instances on one lock directory stand in for two worker processes
+    instances = [SingleFlight(str(tmp_path)), SingleFlight(str(tmp_path))]
+    store, calls, results = {}, [], [None, None]
+
+    def fn():
+        calls.append(1)
+        time.sleep(0.1)
+        store["key"] = "result"
+        return "result"
+
+    def run(i):
+        results[i] = instances[i].do("key", fn, recheck=lambda: store.get("key"))
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.02)
+    for thread in threads:
+        thread.join(5)
+    assert len(calls) == 1
+    assert results == [("result", True), ("result", False)]
+    assert instances[1].stats["shared"] == 1
+
+
+def test_follower_takes_over_when_the_leader_stream_is_closed(flight):
+    started = threading.Event()
+
+    def chunks():
+        started.set()
+        yield "a"
+        time.sleep(0.1)
+        yield "b"
+
+    leader = flight.stream("key", chunks)
+    assert next(leader) == "a"
+    follower_result = []
+    follower = threading.Thread(target=lambda: follower_result.append(flight.do("key", lambda: "own call")))
+    follower.start()
+    time.sleep(0.05)
+    leader.close()
+    follower.join(5)
+    assert follower_result == [("own call", True)]
+
+
+def test_followers_get_the_streamed_text(flight):
+    def chunks():
+        yield "Hello, "
+        time.sleep(0.1)
+        yield "world"
+
+    results = run_threads(3, lambda: "".join(flight.stream("key", chunks)))
+    assert results == ["Hello, world"] * 3
+
+
+def test_cancelled_async_leader_hands_over(flight):
+    async def slow():
+        await asyncio.sleep(10)
+
+    async def quick():
+        return "follower"
+
+    async def main():
+        leader = asyncio.ensure_future(flight.ado("key", slow))
+        await asyncio.sleep(0.05)
+        follower = asyncio.ensure_future(flight.ado("key", quick))
+        await asyncio.sleep(0.05)
+        leader.cancel()
+        return await asyncio.wait_for(follower, 5)
+
+    assert asyncio.run(main()) == ("follower", True)
+
+
+def test_async_callers_share_one_call(flight):
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "result"
+
+    async def main():
+        return await asyncio.gather(*(flight.ado("key", fn) for _ in range(5)))
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert [fresh for _, fresh in results].count(True) == 1
+
+
+def test_unrelated_keys_on_one_stripe_run_in_parallel(tmp_path):
+    instances = [SingleFlight(str(tmp_path), stripes=1), SingleFlight(str(tmp_path), stripes=1)]
+    store = {}
+
+    def run(i):
+        key = f"key{i}"
+
+        def fn():
+            time.sleep(0.3)
+            store[key] = "result"
+            return "result"
+
+        return instances[i].do(key, fn, recheck=lambda: store.get(key))
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert time.monotonic() - started < 0.5
+
+
+def test_stuck_leader_is_taken_over_once_its_claim_expires(tmp_path):
+    stuck, waiting = SingleFlight(str(tmp_path), lease=0.2), SingleFlight(str(tmp_path), lease=0.2)
+    release = threading.Event()
+    leader = threading.Thread(target=lambda: stuck.do("key", lambda: release.wait(5), recheck=lambda: None))
+    leader.start()
+    time.sleep(0.05)
+    started = time.monotonic()
+    assert waiting.do("key", lambda: "taken over", recheck=lambda: None) == ("taken over", True)
+    assert 0.1 < time.monotonic() - started < 1
+    release.set()
+    leader.join(5)
+
+
+def test_claim_of_a_vanished_process_is_ignored(tmp_path):
+    flight = SingleFlight(str(tmp_path))
+    gone = subprocess.Popen([sys.executable, "-c", "pass"])
+    gone.wait()
+    with open(flight._claim_path("key"), "w") as f:
+        json.dump({"token": "other", "pid": gone.pid, "expires": time.time() + 3600}, f)
+    started = time.monotonic()
+    assert flight.do("key", lambda: "result", recheck=lambda: None) == ("result", True)
+    assert time.monotonic() - started < 0.5
+
+
+def test_rejected_leader_does_not_reject_its_followers(flight):
+    def rejected():
+        time.sleep(0.1)
+        raise CallRejected("Too many queued calls for this user", retry_after=1)
+
+    results = []
+    leader = threading.Thread(target=lambda: results.extend(run_threads(1, lambda: flight.do("key", rejected))))
+    leader.start()
+    time.sleep(0.03)
+    # The follower joins the rejected call, then makes its own
+    assert flight.do("key", lambda: "own call") == ("own call", True)
+    leader.join(5)
+    assert isinstance(results[0], CallRejected)
@@ -0,0 +1,100 @@
+"""Startup and rerun timing report for the Streamlit app.
+
+Each measurement runs in a fresh interpreter, so the first run pays the
+full cold-start cost (imports, client setup) exactly as a new server
+process would. The first run is followed by reruns of every page, timed
+by the app itself (``prompt_rerun_seconds``) from the top of the script to
+the end of the page. Run with::
+
+    python timing_report.py                 # 20 reruns per page
+    python timing_report.py --reruns 50 --pages Home History
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+PAGES = ["Home", "Learn", "About", "Feedback", "Techniques", "History"]
+
+# Runs inside the fresh interpreter; prints one JSON object
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+framework = time.perf_counter() - started
+
+app = AppTest.from_file(sys.argv[1], default_timeout=60)
+started = time.perf_counter()
+app.run()
+first_run = time.perf_counter() - started
+
+# Whether the first run imported the model SDK; it should be left to the first model call
+sdk_imported = "google.generativeai" in sys.modules
+
+# With GEMINI_WARMUP=1, let background warm-up finish so it does not skew the rerun timings
+import threading
+for thread in threading.enumerate():
+    if thread.name == "gemini-warmup":
+        thread.join(30)
+
+# The app records how long each script run takes; the test harness adds
+# polling delays of its own, so wall time around app.run() would hide it
+from metrics import get_metrics
+
+reruns = {}
+pages = json.loads(sys.argv[3])
+for page in pages:
+    app.sidebar.radio[0].set_value(page)
+    timings = []
+    for _ in range(int(sys.argv[2])):
+        before = get_metrics().total("prompt_rerun_seconds", page=page)[1]
+        app.run()
+        timings.append(get_metrics().total("prompt_rerun_seconds", page=page)[1] - before)
+    reruns[page] = timings
+
+print(json.dumps({
+    "framework": framework,
+    "first_run": first_run,
+    "sdk_imported": sdk_imported,
+    "reruns": reruns,
+    "exception": [str(e.value) for e in app.exception],
+}))
+"""
+
+
+def measure(app, reruns, pages):
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE, app, str(reruns), json.dumps(pages)],
+        capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(app)),
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report cold start and per-rerun time of a Streamlit app.")
+    parser.add_argument("--reruns", type=int, default=20)
+    parser.add_argument("--pages", nargs="*", default=PAGES)
+    args = parser.parse_args()
+
+    app = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    result = measure(app, args.reruns, args.pages)
+    if result["exception"]:
+        print(f"App raised: {result['exception']}")
+
+    print(f"Streamlit import:   {result['framework'] * 1000:8.1f} ms")
+    print(f"Cold first run:     {result['first_run'] * 1000:8.1f} ms"
+          f"{'   (model SDK imported)' if result['sdk_imported'] else ''}")
+    for page, timings in result["reruns"].items():
+        print(f"Rerun {page:<12} p50 {statistics.median(timings) * 1000:7.1f} ms   "
+              f"p95 {percentile(timings, 95) * 1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
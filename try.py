@@ -2,26 +2,38 @@
 
 
 import streamlit as st
-import google.generativeai as genai
 import logging
-import json
 import os
+import time
+import uuid
+from cache import make_cache_key
+from clients import get_registry, route_model
+from feedback import get_feedback_pipeline
+from history import LOCAL_OWNER, get_history
+from llm import generate
+from metrics import get_metrics, start_metrics_server
+from prompts import MODES, build_critique_instruction, build_mode_instruction
+from scorer import format_local_score, score_prompt
 from dotenv import load_dotenv,dotenv_values
 load_dotenv()
 # Initialize logging
 logging.basicConfig(level=logging.INFO)
 
-# Gemini API Key (replace "YOUR_API_KEY" with your actual key or load from environment variable)
- # Use os.environ.get("GEMINI_API_KEY") for secure storage
-
-# Configure the Gemini client
+# Configure the Gemini client from GEMINI_API_KEY / API_KEY in .env
 try:
-    genai.configure(api_key="your api key here")
+    get_registry()
 except Exception as e:
     logging.error(f"Failed to configure Gemini API: {e}")
     st.error("Failed to configure Gemini API. Please check your API key.")
     st.stop()
 
+# Serve /metrics for Prometheus when METRICS_PORT is set
+start_metrics_server()
+
+# Identifies the session to the scheduler, which takes turns between users
+if "user_id" not in st.session_state:
+    st.session_state.user_id = uuid.uuid4().hex
+
 # Streamlit UI
 st.title("Prompt Generator and Evaluator")
 
@@ -29,43 +41,42 @@ st.title("Prompt Generator and Evaluator")
 st.header("Refine Your Prompt")
 user_input = st.text_area("Enter your rough prompt:", placeholder="E.g., I want to ask GPT about AI in education.")
 mode = st.selectbox("How should the refined prompt be?", ["Creativity", "Technical", "Mix of Both"])
+bypass_cache = st.checkbox("Bypass cache")
+
+# Save a generation to the prompt history in the background
+def save_history(kind, prompt, generation, model_id, started, tags=()):
+    get_history().record(kind, prompt, generation.text, model_id=model_id, tags=tags,
+                         latency=round(time.perf_counter() - started, 3),
+                         prompt_tokens=generation.prompt_tokens, completion_tokens=generation.completion_tokens,
+                         owner=LOCAL_OWNER)
 
 # Function to refine the prompt
-def refine_prompt(user_input, mode):
-    task_instructions = {
-        "Creativity": (
-            "You will act as an expert prompt creator to refine the following prompt into a creative, imaginative, and engaging version. "
-            "Ensure the refined prompt captures the essence of the original input while inspiring engaging and imaginative responses.\n\n"
-            "Input Prompt:\n{user_input}\n\nOutput:"
-        ),
-        "Technical": (
-            "You will act as an expert prompt creator to refine the following prompt into a technical, precise, and factually accurate version. "
-            "Ensure the refined prompt maintains logical structure, clarity, and correctness, tailored for technical queries.\n\n"
-            "Input Prompt:\n{user_input}\n\nOutput:"
-        ),
-        "Mix of Both": (
-            "You will act as an expert prompt creator to refine the following prompt, balancing creativity with technical precision. "
-            "Ensure the refined prompt is both engaging and technically accurate, offering a perfect blend of imaginative and precise details.\n\n"
-            "Input Prompt:\n{user_input}\n\nOutput:"
-        )
-    }
-
-    if mode not in task_instructions:
+def refine_prompt(user_input, mode, bypass_cache=False):
+    if mode not in MODES:
         return "Invalid mode selected."
 
-    instruction = task_instructions[mode].replace("{user_input}", user_input)
     try:
-        # Use Gemini API to refine the prompt
-        model = genai.GenerativeModel("gemini-1.5-flash")
-        response = model.generate_content(instruction)
-        return response.text
+        with get_metrics().trace("refine", mode=mode) as trace:
+            with trace.stage("build_instruction"):
+                instruction = build_mode_instruction(user_input, mode)
+            # Use Gemini API to refine the prompt
+            model_id = route_model("refine")
+            cache_key = make_cache_key("refine", user_input, model_id, mode=mode)
+            started = time.perf_counter()
+            with trace.stage("generate"):
+                generation = generate(instruction, cache_key=cache_key, bypass_cache=bypass_cache, model_id=model_id,
+                                      latency_class=mode, user=st.session_state.user_id)
+            trace.annotate(model=model_id, prompt_tokens=generation.prompt_tokens,
+                           completion_tokens=generation.completion_tokens, cached=generation.cached)
+            save_history("refine", user_input, generation, model_id, started, tags=[mode])
+            return generation.text
     except Exception as e:
         logging.error(f"API call failed: {e}")
         return f"Error refining prompt: {e}"
 
 if st.button("Refine Prompt"):
     if user_input.strip():
-        refined_prompt = refine_prompt(user_input, mode)
+        refined_prompt = refine_prompt(user_input, mode, bypass_cache)
         st.text_area("Refined Prompt:", value=refined_prompt, height=150)
     else:
         st.warning("Please enter a rough prompt to refine.")
@@ -75,30 +86,33 @@ st.header("Evaluate a Prompt")
 prompt_to_evaluate = st.text_area("Enter the prompt for evaluation:")
 
 # Function to evaluate prompts with critique
-def evaluate_prompt(prompt_to_evaluate):
-    instruction = (
-        "You will act as an expert prompt evaluator. Evaluate the following prompt based on these criteria: "
-        "1. Structure: Is the prompt logically organized? "
-        "2. Clarity: Is the prompt precise and unambiguous? "
-        "3. Words and Tone: Is the language appropriate for the audience and purpose? "
-        "4. Effectiveness: Does the prompt achieve its intended goal?\n\n"
-        "Prompt to Evaluate:\n{prompt_to_evaluate}\n\n*Critique:*\n{Provide detailed feedback with actionable suggestions for improvement.}"
-    )
-
-    instruction = instruction.replace("{prompt_to_evaluate}", prompt_to_evaluate)
-
+def evaluate_prompt(prompt_to_evaluate, bypass_cache=False):
     try:
-        # Use Gemini API for evaluation
-        model = genai.GenerativeModel("gemini-1.5-flash")
-        response = model.generate_content(instruction)
-        return response.text
+        with get_metrics().trace("evaluate") as trace:
+            with trace.stage("build_instruction"):
+                instruction = build_critique_instruction(prompt_to_evaluate)
+            # Use Gemini API for evaluation
+            model_id = route_model("evaluate")
+            cache_key = make_cache_key("evaluate", prompt_to_evaluate, model_id, variant="critique")
+            started = time.perf_counter()
+            with trace.stage("generate"):
+                generation = generate(instruction, cache_key=cache_key, bypass_cache=bypass_cache, model_id=model_id,
+                                      latency_class="evaluate", user=st.session_state.user_id)
+            trace.annotate(model=model_id, prompt_tokens=generation.prompt_tokens,
+                           completion_tokens=generation.completion_tokens, cached=generation.cached)
+            save_history("evaluate", prompt_to_evaluate, generation, model_id, started)
+            return generation.text
     except Exception as e:
         logging.error(f"API call failed: {e}")
         return f"Error evaluating prompt: {e}"
 
-if st.button("Evaluate Prompt"):
+# Instant local score; the model is only asked for the detailed critique
+if prompt_to_evaluate.strip():
+    st.text_area("Instant Score:", value=format_local_score(score_prompt(prompt_to_evaluate)), height=200)
+
+if st.button("Get Detailed Critique"):
     if prompt_to_evaluate.strip():
-        evaluation_result = evaluate_prompt(prompt_to_evaluate)
+        evaluation_result = evaluate_prompt(prompt_to_evaluate, bypass_cache)
         st.text_area("Evaluation Result:", value=evaluation_result, height=250)
     else:
         st.warning("Please enter a prompt for evaluation.")
@@ -107,13 +121,13 @@ if st.button("Evaluate Prompt"):
 st.header("Feedback and Report")
 issue_description = st.text_area("Describe the issue or provide feedback:")
 user_email = st.text_input("Your email (optional):")
+st.caption("Feedback is sent to the project's feedback form, like feedback from the main app.")
 
 if st.button("Submit Feedback"):
     if issue_description.strip():
-        feedback = {"description": issue_description, "email": user_email}
-        with open("feedback_log.json", "a") as log_file:
-            json.dump(feedback, log_file)
-            log_file.write("\n")
+        # Same fields as main.py's feedback page, which the endpoint expects
+        feedback = {"feedback": issue_description, "email": user_email}
+        get_feedback_pipeline().submit(feedback)
         st.success("Feedback submitted successfully.")
     else:
         st.warning("Please provide a description for your feedback.")